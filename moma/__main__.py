@@ -0,0 +1,3 @@
+from moma.moma import main
+
+main()
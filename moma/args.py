@@ -28,6 +28,91 @@ def parse_args():
         action="store_true",
         help="Force overwrite of the directory contents if it exists",
     )
+    store_parser.add_argument(
+        "--compress",
+        "-c",
+        action="store_true",
+        help="Compress the .exo and .log files of the run",
+    )
+    store_parser.add_argument(
+        "--codec",
+        choices=["gzip", "lzma", "zstd"],
+        help="Compression codec (default: zstd if the zstandard package is installed, else gzip)",
+    )
+    store_parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        help="Number of compression threads (default: all cores)",
+    )
+
+    # ---------------------------------- Archive --------------------------------- #
+    archive_parser = subparsers.add_parser(
+        "archive",
+        help="Compress the .exo and .log files of a stored run",
+    )
+    archive_parser.add_argument(
+        "identifier",
+        type=str,
+        help="Identifier of the run",
+    )
+    archive_parser.add_argument(
+        "--codec",
+        choices=["gzip", "lzma", "zstd"],
+        help="Compression codec (default: zstd if the zstandard package is installed, else gzip)",
+    )
+    archive_parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        help="Number of compression threads (default: all cores)",
+    )
+
+    # ----------------------------------- Query ---------------------------------- #
+    query_parser = subparsers.add_parser(
+        "query",
+        help="Query the catalog of stored runs",
+    )
+    query_parser.add_argument(
+        "filters",
+        type=str,
+        nargs="*",
+        help="Filters like 'tNumElementsX=40' or 'walltime<100' on parameters or on identifier, build_type, processors, walltime, iterations and final_residual",
+    )
+    query_parser.add_argument(
+        "--sort",
+        "-s",
+        type=str,
+        help="Column or parameter to sort by",
+    )
+    query_parser.add_argument(
+        "--descending",
+        action="store_true",
+        help="Sort in descending order",
+    )
+    query_parser.add_argument(
+        "--limit",
+        "-n",
+        type=int,
+        help="Maximum number of runs to show",
+    )
+    query_parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the runs as json",
+    )
+
+    # ---------------------------------- Reindex --------------------------------- #
+    reindex_parser = subparsers.add_parser(
+        "reindex",
+        help="Rebuild the catalog of stored runs from the result directories",
+    )
+    reindex_parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        help="Number of worker processes (default: all cores)",
+    )
 
     # ------------------------------------ Run ----------------------------------- #
     run_parser = subparsers.add_parser(
@@ -38,8 +123,7 @@ def parse_args():
         "--processors",
         "-np",
         type=int,
-        default=1,
-        help="Number of processors to use",
+        help="Number of processors to use (default: 'processors' in the moris.json or 1)",
     )
     run_parser.add_argument(
         "--shared-object-only",
@@ -55,13 +139,62 @@ def parse_args():
     run_parser.add_argument(
         "--apply-parameters",
         action="store_true",
-        help="Apply the parameters from the moris.json to the C++ file",
+        help="Apply the parameters from the moris.json to the C++ file (or to moma_parameters.txt with \"parameter_mode\": \"runtime\")",
     )
     run_parser.add_argument(
         "--no-clean",
         action="store_true",
         help="Do not clean the directory before running",
     )
+    run_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always compile the shared object instead of restoring it from the build cache",
+    )
+    run_parser.add_argument(
+        "--isolate",
+        action="store_true",
+        help="Build and run in a private scratch directory and moris tree overlay, so concurrent runs do not contend for the moris lock",
+    )
+    run_parser.add_argument(
+        "--compress-log",
+        nargs="?",
+        const=True,
+        choices=["gzip", "lzma", "zstd"],
+        help="Write the log as seekable compressed chunks while moris runs (default codec: zstd if the zstandard package is installed, else gzip)",
+    )
+    run_parser.add_argument(
+        "--events",
+        metavar="TARGET",
+        help="Stream the events of the run (iterations, sections, stderr, ...) as JSON lines to a file, a FIFO or unix:<socket path>",
+    )
+    run_parser.add_argument(
+        "--scaling-study",
+        metavar="NP_LIST",
+        help="Run the case with each of the processor counts (e.g. 1,2,4,8) and report speedup, parallel efficiency and the Karp-Flatt metric",
+    )
+    run_parser.add_argument(
+        "--weak",
+        metavar="PARAMETER",
+        help="Weak scaling for --scaling-study: scale this (size) parameter from the moris.json with the processor count",
+    )
+    run_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Runs per processor count for --scaling-study, the fastest one counts",
+    )
+    run_parser.add_argument(
+        "--min-efficiency",
+        type=float,
+        default=0.7,
+        help="Smallest parallel efficiency of the recommended processor count",
+    )
+    run_parser.add_argument(
+        "--record",
+        action="store_true",
+        help="Save the recommended processor count as 'processors' in the moris.json",
+    )
     run_parser_build_type = run_parser.add_mutually_exclusive_group()
     run_parser_build_type.add_argument(
         "--dbg",
@@ -76,6 +209,141 @@ def parse_args():
         help="Run the optimized version of moris",
     )
     
+    # ---------------------------------- Build ----------------------------------- #
+    build_parser = subparsers.add_parser(
+        "build",
+        help="Build the shared objects of several projects and build types concurrently",
+    )
+    build_parser.add_argument(
+        "projects",
+        nargs="*",
+        help="Project directories (default: the current directory)",
+    )
+    build_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="Maximum number of concurrent builds (default: all cores)",
+    )
+    build_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always compile the shared objects instead of restoring them from the build cache",
+    )
+    build_parser.add_argument(
+        "--dbg",
+        "-d",
+        action="store_true",
+        help="Build against the debug version of moris (default)",
+    )
+    build_parser.add_argument(
+        "--opt",
+        "-o",
+        action="store_true",
+        help="Build against the optimized version of moris, together with --dbg both are built",
+    )
+
+    # ---------------------------------- Sweep ----------------------------------- #
+    sweep_parser = subparsers.add_parser(
+        "sweep",
+        help="Run all parameter combinations from the moris.json in parallel",
+    )
+    sweep_parser.add_argument(
+        "--processors",
+        "-np",
+        type=int,
+        help="Number of processors to use for each case (default: 'processors' in the moris.json or 1)",
+    )
+    sweep_parser.add_argument(
+        "--cores",
+        "-c",
+        type=int,
+        help="Maximum number of cores used by all concurrent cases (default: 'cores' in the sweep config or all cores)",
+    )
+    sweep_parser.add_argument(
+        "--force",
+        "-f",
+        action="store_true",
+        help="Force overwrite of existing case directories",
+    )
+    sweep_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only list the cases of the sweep",
+    )
+    sweep_parser_build_type = sweep_parser.add_mutually_exclusive_group()
+    sweep_parser_build_type.add_argument(
+        "--dbg",
+        "-d",
+        action="store_true",
+        help="Run the debug version of moris",
+    )
+    sweep_parser_build_type.add_argument(
+        "--opt",
+        "-o",
+        action="store_true",
+        help="Run the optimized version of moris",
+    )
+
+    # ----------------------------------- Watch ---------------------------------- #
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Follow a running simulation and plot its residuals live",
+    )
+    watch_parser.add_argument(
+        "--run",
+        "-r",
+        type=str,
+        help="Identifier of a stored run to show instead of following the current directory",
+    )
+    watch_parser.add_argument(
+        "--interval",
+        "-i",
+        type=float,
+        default=2.0,
+        help="Seconds between checks of the log for new output",
+    )
+    watch_parser.add_argument(
+        "--plot-interval",
+        type=float,
+        default=30.0,
+        help="Minimum number of seconds between two renderings of the plot",
+    )
+    watch_parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        help="Image file of the plot (default: residuals.png)",
+    )
+    watch_parser.add_argument(
+        "--dpi",
+        type=int,
+        default=100,
+        help="Resolution of the plot",
+    )
+    watch_parser.add_argument(
+        "--no-plot",
+        action="store_true",
+        help="Only show the progress in the terminal",
+    )
+    watch_parser.add_argument(
+        "--nice",
+        type=int,
+        default=10,
+        help="Increment of the niceness of the watcher, 0 keeps the priority",
+    )
+
+    # ----------------------------------- Cache ---------------------------------- #
+    cache_parser = subparsers.add_parser(
+        "cache",
+        help="Show the statistics of the shared object build cache",
+    )
+    cache_parser.add_argument(
+        "--clear",
+        action="store_true",
+        help="Remove all entries from the build cache",
+    )
+
     # ----------------------------------- Post ----------------------------------- #
     post_parser = subparsers.add_parser(
         "post",
@@ -84,11 +352,108 @@ def parse_args():
     post_subparsers = post_parser.add_subparsers(dest="post_command")
     
     # residuals
-    post_subparsers.add_parser(
+    residuals_parser = post_subparsers.add_parser(
         "residuals",
         help="Plot the residuals",
     )
+    residuals_parser.add_argument(
+        "--run",
+        "-r",
+        type=str,
+        help="Identifier of a stored run to plot instead of the current directory",
+    )
     
+    # compare
+    compare_parser = post_subparsers.add_parser(
+        "compare",
+        help="Plot the Newton metrics of several stored runs in one figure",
+    )
+    compare_parser.add_argument(
+        "runs",
+        type=str,
+        nargs="+",
+        help="Identifiers or glob patterns of the stored runs (e.g. 'mesh_*')",
+    )
+    compare_parser.add_argument(
+        "--metric",
+        "-m",
+        type=str,
+        action="append",
+        choices=["ResidualNorm", "SolutionNorm", "RelResidualDrop", "LoadFactor", "Time"],
+        help="Metric to compare, one figure per metric (default: ResidualNorm)",
+    )
+    compare_parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default="compare.png",
+        help="Output file, the metric is appended to the name for several metrics",
+    )
+    compare_parser.add_argument(
+        "--max-points",
+        type=int,
+        default=2000,
+        help="Series with more iterations are decimated to this many points (about two per pixel column)",
+    )
+    compare_parser.add_argument(
+        "--dpi",
+        type=int,
+        default=150,
+        help="Resolution of the figures",
+    )
+    compare_parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        help="Number of processes rendering the figures (default: all cores)",
+    )
+
+    # profile
+    profile_parser = post_subparsers.add_parser(
+        "profile",
+        help="Show or export the time spent in the moris sections",
+    )
+    profile_parser.add_argument(
+        "--run",
+        "-r",
+        type=str,
+        help="Identifier of a stored run instead of the current directory",
+    )
+    profile_parser.add_argument(
+        "--format",
+        "-f",
+        type=str,
+        choices=["table", "collapsed", "speedscope"],
+        default="table",
+        help="Summary table per stage, collapsed stacks for flamegraph.pl or a speedscope profile",
+    )
+    profile_parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        help="Output file (default: profile.folded or profile.speedscope.json)",
+    )
+    profile_parser.add_argument(
+        "--limit",
+        "-n",
+        type=int,
+        default=30,
+        help="Number of stages in the table",
+    )
+
+    # metrics
+    metrics_parser = post_subparsers.add_parser(
+        "metrics",
+        help="Export the Newton iteration metrics to csv",
+    )
+    metrics_parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default="newton_iterations.csv",
+        help="Output file",
+    )
+
     # extract
     extract_parser = post_subparsers.add_parser(
         "extract",
@@ -98,7 +463,8 @@ def parse_args():
         "--marker",
         "-m",
         type=str,
-        help="Name of the marker that indicates which lines to extract",
+        action="append",
+        help="Name of the marker that indicates which lines to extract. Can be given multiple times to extract several markers in one pass, each into its own file (<output>_<marker>.csv)",
     )
     extract_parser.add_argument(
         "--sep",
@@ -109,7 +475,8 @@ def parse_args():
     extract_parser.add_argument(
         "--header",
         type=str,
-        help="Header for the csv file. Has to have the same number of columns as the values. All column names have to be separated by the separator.",
+        action="append",
+        help="Header for the csv file. Has to have the same number of columns as the values. All column names have to be separated by the separator. Give one header per marker when extracting multiple markers.",
     )
     extract_parser.add_argument(
         "--output",
@@ -118,6 +485,228 @@ def parse_args():
         default="extracted.csv",
         help="Output file",
     )
+    extract_parser.add_argument(
+        "--run",
+        "-r",
+        type=str,
+        help="Identifier of a stored run to extract from instead of the current directory",
+    )
+    extract_parser.add_argument(
+        "--runs",
+        type=str,
+        nargs="+",
+        help="Identifiers or glob patterns of stored runs (e.g. 'mesh_*'). The rows of all runs go to one file (csv, or parquet for a .parquet output), tagged with the run and its parameters",
+    )
+    extract_parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        help="Number of processes reading the logs for --runs (default: all cores)",
+    )
+    extract_parser.add_argument(
+        "--follow",
+        "-f",
+        action="store_true",
+        help="Keep following the log and append new rows as they are written",
+    )
+    extract_parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="Polling interval in seconds for --follow",
+    )
+
+    # exo
+    exo_parser = post_subparsers.add_parser(
+        "exo",
+        help="Export fields of the Exodus output (memory mapped, netCDF classic format)",
+    )
+    exo_parser.add_argument(
+        "file",
+        type=str,
+        nargs="?",
+        help="Exodus file (default: <project>.exo)",
+    )
+    exo_parser.add_argument(
+        "--run",
+        "-r",
+        type=str,
+        help="Identifier of a stored run instead of the current directory",
+    )
+    exo_parser.add_argument(
+        "--list",
+        "-l",
+        action="store_true",
+        help="Only list the time steps, blocks and variables of the file",
+    )
+    exo_parser.add_argument(
+        "--field",
+        "-f",
+        type=str,
+        action="append",
+        help="Nodal or element variable to export, can be given multiple times (default: all)",
+    )
+    exo_parser.add_argument(
+        "--steps",
+        "-s",
+        type=str,
+        help="Time steps as indices and slices, e.g. '-1', '0,10,20' or '10:50:5' (default: all)",
+    )
+    exo_parser.add_argument(
+        "--block",
+        "-b",
+        type=str,
+        action="append",
+        help="Id or name of an element block for element variables (default: all)",
+    )
+    exo_parser.add_argument(
+        "--coordinates",
+        "-c",
+        action="store_true",
+        help="Export the node coordinates as well",
+    )
+    exo_parser.add_argument(
+        "--format",
+        type=str,
+        choices=["npz", "csv"],
+        default="npz",
+        help="Arrays of shape (steps, entities) per field or one csv row per step and entity",
+    )
+    exo_parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        help="Output file (default: <project>_fields.npz or .csv)",
+    )
+
+    # ----------------------------------- Bench ---------------------------------- #
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Benchmark moma itself",
+    )
+    bench_subparsers = bench_parser.add_subparsers(dest="bench_command")
+
+    # log-filter
+    bench_log_filter_parser = bench_subparsers.add_parser(
+        "log-filter",
+        help="Measure the throughput of the log filter on a synthetic moris log",
+    )
+    bench_log_filter_parser.add_argument(
+        "--lines",
+        "-n",
+        type=int,
+        default=1_000_000,
+        help="Number of lines of the synthetic log",
+    )
+    bench_log_filter_parser.add_argument(
+        "--repeat",
+        "-r",
+        type=int,
+        default=3,
+        help="Number of repetitions",
+    )
+
+    # startup
+    bench_startup_parser = bench_subparsers.add_parser(
+        "startup",
+        help="Measure the import time of each command and check that light commands stay light",
+    )
+    bench_startup_parser.add_argument(
+        "--repeat",
+        "-r",
+        type=int,
+        default=5,
+        help="Number of repetitions",
+    )
+    bench_startup_parser.add_argument(
+        "--budget",
+        type=float,
+        help="Fail if the import time of a light command (all but post) exceeds this many milliseconds",
+    )
+
+    # coordinates
+    bench_coordinates_parser = bench_subparsers.add_parser(
+        "coordinates",
+        help="Compare the coordinate column packing with the previous row by row implementation",
+    )
+    bench_coordinates_parser.add_argument(
+        "--rows",
+        "-n",
+        type=int,
+        default=100_000,
+        help="Number of rows",
+    )
+    bench_coordinates_parser.add_argument(
+        "--groups",
+        "-g",
+        type=int,
+        default=2,
+        help="Number of coordinate groups (x, y and z columns each)",
+    )
+    bench_coordinates_parser.add_argument(
+        "--skip-reference",
+        action="store_true",
+        help="Only time the vectorized implementation (the reference is slow for many rows)",
+    )
+
+    # run
+    bench_run_parser = bench_subparsers.add_parser(
+        "run",
+        help="Run the reference projects of a benchmark suite and save the measurements",
+    )
+    bench_run_parser.add_argument(
+        "--suite",
+        "-s",
+        type=str,
+        default="bench_suite.json",
+        help="Suite file with the reference projects (path, build_type, processors, repeat and optionally a recorded log to replay)",
+    )
+    bench_run_parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default="bench_results.json",
+        help="Output file, use it as baseline for later comparisons",
+    )
+    bench_run_parser.add_argument(
+        "--repeat",
+        "-r",
+        type=int,
+        help="Number of runs per project (default: 'repeat' in the suite or 3)",
+    )
+    bench_run_parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Use the build cache (the shared object build time is then not measured)",
+    )
+
+    # compare
+    bench_compare_parser = bench_subparsers.add_parser(
+        "compare",
+        help="Compare benchmark results with a baseline and fail on significant regressions",
+    )
+    bench_compare_parser.add_argument(
+        "baseline",
+        type=str,
+        help="Results of 'moma bench run' to compare against",
+    )
+    bench_compare_parser.add_argument(
+        "current",
+        type=str,
+        help="Results of 'moma bench run' to check",
+    )
+    bench_compare_parser.add_argument(
+        "--alpha",
+        type=float,
+        default=0.05,
+        help="Significance level of Welch's t-test",
+    )
+    bench_compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.05,
+        help="Minimum relative change of the mean that counts as regression",
+    )
 
     # ----------------------------------- Clean ---------------------------------- #
     clean_parser = subparsers.add_parser(
@@ -135,6 +724,30 @@ def parse_args():
         action="store_true",
         help="Remove the lock file",
     )
+    clean_parser.add_argument(
+        "--recursive",
+        "-r",
+        action="store_true",
+        help="Clean every project directory (with a moris.json) below the directory, e.g. all sweep cases",
+    )
+    clean_parser.add_argument(
+        "directory",
+        type=str,
+        nargs="?",
+        help="Root directory for --recursive (default: current directory)",
+    )
+    clean_parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        default=16,
+        help="Number of directories scanned concurrently with --recursive",
+    )
+    clean_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report what would be removed",
+    )
     
     # ------------------------------------ New ----------------------------------- #
     new_parser = subparsers.add_parser(
@@ -0,0 +1,404 @@
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from moma.log_filter import MorisLogFilter
+from moma.metrics import load_metrics
+from moma.run import RECEIPT_FILE
+
+logger = logging.getLogger(__name__)
+
+# modules that main() imports for each command, keep in sync with moma.moma
+STARTUP_MODULES = {
+    "store": ["moma.store"],
+    "archive": ["moma.store"],
+    "query": ["moma.catalog"],
+    "reindex": ["moma.catalog"],
+    "run": ["moma.clean", "moma.parameter", "moma.run", "moma.scaling"],
+    "build": ["moma.build"],
+    "sweep": ["moma.sweep"],
+    "watch": ["moma.watch"],
+    "clean": ["moma.clean"],
+    "cache": ["moma.build_cache"],
+    "bench": ["moma.bench"],
+    "new": ["moma.new"],
+    "post": ["moma.post"],
+}
+HEAVY_MODULES = ("pandas", "matplotlib", "numpy")
+HEAVY_COMMANDS = ("post",)
+
+
+def generate_synthetic_log(num_lines: int, seed: int = 0) -> List[str]:
+    """Create stripped lines that resemble the stdout of a moris run with load stepping"""
+    rng = random.Random(seed)
+    lines: List[str] = ["__MORIS - Run - Main"]
+    iteration = 0
+    while len(lines) < num_lines:
+        lines.append("|  |__NonLinearAlgorithm - Newton - Solve")
+        for _ in range(rng.randint(20, 60)):
+            lines.append(
+                f"|  |  |  Linear solver: Belos - Iterations: {rng.randint(10, 200)} - Residual: {rng.random():.6e}"
+            )
+        iteration += 1
+        residual = rng.random()
+        lines += [
+            f"|  |  Newton - Iteration: {iteration}",
+            f"|  |  Newton - LoadFactor: {rng.random():.6e}",
+            f"|  |  Newton - ResidualNorm: {residual:.6e}",
+            f"|  |  Newton - SolutionNorm: {rng.random():.6e}",
+            f"|  |  Newton - RelResidualDrop: {residual / 2:.6e}",
+            f"|  |  Newton - Relaxation Parameter: {1.0:.6e}",
+            f"|  |  Newton - IterationTime: {rng.random():.6e}",
+        ]
+        for _ in range(rng.randint(5, 20)):
+            lines.append(f"|  |  |__XTK - Decompose - Mesh {rng.randint(0, 1000)}")
+            lines.append(f"Number of elements: {rng.randint(0, 10**6)}")
+    lines.append("Global Clock Stopped. ElapsedTime = 123.45")
+    return lines[:num_lines]
+
+
+def bench_log_filter(args):
+    lines = generate_synthetic_log(args.lines)
+    rates = []
+    cwd = os.getcwd()
+    filter_logger = logging.getLogger("moma.log_filter")
+    level = filter_logger.level
+    # the filter writes its metrics to the working directory and should not spam the console
+    filter_logger.setLevel(logging.WARNING)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            for _ in range(args.repeat):
+                log_filter = MorisLogFilter()
+                start = time.perf_counter()
+                for line in lines:
+                    log_filter.log(line)
+                log_filter.close()
+                rates.append(len(lines) / (time.perf_counter() - start))
+    finally:
+        os.chdir(cwd)
+        filter_logger.setLevel(level)
+
+    logger.info(
+        f"Log filter throughput on {len(lines)} synthetic lines ({args.repeat} repeats):\n"
+        + f"  best  : {max(rates):,.0f} lines/s\n"
+        + f"  median: {sorted(rates)[len(rates) // 2]:,.0f} lines/s"
+    )
+
+
+def _measure_import_time(modules: List[str]) -> Tuple[float, Set[str]]:
+    """Import time in ms of the entry point plus the modules and all imported top-level packages"""
+    code = "import moma.moma as m; m.configure_logging(); " + "; ".join(
+        f"import {module}" for module in modules
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    total = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        packages.add(name.strip().split(".")[0])
+        if not name.startswith("  "):
+            total += int(cumulative)
+    return total / 1000, packages
+
+
+def bench_startup(args):
+    results: Dict[str, float] = {}
+    failed = []
+    for command, modules in STARTUP_MODULES.items():
+        times = []
+        for _ in range(args.repeat):
+            import_time, packages = _measure_import_time(modules)
+            times.append(import_time)
+        results[command] = min(times)
+
+        heavy = sorted(packages.intersection(HEAVY_MODULES))
+        if heavy and command not in HEAVY_COMMANDS:
+            logger.error(f"'moma {command}' imports {', '.join(heavy)} at startup")
+            failed.append(command)
+        if args.budget and command not in HEAVY_COMMANDS and results[command] > args.budget:
+            logger.error(
+                f"'moma {command}' needs {results[command]:.1f} ms to import (budget: {args.budget} ms)"
+            )
+            failed.append(command)
+
+    logger.info(
+        f"Import time per command (best of {args.repeat}):\n"
+        + "\n".join(f"  {command:6}: {ms:7.1f} ms" for command, ms in results.items())
+    )
+    if failed:
+        raise SystemExit(1)
+
+
+def _convert_row_by_row(df, name):
+    # the previous implementation of post._convert_to_coordinate_column as reference
+    import numpy as np
+
+    coord_columns = sorted(
+        col for col in df.columns if col.startswith(name) and col[-1] in ["x", "y", "z"]
+    )
+    df[name] = df.apply(lambda row: np.array([row[col] for col in coord_columns]), axis=1)
+    df.drop(columns=coord_columns, inplace=True)
+    return df
+
+
+def bench_coordinates(args):
+    import numpy as np
+    import pandas as pd
+    from moma.post import _convert_to_coordinate_column
+
+    rng = np.random.default_rng(0)
+    names = [f"P{i}" for i in range(args.groups)]
+    df = pd.DataFrame(
+        {name + axis: rng.random(args.rows) for name in names for axis in "xyz"}
+    )
+
+    start = time.perf_counter()
+    vectorized = _convert_to_coordinate_column(df.copy(), *names)
+    vectorized_time = time.perf_counter() - start
+
+    text = (
+        f"Packing {args.groups} coordinate groups of {args.rows} rows:\n"
+        + f"  vectorized : {vectorized_time:8.3f} s"
+    )
+    if not args.skip_reference:
+        start = time.perf_counter()
+        reference = df.copy()
+        for name in names:
+            reference = _convert_row_by_row(reference, name)
+        reference_time = time.perf_counter() - start
+        for name in names:
+            assert np.array_equal(np.stack(reference[name]), np.stack(vectorized[name]))
+        text += (
+            f"\n  row by row : {reference_time:8.3f} s"
+            + f"\n  speedup    : {reference_time / vectorized_time:8.1f}x"
+        )
+    logger.info(text)
+
+
+BENCH_METRICS = ("walltime", "elapsed", "iteration_time", "build_time", "moma_cpu_time")
+
+
+def _load_suite(path: Path) -> List[Dict[str, Any]]:
+    try:
+        suite = json.loads(path.read_text())
+    except FileNotFoundError:
+        logger.error(f"Benchmark suite {path} not found")
+        raise SystemExit(1)
+    projects = []
+    for project in suite.get("projects", []):
+        if "path" not in project:
+            logger.error(f"Project without 'path' in {path}: {project}")
+            raise SystemExit(1)
+        # paths are relative to the suite file
+        project_dir = (path.parent / project["path"]).resolve()
+        projects.append(
+            {
+                "name": project.get("name", project_dir.name),
+                "directory": project_dir,
+                "build_type": project.get("build_type", "opt"),
+                "processors": project.get("processors", 1),
+                "repeat": project.get("repeat", suite.get("repeat", 3)),
+                "replay": (path.parent / project["replay"]).resolve()
+                if project.get("replay")
+                else None,
+                "rate": project.get("rate", 0),
+            }
+        )
+    if not projects:
+        logger.error(f"No projects in benchmark suite {path}")
+        raise SystemExit(1)
+    return projects
+
+
+def _run_reference(project: Dict[str, Any], use_cache: bool) -> Dict[str, Optional[float]]:
+    command = [
+        sys.executable,
+        "-m",
+        "moma",
+        "run",
+        "-np",
+        str(project["processors"]),
+        f"--{project['build_type']}",
+    ]
+    env = dict(os.environ)
+    if project["replay"] is not None:
+        # the recorded log replaces moris, there is nothing to build
+        command.append("--run-only")
+        env["MOMA_MPIRUN"] = ""
+        env["MOMA_MORIS"] = shlex.join(
+            [
+                sys.executable,
+                "-m",
+                "moma.fake_moris",
+                "--log",
+                str(project["replay"]),
+                "--rate",
+                str(project["rate"]),
+            ]
+        )
+    elif not use_cache:
+        command.append("--no-cache")
+
+    directory = project["directory"]
+    with (directory / "moma_bench.out").open("wb") as out:
+        result = subprocess.run(
+            command, cwd=directory, env=env, stdout=out, stderr=out, check=False
+        )
+    if result.returncode != 0:
+        logger.error(
+            f"Benchmark run of {project['name']} failed, see {directory / 'moma_bench.out'}"
+        )
+        raise SystemExit(1)
+
+    receipt = json.loads((directory / RECEIPT_FILE).read_text())
+    try:
+        iteration_times = load_metrics(directory)["Time"]
+        iteration_time = float(statistics.median(iteration_times.tolist()))
+    except (FileNotFoundError, KeyError, statistics.StatisticsError):
+        iteration_time = None
+    return {
+        "walltime": receipt.get("walltime"),
+        "elapsed": receipt.get("elapsed"),
+        "iteration_time": iteration_time,
+        "build_time": receipt.get("build_time"),
+        "moma_cpu_time": receipt.get("moma_cpu_time"),
+    }
+
+
+def bench_run(args):
+    projects = _load_suite(Path(args.suite))
+    results: Dict[str, Any] = {
+        "created": time.time(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "projects": {},
+    }
+    for project in projects:
+        repeat = args.repeat or project["repeat"]
+        samples: Dict[str, List[float]] = {metric: [] for metric in BENCH_METRICS}
+        for i in range(repeat):
+            logger.info(f"Running {project['name']} ({i + 1}/{repeat})")
+            for metric, value in _run_reference(project, args.cache).items():
+                if value is not None:
+                    samples[metric].append(value)
+        results["projects"][project["name"]] = {
+            "build_type": project["build_type"],
+            "processors": project["processors"],
+            "replay": project["replay"] is not None,
+            "samples": {metric: values for metric, values in samples.items() if values},
+        }
+
+    Path(args.output).write_text(json.dumps(results, indent=4))
+    logger.info(f"Saved the benchmark results to {args.output}")
+
+
+def _betainc(a: float, b: float, x: float) -> float:
+    # regularized incomplete beta function by its continued fraction (modified Lentz)
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    if x > (a + 1) / (a + b + 2):
+        return 1.0 - _betainc(b, a, 1.0 - x)
+    front = math.exp(
+        math.lgamma(a + b)
+        - math.lgamma(a)
+        - math.lgamma(b)
+        + a * math.log(x)
+        + b * math.log(1.0 - x)
+    )
+    tiny = 1e-300
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    result = d
+    for m in range(1, 300):
+        for numerator in (
+            m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+            -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1)),
+        ):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            result *= c * d
+        if abs(c * d - 1.0) < 1e-12:
+            break
+    return front * result / a
+
+
+def welch_t_test(a: List[float], b: List[float]) -> float:
+    """Two sided p-value of Welch's t-test for different means of the samples"""
+    if len(a) < 2 or len(b) < 2:
+        return math.nan
+    error_a = statistics.variance(a) / len(a)
+    error_b = statistics.variance(b) / len(b)
+    difference = statistics.mean(b) - statistics.mean(a)
+    if error_a + error_b == 0:
+        return 1.0 if difference == 0 else 0.0
+    t = difference / math.sqrt(error_a + error_b)
+    dof = (error_a + error_b) ** 2 / (
+        error_a**2 / (len(a) - 1) + error_b**2 / (len(b) - 1)
+    )
+    return _betainc(dof / 2, 0.5, dof / (dof + t * t))
+
+
+def bench_compare(args):
+    baseline = json.loads(Path(args.baseline).read_text())["projects"]
+    current = json.loads(Path(args.current).read_text())["projects"]
+
+    rows = []
+    regressions = 0
+    for name, project in current.items():
+        if name not in baseline:
+            logger.warning(f"{name} is not in the baseline")
+            continue
+        for metric, samples in project["samples"].items():
+            reference = baseline[name]["samples"].get(metric)
+            if not reference:
+                continue
+            before, after = statistics.mean(reference), statistics.mean(samples)
+            change = (after - before) / before if before else math.nan
+            p_value = welch_t_test(reference, samples)
+            # a change counts when it is both significant and large enough to matter
+            significant = p_value < args.alpha and abs(change) > args.threshold
+            if significant and change > 0:
+                status = "REGRESSION"
+                regressions += 1
+            elif significant:
+                status = "improvement"
+            else:
+                status = ""
+            rows.append((name, metric, before, after, change, p_value, status))
+
+    logger.info(
+        f"Benchmark comparison (alpha = {args.alpha}, threshold = {args.threshold:.0%}):\n"
+        + "\n".join(
+            f"  {name:20} {metric:15} {before:10.4g} -> {after:10.4g} "
+            + f"{change:+8.1%}  p={p_value:6.3f}  {status}"
+            for name, metric, before, after, change, p_value, status in rows
+        )
+    )
+    if regressions:
+        logger.error(f"{regressions} significant regressions")
+        raise SystemExit(1)
@@ -0,0 +1,89 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+from pathlib import Path
+
+from moma.util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1 << 20
+FICLONE = 0x40049409  # ioctl of Linux to share the extents of a file (reflink)
+
+
+def hash_file(path: Path) -> str:
+    """sha256 of the file contents, read in chunks into a reused buffer"""
+    digest = hashlib.sha256()
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with path.open("rb", buffering=0) as f:
+        while size := f.readinto(buffer):
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def _reflink(source: Path, destination: Path):
+    with source.open("rb") as src, destination.open("wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _clone(source: Path, destination: Path):
+    # a reflink is instant on btrfs/xfs, everywhere else the data is copied
+    try:
+        _reflink(source, destination)
+    except OSError:
+        destination.unlink(missing_ok=True)
+        shutil.copyfile(source, destination)
+    shutil.copystat(source, destination)
+
+
+class BlobStore:
+    """
+    Content addressed store of result files. Every distinct file content is kept once as
+    <directory>/<hash[:2]>/<hash[2:]> and the run directories link to these blobs.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / digest[2:]
+
+    def add(self, source: Path, digest: str) -> bool:
+        """Add the file to the store. Returns False if the content was already stored"""
+        blob = self.path(digest)
+        if blob.exists():
+            return False
+        blob.parent.mkdir(exist_ok=True)
+        with atomic_write(blob) as tmp_file:
+            _clone(source, tmp_file)
+            # blobs are shared by several runs and must never be modified in place
+            tmp_file.chmod(0o444)
+        return True
+
+    def link(self, digest: str, destination: Path):
+        """Hardlink the blob to the destination, reflink or copy it across filesystems"""
+        blob = self.path(digest)
+        destination.unlink(missing_ok=True)
+        try:
+            os.link(blob, destination)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            logger.debug(f"Cannot hardlink {blob} ({e.strerror}), cloning it instead")
+            _clone(blob, destination)
+
+    def prune(self) -> int:
+        """Remove blobs that are not linked from any run directory anymore"""
+        removed = 0
+        for blob in self.directory.glob("*/*"):
+            if blob.name.startswith("."):
+                continue
+            if blob.stat().st_nlink == 1:
+                blob.unlink()
+                removed += 1
+        return removed
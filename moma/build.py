@@ -0,0 +1,154 @@
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from moma.build_cache import BuildCache
+from moma.isolation import DEFAULT_PRIVATE, Scratch
+from moma.run import create_shared_object
+from moma.util import get_moris_config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BuildTarget:
+    project_dir: Path
+    config: Dict[str, Any]
+    build_type: str
+    status: str = "pending"
+    elapsed: Optional[float] = None
+    cached: Optional[bool] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.config['project']}.{self.build_type}"
+
+    @property
+    def cpp_file(self) -> Path:
+        return self.project_dir / f"{self.config['project']}.cpp"
+
+    @property
+    def output(self) -> Path:
+        # next to the .so of 'moma run', so both build types can exist side by side
+        return self.project_dir / f"{self.name}.so"
+
+    @property
+    def log_file(self) -> Path:
+        return self.project_dir / f"{self.name}.build.log"
+
+
+def get_build_types(args) -> List[str]:
+    build_types = [bt for bt in ("dbg", "opt") if getattr(args, bt)]
+    return build_types or ["dbg"]
+
+
+def _build_target(
+    target: BuildTarget, scratch: Scratch, cache: Optional[BuildCache]
+) -> BuildTarget:
+    """
+    Build one target in its own overlay of the moris tree.
+
+    moris compiles the project under its own name, so every build works on a copy of the
+    .cpp in a private staging directory and the shared object is moved into the project.
+    """
+    staging = scratch.directory / target.build_type
+    cpp_file = staging / target.cpp_file.name
+
+    def log_stderr(line: str):
+        logger.error(f"[{target.project_dir.name}:{target.build_type}] {line}")
+
+    logger.info(f"Building {target.name} in {target.project_dir}")
+    target.status = "running"
+    start = time.perf_counter()
+    try:
+        staging.mkdir()
+        shutil.copyfile(target.cpp_file, cpp_file)
+        with target.log_file.open("wb") as log:
+            target.cached = create_shared_object(
+                target.build_type,
+                cpp_file,
+                log,
+                cache,
+                scratch,
+                target.config.get("isolation_private", DEFAULT_PRIVATE),
+                stderr_func=log_stderr,
+            )
+        os.replace(cpp_file.with_suffix(".so"), target.output)
+        target.status = "completed"
+    except SystemExit:
+        # the error is already logged, the other builds go on
+        target.status = "failed"
+    except Exception:
+        # an unexpected error fails this target only, the report is still written
+        logger.exception(f"Building {target.name} failed")
+        target.status = "failed"
+    finally:
+        target.elapsed = time.perf_counter() - start
+        shutil.rmtree(staging, ignore_errors=True)
+    return target
+
+
+def write_report(targets: List[BuildTarget]):
+    from rich.console import Console
+    from rich.table import Table
+
+    table = Table(title="Build summary")
+    for column in ("project", "build type", "status", "cached", "time [s]", "output"):
+        table.add_column(column)
+    for target in targets:
+        table.add_row(
+            str(target.project_dir),
+            target.build_type,
+            target.status,
+            "" if target.cached is None else str(target.cached).lower(),
+            "" if target.elapsed is None else f"{target.elapsed:.1f}",
+            str(target.output if target.status == "completed" else target.log_file),
+        )
+    Console().print(table)
+
+
+def build_projects(args):
+    """Build the shared objects of several projects and build types concurrently"""
+    build_types = get_build_types(args)
+    project_dirs = list(dict.fromkeys(Path(d).absolute() for d in args.projects or ["."]))
+    targets = []
+    scratches: Dict[Path, Scratch] = {}
+    for project_dir in project_dirs:
+        config = get_moris_config(project_dir)
+        targets.extend(BuildTarget(project_dir, config, bt) for bt in build_types)
+        scratch_directory = config.get("scratch_directory")
+        base = Path(scratch_directory) / project_dir.name if scratch_directory else None
+        scratches[project_dir] = Scratch(project_dir, base)
+
+    missing = [t.cpp_file for t in targets if not t.cpp_file.exists()]
+    if missing:
+        logger.error("Source files not found:\n" + "\n".join(f"  - {p}" for p in missing))
+        raise SystemExit(1)
+
+    jobs = args.jobs or os.cpu_count() or 1
+    logger.info(f"Building {len(targets)} shared objects with {jobs} concurrent jobs")
+    try:
+        # the builds wait for the compiler in child processes, threads are enough
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = []
+            for target in targets:
+                config = target.config
+                cache = None if args.no_cache else BuildCache.from_config(config)
+                scratch = scratches[target.project_dir]
+                futures.append(pool.submit(_build_target, target, scratch, cache))
+            for future in futures:
+                future.result()
+    finally:
+        for scratch in scratches.values():
+            scratch.remove()
+
+    write_report(targets)
+    failed = [target for target in targets if target.status != "completed"]
+    if failed:
+        logger.error(f"{len(failed)} of {len(targets)} builds failed")
+        raise SystemExit(1)
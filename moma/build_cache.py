@@ -0,0 +1,189 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Union
+from moma.util import atomic_write, get_moris_config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 5 * 1024**3
+SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size: Union[int, str]) -> int:
+    # accept plain byte counts or sizes like "500M" and "2G"
+    if isinstance(size, int):
+        return size
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def get_default_cache_dir() -> Path:
+    if "MOMA_CACHE_DIR" in os.environ:
+        return Path(os.environ["MOMA_CACHE_DIR"])
+    cache_home = os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")
+    return Path(cache_home) / "moma" / "shared_objects"
+
+
+def _file_fingerprint(path: Path) -> str:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return "missing"
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class BuildCache:
+    """
+    Content addressed cache for the shared objects created from the project files.
+
+    The key is the hash of the C++ file together with the build type, the build directory
+    and fingerprints of the moris library and the build script. The cache directory is
+    shared between all projects, so identical sources are only compiled once.
+    """
+
+    def __init__(self, directory: Path, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.objects = directory / "objects"
+        self.index_file = directory / "index.json"
+        self.objects.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "BuildCache":
+        cache_config = config.get("build_cache", {})
+        directory = Path(cache_config.get("directory", get_default_cache_dir()))
+        max_size = parse_size(cache_config.get("max_size", DEFAULT_MAX_SIZE))
+        return cls(directory.expanduser(), max_size)
+
+    def key(
+        self,
+        cpp_file: Path,
+        build_type: str,
+        build_dir: str,
+        moris_library: Path,
+        build_script: Path,
+    ) -> str:
+        digest = hashlib.sha256(cpp_file.read_bytes())
+        digest.update(build_type.encode())
+        digest.update(build_dir.encode())
+        digest.update(_file_fingerprint(moris_library).encode())
+        digest.update(_file_fingerprint(build_script).encode())
+        return digest.hexdigest()
+
+    @contextmanager
+    def _locked(self, lock_file: Path) -> Iterator[None]:
+        with lock_file.open("a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        """Serialize builds of the same key so concurrent identical builds compile once"""
+        with self._locked(self.objects / f"{key}.lock"):
+            yield
+
+    @contextmanager
+    def _index(self) -> Iterator[Dict[str, Any]]:
+        with self._locked(self.directory / "index.lock"):
+            try:
+                index = json.loads(self.index_file.read_text())
+            except (FileNotFoundError, json.JSONDecodeError):
+                index = {"hits": 0, "misses": 0, "entries": {}}
+            yield index
+            with atomic_write(self.index_file) as tmp_file:
+                tmp_file.write_text(json.dumps(index))
+
+    def restore(self, key: str, destination: Path) -> bool:
+        """Copy the cached shared object to the destination. Returns False on a miss"""
+        cached = self.objects / f"{key}.so"
+        with self._index() as index:
+            entry = index["entries"].get(key)
+            if entry is None or not cached.exists():
+                index["entries"].pop(key, None)
+                index["misses"] += 1
+                return False
+            entry["last_used"] = time.time()
+            index["hits"] += 1
+            # under the index lock, a concurrent store cannot evict the object meanwhile
+            with atomic_write(destination) as tmp_file:
+                shutil.copy2(cached, tmp_file)
+        return True
+
+    def store(self, key: str, shared_object: Path):
+        cached = self.objects / f"{key}.so"
+        with atomic_write(cached) as tmp_file:
+            shutil.copy2(shared_object, tmp_file)
+        with self._index() as index:
+            index["entries"][key] = {
+                "size": cached.stat().st_size,
+                "last_used": time.time(),
+                "source": shared_object.stem,
+            }
+            self._evict(index, keep=key)
+
+    def _evict(self, index: Dict[str, Any], keep: Optional[str] = None):
+        # remove the least recently used entries until the cache fits into max_size
+        entries = index["entries"]
+        total = sum(entry["size"] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total -= entries.pop(key)["size"]
+            (self.objects / f"{key}.so").unlink(missing_ok=True)
+            logger.debug(f"Evicted {key} from the build cache")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._index() as index:
+            entries = index["entries"]
+            return {
+                "directory": str(self.directory),
+                "entries": len(entries),
+                "size": sum(entry["size"] for entry in entries.values()),
+                "max_size": self.max_size,
+                "hits": index["hits"],
+                "misses": index["misses"],
+            }
+
+    def clear(self):
+        with self._index() as index:
+            for key in index["entries"]:
+                (self.objects / f"{key}.so").unlink(missing_ok=True)
+            # the build locks of all keys, a build that holds one keeps its open file
+            for lock_file in self.objects.glob("*.lock"):
+                lock_file.unlink(missing_ok=True)
+            index.update({"hits": 0, "misses": 0, "entries": {}})
+
+
+def cache_command(args):
+    config = get_moris_config() if Path("moris.json").exists() else {}
+    cache = BuildCache.from_config(config)
+    if args.clear:
+        cache.clear()
+        logger.info(f"Cleared the build cache at {cache.directory}")
+        return
+
+    stats = cache.stats()
+    requests = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / requests if requests else 0.0
+    logger.info(
+        f"Build cache at {stats['directory']}:\n"
+        + f"  entries : {stats['entries']}\n"
+        + f"  size    : {stats['size'] / 1024**2:.1f} MiB of {stats['max_size'] / 1024**2:.0f} MiB\n"
+        + f"  hits    : {stats['hits']}\n"
+        + f"  misses  : {stats['misses']}\n"
+        + f"  hit rate: {hit_rate:.1%}"
+    )
@@ -0,0 +1,252 @@
+import json
+import logging
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from moma.log_filter import read_walltime
+from moma.metrics import load_metrics
+from moma.util import format_cell, get_moris_config, get_result_directory
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILE = "catalog.sqlite"
+RUN_COLUMNS = [
+    "identifier",
+    "project",
+    "stored_at",
+    "build_type",
+    "processors",
+    "walltime",
+    "iterations",
+    "final_residual",
+    "parameters",
+]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    identifier TEXT PRIMARY KEY,
+    project TEXT,
+    stored_at REAL,
+    build_type TEXT,
+    processors INTEGER,
+    walltime REAL,
+    iterations INTEGER,
+    final_residual REAL,
+    parameters TEXT
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    identifier TEXT REFERENCES runs(identifier) ON DELETE CASCADE,
+    name TEXT,
+    value,
+    PRIMARY KEY (identifier, name)
+);
+CREATE INDEX IF NOT EXISTS parameters_name_value ON parameters (name, value);
+CREATE INDEX IF NOT EXISTS runs_walltime ON runs (walltime);
+CREATE INDEX IF NOT EXISTS runs_iterations ON runs (iterations);
+CREATE INDEX IF NOT EXISTS runs_final_residual ON runs (final_residual);
+CREATE INDEX IF NOT EXISTS runs_build_type ON runs (build_type, processors);
+"""
+FILTER_REGEX = re.compile(r"^\s*(\w+)\s*(<=|>=|!=|=|<|>)\s*(.+?)\s*$")
+
+
+def collect_run_info(run_dir: Path) -> Dict[str, Any]:
+    """Everything the catalog records about a stored run, read from its directory"""
+    try:
+        config = json.loads((run_dir / "moris.json").read_text())
+    except FileNotFoundError:
+        config = {}
+    try:
+        receipt = json.loads((run_dir / "moma_run.json").read_text())
+    except FileNotFoundError:
+        receipt = {}
+
+    info = {
+        "identifier": run_dir.name,
+        "project": config.get("project"),
+        "stored_at": run_dir.stat().st_mtime,
+        "build_type": receipt.get("build_type"),
+        "processors": receipt.get("processors"),
+        "walltime": receipt.get("walltime"),
+        "iterations": receipt.get("iterations"),
+        "final_residual": receipt.get("final_residual"),
+        "parameters": config.get("parameters", {}),
+    }
+    # runs stored before the receipt existed: parse the log and the metrics instead
+    if info["walltime"] is None and info["project"]:
+        info["walltime"] = read_walltime(run_dir / f"{info['project']}.log")
+    if info["iterations"] is None:
+        try:
+            metrics = load_metrics(run_dir)
+            info["iterations"] = len(metrics["Iteration"])
+            if info["iterations"]:
+                info["final_residual"] = float(metrics["ResidualNorm"][-1])
+        except FileNotFoundError:
+            pass
+    return info
+
+
+class Catalog:
+    """SQLite catalog of all stored runs in a result directory"""
+
+    def __init__(self, result_directory: Path):
+        self.path = result_directory / CATALOG_FILE
+        self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def insert(self, infos: List[Dict[str, Any]]):
+        with self.connection:
+            for info in infos:
+                row = {**info, "parameters": json.dumps(info["parameters"])}
+                self.connection.execute(
+                    "DELETE FROM runs WHERE identifier = ?", (info["identifier"],)
+                )
+                self.connection.execute(
+                    f"INSERT INTO runs ({', '.join(RUN_COLUMNS)}) "
+                    + f"VALUES ({', '.join(':' + column for column in RUN_COLUMNS)})",
+                    row,
+                )
+                self.connection.executemany(
+                    "INSERT INTO parameters (identifier, name, value) VALUES (?, ?, ?)",
+                    [
+                        (info["identifier"], name, _sql_value(value))
+                        for name, value in info["parameters"].items()
+                    ],
+                )
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM runs")
+
+    def query(
+        self,
+        filters: List[str],
+        sort: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        conditions = []
+        values: List[Any] = []
+        for text in filters:
+            name, operator, value = _parse_filter(text)
+            if name in RUN_COLUMNS:
+                conditions.append(f"runs.{name} {operator} ?")
+            else:
+                conditions.append(
+                    "EXISTS (SELECT 1 FROM parameters p WHERE p.identifier = runs.identifier "
+                    + f"AND p.name = ? AND p.value {operator} ?)"
+                )
+                values.append(name)
+            values.append(value)
+
+        sql = f"SELECT {', '.join(RUN_COLUMNS)} FROM runs"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if sort:
+            order = "DESC" if descending else "ASC"
+            if sort in RUN_COLUMNS:
+                sql += f" ORDER BY runs.{sort} IS NULL, runs.{sort} {order}"
+            else:
+                sql += (
+                    " ORDER BY (SELECT p.value FROM parameters p WHERE "
+                    + f"p.identifier = runs.identifier AND p.name = ?) {order}"
+                )
+                values.append(sort)
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+
+        rows = []
+        for row in self.connection.execute(sql, values):
+            info = dict(zip(RUN_COLUMNS, row))
+            info["parameters"] = json.loads(info["parameters"] or "{}")
+            rows.append(info)
+        return rows
+
+
+def _sql_value(value: Any) -> Any:
+    # numbers and strings are compared natively, everything else as json
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    return json.dumps(value)
+
+
+def _parse_filter(text: str) -> Tuple[str, str, Any]:
+    match = FILTER_REGEX.match(text)
+    if match is None:
+        logger.error(
+            f"Cannot parse the filter '{text}'. Use e.g. 'tNumElementsX=40' or 'walltime<100'"
+        )
+        raise SystemExit(1)
+    name, operator, value = match.groups()
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass  # plain strings do not need quotes
+    return name, operator, _sql_value(value)
+
+
+def catalog_run(config: Dict[str, Any], run_dir: Path):
+    catalog = Catalog(get_result_directory(config))
+    try:
+        catalog.insert([collect_run_info(run_dir)])
+    finally:
+        catalog.close()
+
+
+def query_catalog(args):
+    config = get_moris_config()
+    catalog = Catalog(get_result_directory(config))
+    try:
+        rows = catalog.query(args.filters, args.sort, args.descending, args.limit)
+    finally:
+        catalog.close()
+
+    if args.json:
+        print(json.dumps(rows, indent=4))
+        return
+
+    from rich.console import Console
+    from rich.table import Table
+
+    table = Table(title=f"{len(rows)} runs")
+    columns = [c for c in RUN_COLUMNS if c not in ("project", "stored_at", "parameters")]
+    for column in columns + ["parameters"]:
+        table.add_column(column)
+    for row in rows:
+        parameters = " ".join(f"{k}={v}" for k, v in row["parameters"].items())
+        table.add_row(*(format_cell(row[column]) for column in columns), parameters)
+    Console().print(table)
+
+
+def reindex_catalog(args):
+    config = get_moris_config()
+    result_directory = get_result_directory(config)
+    if not result_directory.is_dir():
+        logger.error(f"Result directory {result_directory} not found")
+        raise SystemExit(1)
+
+    # hidden directories hold moma internals like the blob store
+    run_dirs = [
+        path
+        for path in sorted(result_directory.iterdir())
+        if path.is_dir() and not path.name.startswith(".")
+    ]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        infos = list(pool.map(collect_run_info, run_dirs, chunksize=8))
+
+    catalog = Catalog(result_directory)
+    try:
+        catalog.clear()
+        catalog.insert(infos)
+    finally:
+        catalog.close()
+    logger.info(
+        f"Indexed {len(infos)} runs in {time.perf_counter() - start:.1f}s into {catalog.path}"
+    )
@@ -0,0 +1,349 @@
+import bisect
+import io
+import json
+import logging
+import lzma
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Callable, Dict, List, NamedTuple, Optional, Tuple, TypeVar
+
+from moma.util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4 * 1024**2
+INDEX_SUFFIX = ".idx"
+
+
+class Codec(NamedTuple):
+    suffix: str
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+def _zstd_codec() -> Optional[Codec]:
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    # compressor instances are not thread-safe, every worker thread gets its own
+    local = threading.local()
+
+    def compress(data: bytes) -> bytes:
+        if not hasattr(local, "compressor"):
+            local.compressor = zstandard.ZstdCompressor(level=3)
+        return local.compressor.compress(data)
+
+    return Codec(
+        ".zst",
+        compress,
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+# every chunk is an independent gzip member / xz stream / zstd frame, so the concatenation
+# of all chunks is still a valid file for gunzip, xz and zstd
+CODECS: Dict[str, Codec] = {
+    "gzip": Codec(
+        ".gz",
+        lambda data: zlib.compress(data, 6, wbits=31),
+        lambda data: zlib.decompress(data, wbits=31),
+    ),
+    "lzma": Codec(
+        ".xz",
+        lambda data: lzma.compress(data, format=lzma.FORMAT_XZ, preset=3),
+        lambda data: lzma.decompress(data, format=lzma.FORMAT_XZ),
+    ),
+}
+if (zstd := _zstd_codec()) is not None:
+    CODECS["zstd"] = zstd
+
+DEFAULT_CODEC = "zstd" if "zstd" in CODECS else "gzip"
+
+
+def get_index_file(compressed: Path) -> Path:
+    return compressed.with_name(compressed.name + INDEX_SUFFIX)
+
+
+def find_compressed(path: Path) -> Optional[Path]:
+    """Returns the compressed variant of the path if one exists"""
+    for codec in CODECS.values():
+        compressed = path.with_name(path.name + codec.suffix)
+        if compressed.exists() and get_index_file(compressed).exists():
+            return compressed
+    return None
+
+
+def resolve(path: Path) -> Path:
+    """The file that holds the contents of path: the path itself or its compressed variant"""
+    if path.exists():
+        return path
+    compressed = find_compressed(path)
+    if compressed is None:
+        raise FileNotFoundError(path)
+    return compressed
+
+
+def exists(path: Path) -> bool:
+    return path.exists() or find_compressed(path) is not None
+
+
+def compress_file(
+    source: Path,
+    codec_name: str = DEFAULT_CODEC,
+    workers: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> Path:
+    """
+    Compress the file into independently compressed chunks next to it and write an index
+    with the offsets of all chunks. The chunks are compressed in parallel threads (the
+    compressors release the GIL), at most two chunks per worker are held in memory.
+    """
+    codec = CODECS[codec_name]
+    destination = source.with_name(source.name + codec.suffix)
+    workers = workers or os.cpu_count() or 1
+    chunks: List[Tuple[int, int]] = []
+    compressed_offset = 0
+    uncompressed_offset = 0
+
+    def write(future):
+        nonlocal compressed_offset, uncompressed_offset
+        data, size = future.result()
+        chunks.append((compressed_offset, uncompressed_offset))
+        out.write(data)
+        compressed_offset += len(data)
+        uncompressed_offset += size
+
+    with atomic_write(destination) as tmp_file:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        with source.open("rb") as f, tmp_file.open("wb") as out, pool:
+            in_flight = []
+            while chunk := f.read(chunk_size):
+                in_flight.append(pool.submit(lambda c: (codec.compress(c), len(c)), chunk))
+                if len(in_flight) >= 2 * workers:
+                    write(in_flight.pop(0))
+            for future in in_flight:
+                write(future)
+        # the index of the chunks exists before the file that it describes
+        write_index(destination, codec_name, chunks, uncompressed_offset)
+    return destination
+
+
+def write_index(
+    compressed: Path,
+    codec_name: str,
+    chunks: List[Tuple[int, int]],
+    size: int,
+    compressed_size: Optional[int] = None,
+):
+    index = {"codec": codec_name, "size": size, "chunks": chunks}
+    if compressed_size is not None:
+        # bytes behind it belong to a chunk that is still being written
+        index["compressed_size"] = compressed_size
+    with atomic_write(get_index_file(compressed)) as tmp_file:
+        tmp_file.write_text(json.dumps(index))
+
+
+_Writer = TypeVar("_Writer", bound="ChunkedWriter")
+
+
+class ChunkedWriter:
+    """
+    Write a file as independently compressed chunks while it is being produced, e.g. the
+    log of a running moris.
+
+    The chunks are compressed in background threads and appended in order. Once chunks
+    were appended, the index is rewritten on writes and flushes, at most every
+    INDEX_INTERVAL seconds. So the file can be read with open_binary while it grows, up to
+    the last indexed chunk. Data that was flushed is cut into a chunk after `max_delay`
+    seconds at the latest.
+    """
+
+    INDEX_INTERVAL = 1.0  # seconds
+
+    def __init__(
+        self,
+        path: Path,
+        codec_name: str = DEFAULT_CODEC,
+        workers: int = 1,
+        chunk_size: int = CHUNK_SIZE,
+        max_delay: float = 10.0,
+    ):
+        self.codec_name = codec_name
+        self.codec = CODECS[codec_name]
+        self.path = path.with_name(path.name + self.codec.suffix)
+        self.name = str(self.path)
+        self.chunk_size = chunk_size
+        self.max_delay = max_delay
+        self.workers = workers
+        self.file = self.path.open("wb")
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight: List = []
+        self.buffer: List[bytes] = []
+        self.buffered = 0
+        self.buffer_started = 0.0
+        self.chunks: List[Tuple[int, int]] = []
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+        self.last_index = 0.0
+        self.unindexed = False
+        self.closed = False
+        self._write_index()
+
+    def write(self, data: bytes) -> int:
+        if not data:
+            return 0
+        if not self.buffer:
+            self.buffer_started = time.monotonic()
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self._cut()
+        self._collect(block=len(self.in_flight) >= 2 * self.workers)
+        return len(data)
+
+    def flush(self):
+        if self.buffer and time.monotonic() - self.buffer_started >= self.max_delay:
+            self._cut()
+        self._collect(block=False)
+
+    def _cut(self):
+        data = b"".join(self.buffer)
+        self.buffer.clear()
+        self.buffered = 0
+        for start in range(0, len(data), self.chunk_size):
+            chunk = data[start : start + self.chunk_size]
+            self.in_flight.append(
+                self.pool.submit(lambda c: (self.codec.compress(c), len(c)), chunk)
+            )
+
+    def _collect(self, block: bool):
+        # append the compressed chunks in order, waiting only for the oldest if asked to
+        while self.in_flight and (block or self.in_flight[0].done()):
+            data, size = self.in_flight.pop(0).result()
+            self.chunks.append((self.compressed_offset, self.uncompressed_offset))
+            self.file.write(data)
+            self.compressed_offset += len(data)
+            self.uncompressed_offset += size
+            self.unindexed = True
+            block = False
+        # chunks appended shortly after the last index are indexed by a later flush, even
+        # if moris stays quiet
+        if self.unindexed and time.monotonic() - self.last_index >= self.INDEX_INTERVAL:
+            self._write_index()
+
+    def _write_index(self):
+        # the chunks must be on disk before the index points to them
+        self.file.flush()
+        write_index(
+            self.path,
+            self.codec_name,
+            self.chunks,
+            self.uncompressed_offset,
+            self.compressed_offset,
+        )
+        self.last_index = time.monotonic()
+        self.unindexed = False
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buffer:
+            self._cut()
+        while self.in_flight:
+            self._collect(block=True)
+        self.pool.shutdown()
+        self._write_index()
+        self.file.close()
+        self.closed = True
+
+    def __enter__(self: _Writer) -> _Writer:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ChunkedReader(io.RawIOBase):
+    """
+    Seekable reader for files written by compress_file. Only the chunk that contains the
+    current position is decompressed, so seeking to any offset is cheap.
+    """
+
+    def __init__(self, path: Path):
+        index = json.loads(get_index_file(path).read_text())
+        self.codec = CODECS[index["codec"]]
+        self.size: int = index["size"]
+        self.compressed_size: Optional[int] = index.get("compressed_size")
+        self.compressed_offsets = [chunk[0] for chunk in index["chunks"]]
+        self.offsets = [chunk[1] for chunk in index["chunks"]]
+        self.file = path.open("rb")
+        self.position = 0
+        self.chunk = -1
+        self.data = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def _load(self, chunk: int):
+        start = self.compressed_offsets[chunk]
+        if chunk + 1 < len(self.compressed_offsets):
+            end = self.compressed_offsets[chunk + 1]
+        elif self.compressed_size is not None:
+            end = self.compressed_size
+        else:
+            end = os.fstat(self.file.fileno()).st_size
+        self.file.seek(start)
+        self.data = self.codec.decompress(self.file.read(end - start))
+        self.chunk = chunk
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size:
+            return 0
+        chunk = bisect.bisect_right(self.offsets, self.position) - 1
+        if chunk != self.chunk:
+            self._load(chunk)
+        start = self.position - self.offsets[chunk]
+        size = min(len(buffer), len(self.data) - start)
+        buffer[:size] = self.data[start : start + size]
+        self.position += size
+        return size
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def open_binary(path: Path, buffering: int = 1 << 20) -> IO[bytes]:
+    """Open the path for reading, transparently decompressing a compressed variant"""
+    if path.exists():
+        return path.open("rb", buffering=buffering)
+    compressed = find_compressed(path)
+    if compressed is None:
+        raise FileNotFoundError(path)
+    return io.BufferedReader(ChunkedReader(compressed), buffer_size=buffering)
+
+
+def uncompressed_size(path: Path) -> int:
+    if path.exists():
+        return path.stat().st_size
+    compressed = resolve(path)
+    return json.loads(get_index_file(compressed).read_text())["size"]
@@ -1,9 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import json
+import os
 from pathlib import Path
 import logging
-from moma.util import get_moris_config, get_moris_root
+import re
+from typing import Any, Dict, List, Optional, Tuple
+from moma.util import get_moris_config, get_moris_root, get_result_directory
 
 logger = logging.getLogger(__name__)
 
+# used for projects whose moris.json has no "clean" list
+DEFAULT_CLEAN_PATTERNS = [
+    "{project}.exo",
+    "{project}.log",
+    "{project}.log.*",
+    "{project}.so",
+    "{project}.*.so",
+    "{project}.*.build.log",
+    "xtk_temp.exo",
+    "Parameter_Receipt.xml",
+    "debug_mesh_*.json",
+    "mapping_result_*.json",
+    "surface_meshes_*.json",
+    "newton_iterations.csv",
+    "newton_iterations.npz",
+    "moma_run.json",
+    "moma_profile.json",
+    "residuals.png",
+]
+# the blob store and the catalog of moma store mark a result directory
+RESULT_DIRECTORY_MARKERS = (".blobs", "catalog.sqlite")
+
+
 def remove_lock():
     root = get_moris_root()
     lock_path = root / "projects" / "mains" / "input_file.locked"
@@ -14,31 +43,139 @@ def remove_lock():
         logger.info("No lock file to remove")
 
 
-def clean_dir(args):
+def compile_clean_patterns(config: Dict[str, Any]) -> Optional[re.Pattern]:
+    """One regex for all file name patterns of the "clean" list in the config"""
+    patterns = config.get("clean")
+    if patterns is None:
+        patterns = [p.format(project=config["project"]) for p in DEFAULT_CLEAN_PATTERNS]
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in patterns))
+
+
+def _is_result_directory(directory: Path) -> bool:
+    return any((directory / marker).exists() for marker in RESULT_DIRECTORY_MARKERS)
+
+
+def _check_not_stored(directory: Path):
+    absolute = directory.absolute()
+    if any(_is_result_directory(d) for d in [absolute, *absolute.parents]):
+        logger.error(f"{directory} is a result directory or a stored run, which is never cleaned")
+        raise SystemExit(1)
+
+
+def _clean_entries(
+    entries: List[os.DirEntry], regex: Optional[re.Pattern], dry_run: bool
+) -> Tuple[int, int]:
+    # remove the matching files of one directory, returns the files and bytes reclaimed
+    num_files = 0
+    num_bytes = 0
+    if regex is None:
+        return num_files, num_bytes
+    for entry in entries:
+        if not regex.match(entry.name) or entry.is_dir(follow_symlinks=False):
+            continue
+        stat = entry.stat(follow_symlinks=False)
+        # files that are still linked elsewhere (e.g. the blob store) free no space
+        if stat.st_nlink == 1:
+            num_bytes += stat.st_size
+        logger.debug(f"Removing file: {entry.path}")
+        if not dry_run:
+            os.unlink(entry.path)
+        num_files += 1
+    return num_files, num_bytes
+
+
+def _format_bytes(num_bytes: int) -> str:
+    return f"{num_bytes / 1024**2:.1f} MiB"
+
+
+def clean_dir(args, dry_run: bool = False):
     config = get_moris_config()
-    project_name = config["project"]
-    
-    clean_patterns = [
-        f"{project_name}.exo",
-        f"{project_name}.log",
-        f"{project_name}.so",
-        "xtk_temp.exo",
-        "Parameter_Receipt.xml",
-        "debug_mesh_*.json",
-        "mapping_result_*.json",
-        "surface_meshes_*.json",
-        "newton_iterations.csv",
-        "residuals.png",
-    ]
-    
-    num_files_removed = 0
-    for pattern in clean_patterns:
-        logger.debug(f"Looking for files with pattern: {pattern}")
-        for file in Path.cwd().glob(pattern):
-            file.unlink()
-            logger.debug(f"Removing file: {file}")
-            num_files_removed += 1
+    _check_not_stored(Path.cwd())
+    # a single scan of the directory, every name is matched against all patterns at once
+    with os.scandir(Path.cwd()) as it:
+        entries = list(it)
+    num_files_removed, num_bytes = _clean_entries(
+        entries, compile_clean_patterns(config), dry_run
+    )
     if num_files_removed == 0:
         logger.info("No files to remove")
     else:
-        logger.info(f"Removed {num_files_removed} files from the current directory")
\ No newline at end of file
+        action = "Would remove" if dry_run else "Removed"
+        logger.info(
+            f"{action} {num_files_removed} files ({_format_bytes(num_bytes)}) from the current directory"
+        )
+
+
+def _clean_tree_directory(
+    directory: str, dry_run: bool
+) -> Tuple[List[str], int, int, Optional[str]]:
+    """
+    Scan one directory of the tree once: clean it if it is a project directory and return
+    the subdirectories that still have to be visited and the result directory of the
+    project.
+    """
+    with os.scandir(directory) as it:
+        entries = list(it)
+    if any(entry.name in RESULT_DIRECTORY_MARKERS for entry in entries):
+        # every subdirectory is a stored run
+        return [], 0, 0, None
+    subdirectories = {
+        entry.name: entry.path
+        for entry in entries
+        if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".")
+    }
+    if not any(entry.name == "moris.json" for entry in entries):
+        return list(subdirectories.values()), 0, 0, None
+
+    try:
+        with open(os.path.join(directory, "moris.json")) as f:
+            config = json.load(f)
+        regex = compile_clean_patterns(config)
+    except (json.JSONDecodeError, KeyError) as e:
+        logger.warning(f"Skipping {directory}: invalid moris.json ({e})")
+        return list(subdirectories.values()), 0, 0, None
+
+    num_files, num_bytes = _clean_entries(entries, regex, dry_run)
+    # stored runs have a moris.json as well, but they must never be cleaned. Result
+    # directories without a marker (yet) are known from the config of their project
+    results = os.path.abspath(os.path.join(directory, get_result_directory(config)))
+    return list(subdirectories.values()), num_files, num_bytes, results
+
+
+def clean_tree(args):
+    """Clean all project directories (e.g. sweep cases) below a directory in parallel"""
+    root = Path(args.directory or ".")
+    if not root.is_dir():
+        logger.error(f"Directory {root} not found")
+        raise SystemExit(1)
+    _check_not_stored(root)
+
+    num_projects = 0
+    num_files = 0
+    num_bytes = 0
+    num_directories = 0
+    excluded = set()
+    # the directories of one level are scanned concurrently, the scans mostly wait for
+    # the (network) filesystem and release the GIL
+    level = [str(root)]
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while level:
+            next_level = []
+            results = pool.map(lambda d: _clean_tree_directory(d, args.dry_run), level)
+            for subdirectories, files, size, result_directory in results:
+                next_level.extend(subdirectories)
+                if result_directory is not None:
+                    num_projects += 1
+                    excluded.add(result_directory)
+                num_files += files
+                num_bytes += size
+            num_directories += len(level)
+            level = [d for d in next_level if os.path.abspath(d) not in excluded]
+
+    action = "Would remove" if args.dry_run else "Removed"
+    logger.info(
+        f"{action} {num_files} files ({_format_bytes(num_bytes)}) from {num_projects} "
+        + f"project directories ({num_directories} directories scanned)"
+    )
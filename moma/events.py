@@ -0,0 +1,133 @@
+import errno
+import json
+import logging
+import os
+import socket
+import stat
+import time
+from typing import Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+EVENT_VERSION = 1
+FLUSH_INTERVAL = 0.5  # seconds
+FLUSH_SIZE = 1 << 16  # bytes
+RETRY_INTERVAL = 0.05  # seconds between writes to a reader that is behind
+MAX_PENDING = 16 << 20  # bytes kept for a slow reader before events are dropped
+# high-volume events are batched, all others are sent right away
+BATCHED_EVENTS = ("section_enter", "section_exit")
+# json.dumps with options builds a new encoder on every call
+ENCODER = json.JSONEncoder(separators=(",", ":"), default=str)
+
+
+class EventStream:
+    """
+    JSON lines stream of the events of a run (iterations, sections, stderr, ...).
+
+    The target is a file, a FIFO or `unix:<path>` for a listening unix stream socket.
+    Every line is an object with the event name in "event" and the unix time in "time".
+    FIFOs and sockets are written without blocking: moris must never wait for a slow or
+    vanished reader, so events are held back and, beyond MAX_PENDING bytes, dropped.
+    """
+
+    def __init__(self, target: str):
+        self.target = target
+        self._socket: Optional[socket.socket] = None
+        self._pending: List[bytes] = []
+        self._pending_size = 0
+        self._last_flush = time.monotonic()
+        self._retry_at = 0.0
+        self.dropped = 0
+        self.fd: Optional[int] = self._open(target)
+        self.emit("stream_start", version=EVENT_VERSION, pid=os.getpid())
+
+    def _open(self, target: str) -> Optional[int]:
+        try:
+            if target.startswith("unix:"):
+                self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._socket.connect(target[len("unix:") :])
+                self._socket.setblocking(False)
+                return self._socket.fileno()
+            if os.path.exists(target) and stat.S_ISFIFO(os.stat(target).st_mode):
+                # fails with ENXIO if nobody reads the FIFO yet
+                return os.open(target, os.O_WRONLY | os.O_NONBLOCK)
+            return os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        except OSError as e:
+            logger.warning(f"Cannot open the event stream {target} ({e}), no events are sent")
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+            return None
+
+    def emit(self, event: str, **fields: Any):
+        if self.fd is None:
+            return
+        record = {"event": event, "time": time.time(), **fields}
+        data = (ENCODER.encode(record) + "\n").encode()
+        if self._pending_size + len(data) > MAX_PENDING:
+            self.dropped += 1
+            return
+        self._pending.append(data)
+        self._pending_size += len(data)
+        now = time.monotonic()
+        if now < self._retry_at:
+            # the reader is behind, do not copy the backlog on every event
+            return
+        if (
+            event not in BATCHED_EVENTS
+            or self._pending_size >= FLUSH_SIZE
+            or now - self._last_flush >= FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def poll(self):
+        """Send batched events that waited longer than FLUSH_INTERVAL"""
+        now = time.monotonic()
+        if self._pending and now >= self._retry_at and now - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.fd is None or not self._pending:
+            return
+        data = b"".join(self._pending)
+        try:
+            written = os.write(self.fd, data)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            logger.warning(f"The reader of the event stream {self.target} is gone")
+            self._close_fd()
+            return
+        # keep the unwritten rest for the next flush
+        rest = data[written:]
+        self._pending = [rest] if rest else []
+        self._pending_size = len(rest)
+        self._last_flush = time.monotonic()
+        if rest:
+            self._retry_at = self._last_flush + RETRY_INTERVAL
+
+    def _close_fd(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        elif self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.emit("stream_end", dropped=self.dropped)
+        # a slow reader gets a last chance to catch up
+        deadline = time.monotonic() + 1.0
+        while self._pending and self.fd is not None and time.monotonic() < deadline:
+            self.flush()
+            if self._pending:
+                time.sleep(0.01)
+        if self._pending:
+            logger.warning(f"{self._pending_size} bytes of events were not delivered")
+        if self.dropped:
+            logger.warning(f"{self.dropped} events were dropped for the slow event reader")
+        self._close_fd()
@@ -0,0 +1,377 @@
+import logging
+import warnings
+import zipfile
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from moma import chunked
+from moma.util import get_cpp_file, get_moris_config, get_run_directory
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# netCDF classic and 64-bit offset, the formats scipy can read
+SUPPORTED_MAGIC = (b"CDF\x01", b"CDF\x02")
+HDF5_MAGIC = b"\x89HDF"
+CSV_BATCH_ROWS = 1 << 16
+
+Steps = Union[slice, List[int]]
+
+
+def _decode_names(variable) -> List[str]:
+    # fixed length char arrays padded with null bytes
+    return [row.tobytes().rstrip(b"\x00").decode().strip() for row in variable[:]]
+
+
+_Exodus = TypeVar("_Exodus", bound="ExodusFile")
+
+
+class ExodusFile:
+    """
+    Read only access to an Exodus II file in netCDF classic format.
+
+    The file is memory mapped, so the fields are numpy views of the mapped pages and only
+    the steps that are actually read are loaded from disk. Views must not be used after
+    the file is closed, copy what has to outlive it.
+    """
+
+    def __init__(self, path: Path):
+        with path.open("rb") as f:
+            magic = f.read(4)
+        if magic == HDF5_MAGIC:
+            logger.error(
+                f"{path} is a netCDF-4 (HDF5) file, which cannot be memory mapped. "
+                + f"Convert it with 'nccopy -k 64-bit-offset {path} <output>'"
+            )
+            raise SystemExit(1)
+        if magic not in SUPPORTED_MAGIC:
+            logger.error(f"{path} is not an Exodus file in netCDF classic format")
+            raise SystemExit(1)
+        try:
+            from scipy.io import netcdf_file
+        except ImportError:
+            logger.error("Reading Exodus files requires scipy, install it with pip")
+            raise SystemExit(1)
+
+        self.path = path
+        self.file = netcdf_file(path, "r", mmap=True, maskandscale=False)
+        self.variables = self.file.variables
+        self.dimensions = self.file.dimensions
+
+    def __enter__(self: _Exodus) -> _Exodus:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # scipy does not unmap (and warns) while views exist, they stay valid until
+        # they are collected
+        self.variables = {}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            self.file.close()
+
+    def _names(self, variable: str) -> List[str]:
+        if variable not in self.variables:
+            return []
+        return _decode_names(self.variables[variable])
+
+    @property
+    def times(self) -> "np.ndarray":
+        if "time_whole" not in self.variables:
+            import numpy as np
+
+            return np.zeros(0)
+        return self.variables["time_whole"].data
+
+    @property
+    def num_nodes(self) -> int:
+        return self.dimensions.get("num_nodes") or 0
+
+    @property
+    def nodal_variables(self) -> List[str]:
+        return self._names("name_nod_var")
+
+    @property
+    def element_variables(self) -> List[str]:
+        return self._names("name_elem_var")
+
+    @property
+    def global_variables(self) -> List[str]:
+        return self._names("name_glo_var")
+
+    @property
+    def blocks(self) -> List[Tuple[int, str]]:
+        """Id and name of every element block"""
+        if "eb_prop1" not in self.variables:
+            return []
+        ids = [int(i) for i in self.variables["eb_prop1"].data]
+        names = self._names("eb_names") or [""] * len(ids)
+        return list(zip(ids, names))
+
+    def coordinates(self) -> Dict[str, "np.ndarray"]:
+        if "coord" in self.variables:
+            coord = self.variables["coord"].data
+            return {axis: coord[i] for i, axis in enumerate("xyz"[: coord.shape[0]])}
+        return {
+            axis: self.variables[f"coord{axis}"].data
+            for axis in "xyz"
+            if f"coord{axis}" in self.variables
+        }
+
+    def nodal(self, name: str) -> "np.ndarray":
+        """View of a nodal variable with the shape (time steps, nodes)"""
+        index = self.nodal_variables.index(name)
+        if f"vals_nod_var{index + 1}" in self.variables:
+            return self.variables[f"vals_nod_var{index + 1}"].data
+        # files written by older versions store all nodal variables in one array
+        return self.variables["vals_nod_var"].data[:, index, :]
+
+    def num_elements(self, block: int) -> int:
+        position = [block_id for block_id, _ in self.blocks].index(block)
+        return self.dimensions.get(f"num_el_in_blk{position + 1}") or 0
+
+    def element(self, name: str, block: int) -> Optional["np.ndarray"]:
+        """View of an element variable in a block (time steps, elements), None if undefined"""
+        index = self.element_variables.index(name)
+        position = [block_id for block_id, _ in self.blocks].index(block)
+        variable = self.variables.get(f"vals_elem_var{index + 1}eb{position + 1}")
+        return None if variable is None else variable.data
+
+    def global_values(self) -> Optional["np.ndarray"]:
+        """Global variables with the shape (time steps, variables)"""
+        variable = self.variables.get("vals_glo_var")
+        return None if variable is None else variable.data
+
+
+def parse_steps(spec: Optional[str], num_steps: int) -> Steps:
+    """
+    Time steps from indices and python slices like "0,5,-1" or "10:" (default: all).
+    A single slice keeps the selection a view of the mapped file.
+    """
+    if not spec:
+        return slice(None)
+    parts = [part.strip() for part in spec.split(",") if part.strip()]
+    try:
+        if len(parts) == 1 and ":" in parts[0]:
+            return slice(*(int(v) if v else None for v in parts[0].split(":")))
+        steps: List[int] = []
+        for part in parts:
+            if ":" in part:
+                bounds = slice(*(int(v) if v else None for v in part.split(":")))
+                steps.extend(range(num_steps)[bounds])
+            else:
+                steps.append(range(num_steps)[int(part)])
+    except (ValueError, TypeError, IndexError):
+        logger.error(f"Invalid time steps '{spec}' for a file with {num_steps} steps")
+        raise SystemExit(1)
+    return steps
+
+
+def _select_fields(
+    exo: ExodusFile, fields: Optional[List[str]]
+) -> Tuple[List[str], List[str]]:
+    nodal = exo.nodal_variables
+    element = exo.element_variables
+    if not fields:
+        return nodal, element
+    unknown = [f for f in fields if f not in nodal and f not in element]
+    if unknown:
+        logger.error(
+            f"Unknown fields {', '.join(unknown)} in {exo.path}. "
+            + f"Nodal: {', '.join(nodal) or '-'}, element: {', '.join(element) or '-'}"
+        )
+        raise SystemExit(1)
+    return [f for f in fields if f in nodal], [f for f in fields if f in element]
+
+
+def _select_blocks(exo: ExodusFile, blocks: Optional[List[str]]) -> List[Tuple[int, str]]:
+    if not blocks:
+        return exo.blocks
+    selected = []
+    for block in blocks:
+        matches = [b for b in exo.blocks if block in (str(b[0]), b[1])]
+        if not matches:
+            logger.error(f"No element block '{block}' in {exo.path}")
+            raise SystemExit(1)
+        selected.extend(m for m in matches if m not in selected)
+    return selected
+
+
+def _write_npz(output: Path, arrays: List[Tuple[str, Any]]):
+    import numpy as np
+
+    # like np.savez, but one array at a time: arrays can be given as functions that make
+    # the selection, so at most one copied field is held in memory
+    with zipfile.ZipFile(output, "w") as zf:
+        for name, array in arrays:
+            if callable(array):
+                array = array()
+            with zf.open(f"{name}.npy", "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+
+def _nodal_rows(
+    exo: ExodusFile,
+    names: List[str],
+    coordinates: Dict[str, "np.ndarray"],
+    steps: "np.ndarray",
+) -> Iterator["np.ndarray"]:
+    import numpy as np
+
+    # one step at a time, so only a single step of the fields is read from the file
+    fields = [exo.nodal(name) for name in names]
+    nodes = np.arange(exo.num_nodes)
+    for step in steps:
+        yield np.column_stack(
+            [
+                np.full(len(nodes), step),
+                np.full(len(nodes), exo.times[step]),
+                nodes,
+                *coordinates.values(),
+                *(field[step] for field in fields),
+            ]
+        )
+
+
+def _element_rows(
+    exo: ExodusFile, names: List[str], blocks: List[Tuple[int, str]], steps: "np.ndarray"
+) -> Iterator["np.ndarray"]:
+    import numpy as np
+
+    for block_id, _ in blocks:
+        fields = [exo.element(name, block_id) for name in names]
+        num_elements = exo.num_elements(block_id)
+        elements = np.arange(num_elements)
+        for step in steps:
+            yield np.column_stack(
+                [
+                    np.full(num_elements, step),
+                    np.full(num_elements, exo.times[step]),
+                    np.full(num_elements, block_id),
+                    elements,
+                    # variables that are not defined on the block are empty
+                    *(
+                        np.full(num_elements, np.nan) if f is None else f[step]
+                        for f in fields
+                    ),
+                ]
+            )
+
+
+def _write_csv(output: Path, columns: List[str], rows: Iterable["np.ndarray"]):
+    # one format operation per batch of rows is about twice as fast as np.savetxt
+    row_format = ",".join(["%.10g"] * len(columns)) + "\n"
+    with output.open("w") as f:
+        f.write(",".join(columns) + "\n")
+        for block in rows:
+            for start in range(0, len(block), CSV_BATCH_ROWS):
+                batch = block[start : start + CSV_BATCH_ROWS]
+                f.write((row_format * len(batch)) % tuple(batch.ravel().tolist()))
+
+
+def _list_contents(exo: ExodusFile):
+    from rich.console import Console
+    from rich.table import Table
+
+    times = exo.times
+    table = Table(title=f"{exo.path}")
+    table.add_column("Kind")
+    table.add_column("Names")
+    steps = f"{len(times)}"
+    if len(times):
+        steps += f" ({times[0]:g} to {times[-1]:g})"
+    table.add_row("Time steps", steps)
+    table.add_row("Nodes", str(exo.num_nodes))
+    table.add_row("Blocks", ", ".join(f"{i} {n}".strip() for i, n in exo.blocks) or "-")
+    table.add_row("Nodal variables", ", ".join(exo.nodal_variables) or "-")
+    table.add_row("Element variables", ", ".join(exo.element_variables) or "-")
+    table.add_row("Global variables", ", ".join(exo.global_variables) or "-")
+    Console().print(table)
+
+
+def export_exodus(args):
+    import numpy as np
+
+    # an explicit file can be exported outside of a project
+    config = get_moris_config() if args.run or not args.file else None
+    exo_file = Path(args.file) if args.file else get_cpp_file(config).with_suffix(".exo")
+    if args.run:
+        exo_file = get_run_directory(config, args.run) / exo_file.name
+    if not exo_file.exists():
+        if chunked.exists(exo_file):
+            logger.error(
+                f"{exo_file} is stored compressed, decompress it to read it memory mapped"
+            )
+        else:
+            logger.error(f"Exodus file {exo_file} not found")
+        raise SystemExit(1)
+
+    with ExodusFile(exo_file) as exo:
+        if args.list:
+            _list_contents(exo)
+            return
+
+        times = exo.times
+        steps = parse_steps(args.steps, len(times))
+        step_numbers = np.arange(len(times))[steps]
+        nodal, element = _select_fields(exo, args.field)
+        blocks = _select_blocks(exo, args.block) if element else []
+        name = config["project"] if config else exo_file.stem
+        output = Path(args.output or f"{name}_fields.{args.format}")
+
+        if args.format == "npz":
+            arrays = [("step", step_numbers), ("time", times[steps])]
+            if args.coordinates:
+                arrays.extend(exo.coordinates().items())
+            # the selections are made while writing, one field after the other
+            arrays.extend((name, lambda n=name: exo.nodal(n)[steps]) for name in nodal)
+            for name in element:
+                for block_id, _ in blocks:
+                    values = exo.element(name, block_id)
+                    if values is not None:
+                        arrays.append((f"{name}@{block_id}", lambda v=values: v[steps]))
+            _write_npz(output, arrays)
+            logger.info(
+                f"Saved {len(arrays)} arrays for {len(step_numbers)} steps to {output}"
+            )
+            return
+
+        # csv: one row per step and node (and per step and element), one column per field
+        written = []
+        if nodal:
+            nodal_output = output
+            if element:
+                nodal_output = output.with_name(f"{output.stem}_nodal{output.suffix}")
+            coordinates = exo.coordinates() if args.coordinates else {}
+            _write_csv(
+                nodal_output,
+                ["step", "time", "node", *coordinates, *nodal],
+                _nodal_rows(exo, nodal, coordinates, step_numbers),
+            )
+            written.append(nodal_output)
+        if element:
+            element_output = output
+            if nodal:
+                element_output = output.with_name(f"{output.stem}_element{output.suffix}")
+            _write_csv(
+                element_output,
+                ["step", "time", "block", "element", *element],
+                _element_rows(exo, element, blocks, step_numbers),
+            )
+            written.append(element_output)
+        logger.info(f"Saved {len(step_numbers)} steps to {', '.join(map(str, written))}")
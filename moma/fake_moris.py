@@ -0,0 +1,62 @@
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+from moma import chunked
+
+# Stand-in for moris (and mpirun) that replays a recorded log, so the moma side of a run can
+# be benchmarked without a moris installation:
+#
+#   MOMA_MPIRUN="" MOMA_MORIS="python -m moma.fake_moris --log beam.log" moma run --run-only
+
+BATCH_SIZE = 1000  # lines between two checks of the rate
+
+
+def replay(log_file: Path, rate: float, out=None):
+    """Write the lines of the log to out at (at most) rate lines per second"""
+    out = out or sys.stdout.buffer
+    start = time.perf_counter()
+    with chunked.open_binary(log_file) as f:
+        for count, line in enumerate(f, 1):
+            out.write(line)
+            if rate and count % BATCH_SIZE == 0:
+                out.flush()
+                ahead = count / rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+    out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m moma.fake_moris",
+        description="Replay a recorded moris log on stdout",
+    )
+    parser.add_argument(
+        "--log",
+        type=Path,
+        default=os.environ.get("MOMA_REPLAY_LOG"),
+        help="Recorded log to replay (default: $MOMA_REPLAY_LOG)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Lines per second, 0 replays as fast as possible",
+    )
+    parser.add_argument("-np", type=int, help="Ignored, accepted like mpirun")
+    parser.add_argument("arguments", nargs="*", help="Ignored, e.g. the shared object")
+    args = parser.parse_args()
+    if args.log is None:
+        parser.error("no log to replay, use --log or set MOMA_REPLAY_LOG")
+    try:
+        replay(args.log, args.rate)
+    except FileNotFoundError:
+        print(f"Recorded log {args.log} not found", file=sys.stderr)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
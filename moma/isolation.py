@@ -0,0 +1,179 @@
+import fcntl
+import itertools
+import json
+import logging
+import os
+import shutil
+import socket
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILE = Path("projects") / "mains" / "input_file.locked"
+GUARD_FILE = Path("projects") / "mains" / ".moma_build.lock"
+SCRATCH_DIRECTORY = ".moma_scratch"
+DEFAULT_PRIVATE = ["projects/mains"]
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, but belongs to someone else
+    return True
+
+
+def _owner_crashed(owner: Dict[str, Any]) -> bool:
+    # only processes on this host can be checked
+    return owner.get("host") == socket.gethostname() and not _process_alive(
+        owner.get("pid", -1)
+    )
+
+
+@contextmanager
+def moris_build_lock(moris_root: Path) -> Iterator[None]:
+    """
+    Serialize the builds of moma processes in the shared moris tree and remove a lock
+    file that a crashed moma build left behind.
+
+    Every build holds an flock on a guard file next to the lock of moris and records its
+    pid and host in it. Who gets the guard knows that no other moma build is running, so an
+    existing lock file is stale if it was created during the recorded build and that
+    process is gone. Lock files of builds outside moma are never removed.
+    """
+    guard = moris_root / GUARD_FILE
+    lock_file = moris_root / LOCK_FILE
+    with guard.open("a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                owner = json.loads(f.read() or "{}")
+            except json.JSONDecodeError:
+                owner = {}
+            if lock_file.exists():
+                created = lock_file.stat().st_mtime
+                if created >= owner.get("started", float("inf")) and _owner_crashed(owner):
+                    logger.warning(
+                        f"Removing the lock file {lock_file} of the crashed build of process {owner['pid']}"
+                    )
+                    lock_file.unlink(missing_ok=True)
+
+            f.seek(0)
+            f.truncate()
+            json.dump(
+                {"pid": os.getpid(), "host": socket.gethostname(), "started": time.time()},
+                f,
+            )
+            f.flush()
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _mirror(source: Path, destination: Path, exclude: List[str]):
+    # directory of symlinks to the entries of source, except the excluded names
+    destination.mkdir(parents=True, exist_ok=True)
+    for entry in os.scandir(source):
+        if entry.name in exclude:
+            continue
+        os.symlink(entry.path, destination / entry.name)
+
+
+def create_overlay(moris_root: Path, overlay: Path, private: List[str]):
+    """
+    Create a symlink farm of the moris tree in which the private directories are real
+    directories. Builds in the overlay create their input file and lock there instead of
+    in the shared tree. Everything else, e.g. the libraries, stays shared.
+    """
+    private_paths = [Path(path) for path in private]
+    # every directory on the way to a private directory needs its own copy as well
+    directories = {Path(".")}
+    for path in private_paths:
+        directories.update(path.parents)
+        directories.add(path)
+    for directory in sorted(directories, key=lambda p: len(p.parts)):
+        children = [p.name for p in directories if p.parent == directory and p != directory]
+        exclude = list(children)
+        if directory in private_paths:
+            # moris' own input file, its build products and the lock stay private
+            exclude += [
+                entry.name
+                for entry in os.scandir(moris_root / directory)
+                if entry.name.startswith("input_file")
+            ]
+        _mirror(moris_root / directory, overlay / directory, exclude)
+
+
+def _move(source: Path, destination: Path):
+    # directories are merged file by file like the outputs of a run in the project itself,
+    # files of earlier runs that were not written again stay
+    if source.is_dir() and not source.is_symlink() and destination.is_dir():
+        for entry in os.scandir(source):
+            _move(Path(entry.path), destination / entry.name)
+        source.rmdir()
+        return
+    if destination.is_dir() and not destination.is_symlink():
+        shutil.rmtree(destination)
+    os.replace(source, destination)
+
+
+class Scratch:
+    """
+    Private staging area of one moma process below SCRATCH_DIRECTORY of the project.
+
+    The scratch lives on the file system of the project, so outputs are moved back with
+    atomic renames. Scratch directories of crashed processes are removed on creation.
+    """
+
+    def __init__(self, project_dir: Path, base: Optional[Path] = None):
+        self.project_dir = project_dir
+        self.base = base or project_dir / SCRATCH_DIRECTORY
+        self.base.mkdir(parents=True, exist_ok=True)
+        self._remove_stale()
+        self.directory = self.base / f"{socket.gethostname()}-{os.getpid()}"
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory.mkdir()
+        self._counter = itertools.count()
+
+    def _remove_stale(self):
+        host = socket.gethostname()
+        for entry in os.scandir(self.base):
+            name, _, pid = entry.name.rpartition("-")
+            if name == host and pid.isdigit() and not _process_alive(int(pid)):
+                logger.info(f"Removing the scratch directory {entry.path} of a crashed run")
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def overlay(self, moris_root: Path, private: List[str]) -> Path:
+        # concurrent builds of one process each get their own overlay
+        overlay = self.directory / f"morisroot_{next(self._counter)}"
+        create_overlay(moris_root, overlay, private)
+        return overlay
+
+    def stage(self, inputs: List[Path]) -> Path:
+        """Private working directory with links to the inputs"""
+        staging = self.directory / "run"
+        staging.mkdir()
+        for path in inputs:
+            os.symlink(path.absolute(), staging / path.name)
+        return staging
+
+    def collect(self, staging: Path) -> List[Path]:
+        """Move everything the run created back into the project directory"""
+        moved = []
+        for entry in os.scandir(staging):
+            if entry.is_symlink():
+                continue
+            destination = self.project_dir / entry.name
+            _move(Path(entry.path), destination)
+            moved.append(destination)
+        return moved
+
+    def remove(self):
+        # symlinks are removed, not followed
+        shutil.rmtree(self.directory, ignore_errors=True)
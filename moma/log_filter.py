@@ -1,13 +1,103 @@
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import re
 import logging
 from pathlib import Path
+from moma import chunked
+from moma.events import EventStream
+from moma.metrics import MetricsBuffer
+from moma.section_profile import SectionProfile
 
 logger = logging.getLogger(__name__)
 
+WALLTIME_PREFIX = "Global Clock Stopped. ElapsedTime = "
+
+
+def read_walltime(log_file: Path) -> Optional[float]:
+    """Read the walltime reported at the end of a moris log (None if it is not available)"""
+    try:
+        with chunked.open_binary(log_file) as f:
+            # the walltime is one of the last lines, so look at the tail before scanning it all
+            size = f.seek(0, 2)
+            f.seek(max(0, size - 65536))
+            lines = f.read().decode("utf8", errors="replace").splitlines()
+            if not any(line.strip().startswith(WALLTIME_PREFIX) for line in lines):
+                f.seek(0)
+                lines = (line.decode("utf8", errors="replace") for line in f)
+            for line in lines:
+                line = line.strip()
+                if line.startswith(WALLTIME_PREFIX):
+                    try:
+                        return float(line[len(WALLTIME_PREFIX):].split()[0])
+                    except (ValueError, IndexError):
+                        return None
+    except FileNotFoundError:
+        pass
+    return None
+
+
+NUMBER_REGEX = r"[+\-]?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+\-]?\d+)?"
+
+# property, keywords that start a match and the pattern anchored at such a keyword
+NEWTON_PATTERNS = [
+    (
+        "Iteration",
+        ("Newton - Iteration: ",),
+        re.compile(r"Newton - Iteration: (\d+)"),
+    ),
+    (
+        "LoadFactor",
+        ("LoadFactor: ",),
+        re.compile(r"LoadFactor: (" + NUMBER_REGEX + ")"),
+    ),
+    (
+        "ResidualNorm",
+        ("ResidualNorm: ", "ReferenceNorm: "),
+        re.compile(r"(?:ResidualNorm|ReferenceNorm): (" + NUMBER_REGEX + ")"),
+    ),
+    (
+        "SolutionNorm",
+        ("SolutionNorm: ",),
+        re.compile(r"SolutionNorm: (" + NUMBER_REGEX + ")"),
+    ),
+    (
+        "RelResidualDrop",
+        ("RelResidualDrop: ",),
+        re.compile(r"RelResidualDrop: (" + NUMBER_REGEX + ")"),
+    ),
+    (
+        "Relaxation",
+        ("Relaxation",),
+        re.compile(r"Relaxation(?:\s.*)?: (" + NUMBER_REGEX + ")"),
+    ),
+    (
+        "Time",
+        ("Newton - IterationTime: ",),
+        re.compile(r"Newton - IterationTime: (" + NUMBER_REGEX + ")"),
+    ),
+]
+
+SECTION_REGEX = re.compile(r"(?:\|  )*\|__(.*)\s-\s(.*)\s-\s(.*)")
+
+
+def _match_last(line: str, keywords: Tuple[str, ...], pattern: re.Pattern):
+    """
+    Match the pattern at the last keyword occurrence where it matches. This is what a
+    greedy ".*" prefix does, without scanning the line character by character.
+    """
+    starts = [line.rfind(keyword) for keyword in keywords]
+    while True:
+        start = max(starts)
+        if start < 0:
+            return None
+        if match := pattern.match(line, start):
+            return match
+        starts = [
+            line.rfind(keyword, 0, start + len(keyword) - 1) for keyword in keywords
+        ]
+
 
 class NewtonIteration:
-    def __init__(self):
+    def __init__(self, record: bool = True):
         self.properties = {
             "Iteration": None,
             "ResidualNorm": None,
@@ -18,39 +108,36 @@ class NewtonIteration:
             "Time": None,
         }
 
-        number_regex = r"[+\-]?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+\-]?\d+)?"
-        self.patterns = {
-            "Iteration": re.compile(r".*Newton - Iteration: (\d+).*"),
-            "LoadFactor": re.compile(r".*LoadFactor: (" + number_regex + ").*"),
-            "ResidualNorm": re.compile(
-                r".*(?:ResidualNorm|ReferenceNorm): (" + number_regex + ").*"
-            ),
-            "SolutionNorm": re.compile(r".*SolutionNorm: (" + number_regex + ").*"),
-            "RelResidualDrop": re.compile(
-                r".*RelResidualDrop: (" + number_regex + ").*"
-            ),
-            "Relaxation": re.compile(
-                r".*Relaxation(?:\s.*)?: (" + number_regex + ").*"
-            ),
-            "Time": re.compile(r".*Newton - IterationTime: (" + number_regex + ").*"),
-        }
-        
-        self.csv_path = Path("./newton_iterations.csv")
-        self.csv_header = ",".join(self.properties.keys()) 
-        if self.csv_path.exists():
-            self.csv_path.unlink() # remove old file
-        Path(self.csv_path).write_text(self.csv_header + "\n")
-
-    def parse_line(self, line: str):
-        for key, pattern in self.patterns.items():
-            if match := pattern.match(line):
+        # only the run records the metrics, a watcher of the same log must not touch them
+        self.metrics = MetricsBuffer(list(self.properties.keys())) if record else None
+
+    def parse_line(self, line: str) -> bool:
+        # skip the vast majority of lines before looking at the single properties
+        if ": " not in line or not (
+            "Iteration" in line
+            or "Norm" in line
+            or "LoadFactor" in line
+            or "RelResidualDrop" in line
+            or "Relaxation" in line
+        ):
+            return False
+        matched = False
+        for key, keywords, pattern in NEWTON_PATTERNS:
+            for keyword in keywords:
+                if keyword in line:
+                    break
+            else:
+                continue
+            if match := _match_last(line, keywords, pattern):
                 if key == "Iteration":
                     self._reset()
                     self.properties[key] = int(match.group(1))
                 else:
                     self.properties[key] = float(match.group(1))
+                matched = True
+        return matched
 
-    def log(self):
+    def log(self, events: Optional[EventStream] = None):
         text = f"Newton Iteration {self.properties['Iteration']}:"
         row = 0
         for key, value in self.properties.items():
@@ -60,9 +147,17 @@ class NewtonIteration:
                 text += f"  {key:16}: {value:.4e}  "
                 row += 1
         logger.info(text)
-        with open(self.csv_path, "a") as csv_file:
-            csv_file.write(",".join(str(value) for value in self.properties.values()) + "\n")
+        row = self.take()
+        if self.metrics is not None:
+            self.metrics.append(list(row.values()))
+        if events is not None:
+            events.emit("iteration", **row)
+
+    def take(self) -> Dict[str, Any]:
+        """Returns the properties of the completed iteration and starts the next one"""
+        properties = dict(self.properties)
         self._reset()
+        return properties
         
         
     def _reset(self):
@@ -77,45 +172,76 @@ class NewtonIteration:
 class MorisLogFilter:
     """Create a nice output of the moris log (less verbose!)"""
 
-    def __init__(self):
-        self.sections: List[Tuple[int, str, str, str]] = []
+    def __init__(self, events: Optional[EventStream] = None):
+        self.section: Optional[Tuple[int, str, str, str]] = None
+        self.profile = SectionProfile()
         self.newton_iteration = NewtonIteration()
+        self.walltime: Optional[float] = None
+        self.events = events
+
+    def close(self):
+        self.newton_iteration.metrics.close()
+        self._emit_section_exits(self.profile.finish())
+
+    def summary(self) -> Dict[str, Any]:
+        """Walltime, number of Newton iterations and the final residual of the run"""
+        metrics = self.newton_iteration.metrics
+        residuals = metrics.columns["ResidualNorm"]
+        return {
+            "walltime": self.walltime,
+            "iterations": len(metrics),
+            "final_residual": residuals[-1] if residuals else None,
+        }
 
     def log(self, line: str):
-        if self._parse_section(line):
+        # dispatch on cheap prefix and substring tests before running any regex
+        if line.startswith("|") and "|__" in line and self._parse_section(line):
             # self._log_section()
-            pass
-        else:
-            self.newton_iteration.parse_line(line)
-            if self.newton_iteration.is_complete():
-                self.newton_iteration.log()
+            return
+        if self.newton_iteration.parse_line(line) and self.newton_iteration.is_complete():
+            self.newton_iteration.log(self.events)
+        if line.startswith(WALLTIME_PREFIX):
             self._log_walltime(line)
+        if self.events is not None:
+            self.events.poll()
 
     def _log_section(self):
-        newest_section = self.sections[-1]
+        newest_section = self.section
         logger.info(
             f"{newest_section[0]}: {newest_section[1]} - {newest_section[2]} - {newest_section[3]}"
         )
         
     def _log_walltime(self, line: str) -> bool:
-        search_str = "Global Clock Stopped. ElapsedTime = "
-        if line.startswith(search_str):
-            walltime = line.lstrip(search_str)
+        if line.startswith(WALLTIME_PREFIX):
+            walltime = line[len(WALLTIME_PREFIX):]
             logger.info(f"Walltime: {walltime}")
+            try:
+                self.walltime = float(walltime.split()[0])
+            except (ValueError, IndexError):
+                pass
+            if self.events is not None:
+                self.events.emit("walltime", walltime=self.walltime)
             return True
         return False
     
     def _parse_section(self, line: str) -> bool:
-        regex = re.compile(r"(?:\|  )*\|__(.*)\s-\s(.*)\s-\s(.*)")
-        if match := regex.match(line):
+        if match := SECTION_REGEX.match(line):
+            # the level is the number of "|" in front of the "__"
             line = line.strip()
-            level = 0
-            while line and not line.startswith("__"):
-                if line.startswith("|"):
-                    level += 1
-                line = line[1:]
-
-            sec = (level, match.group(1), match.group(2), match.group(3))
-            self.sections.append(sec)
+            level = line.count("|", 0, line.find("__"))
+            sec = (level, match.group(1).strip(), match.group(2), match.group(3).strip())
+            self.section = sec
+            closed = self.profile.enter(level, f"{sec[1]} - {sec[2]} - {sec[3]}")
+            if self.events is not None:
+                self._emit_section_exits(closed)
+                self.events.emit(
+                    "section_enter", level=level, name=sec[1], type=sec[2], info=sec[3]
+                )
             return True
         return False
+
+    def _emit_section_exits(self, closed: List[Tuple[int, Tuple[str, ...], float]]):
+        if self.events is None:
+            return
+        for level, path, seconds in closed:
+            self.events.emit("section_exit", level=level, section=path[-1], seconds=seconds)
@@ -0,0 +1,142 @@
+import hashlib
+import heapq
+import json
+import logging
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterable, Iterator, List
+from moma import chunked
+from moma.util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 3
+FINGERPRINT_SIZE = 4096
+
+
+def get_index_file(log_file: Path) -> Path:
+    return log_file.with_name(log_file.name + ".idx")
+
+
+class LogIndex:
+    """
+    Sidecar index of a moris log with the byte offsets of its marker lines.
+
+    Only complete lines up to `indexed_bytes` are indexed, so later calls of `update` only
+    read the bytes that were appended since. The index is tied to the log by its inode and
+    a hash of its first bytes and is discarded when the log was replaced.
+    """
+
+    def __init__(self, log_file: Path):
+        self.log_file = log_file
+        self.index_file = get_index_file(log_file)
+        self.reset()
+
+    def reset(self, markers: Iterable[str] = ()):
+        self.inode = None
+        self.fingerprint = ""
+        self.fingerprint_size = 0
+        self.indexed_bytes = 0
+        self.markers: Dict[str, List[int]] = {marker: [] for marker in markers}
+
+    @classmethod
+    def load(cls, log_file: Path) -> "LogIndex":
+        index = cls(log_file)
+        try:
+            data = json.loads(index.index_file.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return index
+        if data.pop("version", None) != INDEX_VERSION:
+            return index
+
+        index.__dict__.update(data)
+        if not index.is_valid():
+            logger.debug(f"Discarding outdated index {index.index_file}")
+            index.reset()
+        return index
+
+    def save(self):
+        data = {
+            "version": INDEX_VERSION,
+            "inode": self.inode,
+            "fingerprint": self.fingerprint,
+            "fingerprint_size": self.fingerprint_size,
+            "indexed_bytes": self.indexed_bytes,
+            "markers": self.markers,
+        }
+        with atomic_write(self.index_file) as tmp_file:
+            tmp_file.write_text(json.dumps(data, separators=(",", ":")))
+
+    def _fingerprint(self, size: int) -> str:
+        with chunked.open_binary(self.log_file) as f:
+            return hashlib.sha1(f.read(size)).hexdigest()
+
+    def is_valid(self) -> bool:
+        # the log may be compressed, offsets and sizes always refer to the uncompressed log
+        try:
+            inode = chunked.resolve(self.log_file).stat().st_ino
+            size = chunked.uncompressed_size(self.log_file)
+        except FileNotFoundError:
+            return False
+        if inode != self.inode or size < self.indexed_bytes:
+            return False
+        return self._fingerprint(self.fingerprint_size) == self.fingerprint
+
+    def track(self, markers: Iterable[str]):
+        """Make sure the markers are indexed. New markers require indexing from the start"""
+        missing = [marker for marker in markers if marker not in self.markers]
+        if missing:
+            self.reset([*self.markers, *missing])
+
+    def update(
+        self,
+        f: IO[bytes],
+        marker_func: Callable[[str], None] | None = None,
+        follow: bool = False,
+    ):
+        """
+        Index the complete lines appended since the last update. `marker_func` is called
+        with every new marker line. An unterminated last line is never indexed, it may still
+        grow. In follow mode it is left for the next update, otherwise it is the last line
+        of a finished log and is passed to `marker_func` as well.
+        """
+        if self.inode is None:
+            self.inode = chunked.resolve(self.log_file).stat().st_ino
+        if self.fingerprint_size < FINGERPRINT_SIZE:
+            f.seek(0)
+            head = f.read(FINGERPRINT_SIZE)
+            self.fingerprint_size = len(head)
+            self.fingerprint = hashlib.sha1(head).hexdigest()
+
+        markers = list(self.markers)
+        prefixes = tuple(marker.encode() for marker in markers)
+        offset = self.indexed_bytes
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                stripped = raw.strip()
+                if not follow and marker_func is not None and stripped.startswith(prefixes):
+                    marker_func(stripped.decode("utf8", errors="replace"))
+                break
+            stripped = raw.strip()
+            if prefixes and stripped.startswith(prefixes):
+                line = stripped.decode("utf8", errors="replace")
+                # under every matching marker: a prefix marker alone must find the line too
+                for marker in markers:
+                    if line.startswith(marker):
+                        self.markers[marker].append(offset)
+                if marker_func is not None:
+                    marker_func(line)
+            offset += len(raw)
+        self.indexed_bytes = offset
+
+    def marker_lines(self, f: IO[bytes], markers: Iterable[str]) -> Iterator[str]:
+        """Read the indexed lines of the markers in the order of the log"""
+        offsets = heapq.merge(*(self.markers[marker] for marker in markers))
+        previous = None
+        for offset in offsets:
+            # a line of several of the markers is read once
+            if offset == previous:
+                continue
+            previous = offset
+            f.seek(offset)
+            yield f.readline().decode("utf8", errors="replace")
@@ -0,0 +1,105 @@
+import atexit
+import csv
+import logging
+import math
+import time
+from array import array
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from moma.util import atomic_write
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+METRICS_FILE = "newton_iterations.npz"
+CSV_FILE = "newton_iterations.csv"
+FLUSH_INTERVAL = 5.0  # seconds
+
+
+class MetricsBuffer:
+    """
+    Array backed buffer for the metrics of the Newton iterations.
+
+    Rows are appended to one typed array per column, so logging an iteration neither opens
+    a file nor formats text. The columns are written to an npz file every FLUSH_INTERVAL
+    seconds and when the buffer is closed (at the latest at exit).
+    """
+
+    def __init__(self, columns: List[str], path: Path = Path(METRICS_FILE)):
+        self.path = path
+        self.columns = {
+            name: array("q" if name == "Iteration" else "d") for name in columns
+        }
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        self.path.unlink(missing_ok=True)  # remove old file
+        atexit.register(self.close)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values())))
+
+    def append(self, row: List[Optional[float]]):
+        for values, value in zip(self.columns.values(), row):
+            if value is None:
+                value = -1 if values.typecode == "q" else math.nan
+            values.append(value)
+        self.dirty = True
+        if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        import numpy as np
+
+        with atomic_write(self.path) as tmp_file, tmp_file.open("wb") as f:
+            # the arrays are passed as views without copying
+            np.savez(
+                f,
+                **{
+                    name: np.frombuffer(values, dtype=values.typecode)
+                    for name, values in self.columns.items()
+                },
+            )
+        self.dirty = False
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.dirty:
+            self.flush()
+        atexit.unregister(self.close)
+
+
+def load_metrics(directory: Path = Path(".")) -> Dict[str, "np.ndarray"]:
+    """Load the Newton metrics of a run. Falls back to the csv written by older versions"""
+    import numpy as np
+
+    npz_file = directory / METRICS_FILE
+    if npz_file.exists():
+        with np.load(npz_file) as data:
+            return {name: data[name] for name in data.files}
+
+    with (directory / CSV_FILE).open("r") as f:
+        rows = list(csv.reader(f))
+    header, rows = rows[0], rows[1:]
+    return {
+        name: np.array(
+            [math.nan if row[i] in ("", "None") else float(row[i]) for row in rows]
+        )
+        for i, name in enumerate(header)
+    }
+
+
+def export_metrics_csv(args):
+    try:
+        metrics = load_metrics()
+    except FileNotFoundError:
+        logger.error(f"No {METRICS_FILE} file found")
+        raise SystemExit(1)
+
+    with Path(args.output).open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(metrics.keys())
+        writer.writerows(zip(*(values.tolist() for values in metrics.values())))
+    logger.info(f"Exported {len(metrics['Iteration'])} iterations to {args.output}")
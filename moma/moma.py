@@ -1,16 +1,13 @@
-from moma import clean
 from moma.args import parse_args
-from rich.logging import RichHandler
 import logging
-from moma.store import store_results
-from moma.clean import clean_dir, remove_lock
-from moma.run import run
-from moma.post import plot_residuals, extract_csv_from_log
-from moma.parameter import apply_parameters
-from moma.new import new_project
+
+# The command modules are imported in the branches of main(), so that every command only
+# pays for the dependencies it actually uses (pandas and matplotlib take most of a second).
 
 
 def configure_logging(verbose=False):
+    from rich.logging import RichHandler
+
     level = logging.DEBUG if verbose else logging.INFO
     logging.basicConfig(
         level=level,  # Adjust root logger level
@@ -25,21 +22,104 @@ def main():
     configure_logging(args.verbose)
 
     if args.command == "store":
+        from moma.store import store_results
+
         store_results(args)
+    elif args.command == "archive":
+        from moma.store import archive_results
+
+        archive_results(args)
+    elif args.command == "query":
+        from moma.catalog import query_catalog
+
+        query_catalog(args)
+    elif args.command == "reindex":
+        from moma.catalog import reindex_catalog
+
+        reindex_catalog(args)
     elif args.command == "run":
+        from moma.clean import clean_dir
+        from moma.parameter import apply_parameters
+        from moma.run import run
+
         if not args.no_clean and not args.run_only:
             clean_dir(args)
         if args.apply_parameters:
             apply_parameters(args)
-        run(args)
+        if args.scaling_study:
+            from moma.scaling import scaling_study
+
+            scaling_study(args)
+        else:
+            run(args)
+    elif args.command == "build":
+        from moma.build import build_projects
+
+        build_projects(args)
+    elif args.command == "sweep":
+        from moma.sweep import run_sweep
+
+        run_sweep(args)
+    elif args.command == "watch":
+        from moma.watch import watch_run
+
+        watch_run(args)
     elif args.command == "clean":
-        clean_dir(args)
+        from moma.clean import clean_dir, clean_tree, remove_lock
+
+        if args.recursive:
+            clean_tree(args)
+        else:
+            clean_dir(args, dry_run=args.dry_run)
         if args.remove_lock:
             remove_lock()
+    elif args.command == "cache":
+        from moma.build_cache import cache_command
+
+        cache_command(args)
+    elif args.command == "bench":
+        from moma.bench import (
+            bench_compare,
+            bench_coordinates,
+            bench_log_filter,
+            bench_run,
+            bench_startup,
+        )
+
+        if args.bench_command == "log-filter":
+            bench_log_filter(args)
+        elif args.bench_command == "startup":
+            bench_startup(args)
+        elif args.bench_command == "coordinates":
+            bench_coordinates(args)
+        elif args.bench_command == "run":
+            bench_run(args)
+        elif args.bench_command == "compare":
+            bench_compare(args)
     elif args.command == "new":
+        from moma.new import new_project
+
         new_project(args)
     elif args.command == "post":
+        from moma.post import plot_residuals, extract_csv_from_log
+
         if args.post_command == "residuals":
-            plot_residuals()
+            plot_residuals(args)
+        elif args.post_command == "compare":
+            from moma.post import compare_runs
+
+            compare_runs(args)
+        elif args.post_command == "profile":
+            from moma.section_profile import export_profile
+
+            export_profile(args)
         elif args.post_command == "extract":
             extract_csv_from_log(args)
+        elif args.post_command == "exo":
+            from moma.exodus import export_exodus
+
+            export_exodus(args)
+        elif args.post_command == "metrics":
+            from moma.metrics import export_metrics_csv
+
+            export_metrics_csv(args)
@@ -1,9 +1,165 @@
-from moma.util import get_moris_config, get_cpp_file
+from moma.util import atomic_write, get_moris_config, get_cpp_file
+from pathlib import Path
+from typing import Any, Dict, List
 import logging
 import re
 
 logger = logging.getLogger(__name__)
 
+PARAMETER_FILE = "moma_parameters.txt"
+BLOCK_BEGIN = "// ---- moma parameters (generated, do not edit) ---- //"
+BLOCK_END = "// ---- end of moma parameters ---- //"
+
+# moris compiles a copy of the .cpp in its own tree, so instead of a header next to the
+# project the reader is inserted into the .cpp. It does not depend on the values, so the
+# source (and the shared object) stays the same when only parameters change.
+PARAMETER_READER = r"""#include <cstdlib>
+#include <fstream>
+#include <map>
+#include <sstream>
+#include <stdexcept>
+#include <string>
+#include <type_traits>
+
+namespace moma
+{
+    inline std::string trim( const std::string& aText )
+    {
+        const auto tBegin = aText.find_first_not_of( " \t\r" );
+        const auto tEnd   = aText.find_last_not_of( " \t\r" );
+        return tBegin == std::string::npos ? "" : aText.substr( tBegin, tEnd - tBegin + 1 );
+    }
+
+    // values of the parameter file written by moma (MOMA_PARAMETERS or moma_parameters.txt)
+    inline const std::map< std::string, std::string >& parameters()
+    {
+        static const std::map< std::string, std::string > tValues = [] {
+            std::map< std::string, std::string > tValues;
+            const char*   tPath = std::getenv( "MOMA_PARAMETERS" );
+            std::ifstream tFile( tPath ? tPath : "moma_parameters.txt" );
+            std::string   tLine;
+            while ( std::getline( tFile, tLine ) )
+            {
+                const auto tSeparator = tLine.find( '=' );
+                if ( tLine.empty() || tLine[ 0 ] == '#' || tSeparator == std::string::npos ) continue;
+                tValues[ trim( tLine.substr( 0, tSeparator ) ) ] = trim( tLine.substr( tSeparator + 1 ) );
+            }
+            return tValues;
+        }();
+        return tValues;
+    }
+
+    template< typename T >
+    T parameter( const std::string& aName, const T& aDefault )
+    {
+        const auto tValue = parameters().find( aName );
+        if ( tValue == parameters().end() ) return aDefault;
+        if constexpr ( std::is_same_v< T, std::string > )
+        {
+            return tValue->second;
+        }
+        else
+        {
+            std::istringstream tStream( tValue->second );
+            T                  tResult;
+            if ( !( tStream >> tResult ) )
+            {
+                throw std::runtime_error( "moma: invalid value '" + tValue->second + "' for parameter " + aName );
+            }
+            return tResult;
+        }
+    }
+}    // namespace moma
+"""
+
+# regular expression that matches a variable assignment in a C++ file
+PARAMETER_REGEX = re.compile(r"^\s*(?:[^\/\n]+)\s+(\w+)\s*=\s*([^;]+);")
+
+
+def _format_value(value: Any) -> str:
+    # booleans as 0/1, so that they can be read with operator>>
+    if isinstance(value, bool):
+        return str(int(value))
+    # values written as C++ string literals for the source mode work as well
+    if isinstance(value, str) and len(value) > 1 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return str(value)
+
+
+def write_parameter_file(parameters: Dict[str, Any], path: Path):
+    lines = ["# generated by moma from moris.json\n"]
+    lines += [f"{name} = {_format_value(value)}\n" for name, value in parameters.items()]
+    with atomic_write(path) as tmp_file:
+        tmp_file.write_text("".join(lines))
+
+
+def _insert_reader(lines: List[str]) -> List[str]:
+    # replace an existing block, so that a newer reader is picked up
+    if BLOCK_BEGIN + "\n" in lines and BLOCK_END + "\n" in lines:
+        begin = lines.index(BLOCK_BEGIN + "\n")
+        end = lines.index(BLOCK_END + "\n")
+        lines = lines[:begin] + lines[end + 1 :]
+    else:
+        begin = 0
+    block = [BLOCK_BEGIN + "\n", *PARAMETER_READER.splitlines(True), BLOCK_END + "\n"]
+    return lines[:begin] + block + lines[begin:]
+
+
+def _needs_constant(source: str, declaration: str, var: str) -> bool:
+    """Whether the variable must stay a compile-time constant and cannot be read at runtime"""
+    if re.search(r"\bconstexpr\b", declaration):
+        return True
+    # array bounds, template arguments and static_assert need a constant expression
+    name = re.escape(var)
+    usages = (
+        rf"\[[^\[\];]*\b{name}\b[^\[\];]*\]",
+        rf"<[^<>;()]*\b{name}\b[^<>;()]*>",
+        rf"static_assert\s*\([^;]*\b{name}\b",
+    )
+    return any(re.search(usage, source) for usage in usages)
+
+
+def _read_at_runtime(lines: List[str], parameters: Dict[str, Any]) -> List[str]:
+    source = "".join(lines)
+    out = []
+    for line in lines:
+        if match := PARAMETER_REGEX.match(line):
+            var, value = match.groups()
+            if var in parameters:
+                if _needs_constant(source, line, var):
+                    # compiled in like in the source mode, changing it rebuilds the object
+                    line = line.replace(value, f"{parameters[var]}")
+                    logger.info(
+                        f"{var} is a compile-time constant, its value is written into the source"
+                    )
+                elif "moma::parameter<" not in value:
+                    # an auto variable has no type before its initializer is deduced
+                    declared = line[: match.start(1)]
+                    typed = value.strip() if re.search(r"\bauto\b", declared) else var
+                    reader = (
+                        f'moma::parameter< std::decay_t< decltype( {typed} ) > >( "{var}", '
+                        + f"{value.strip()} )"
+                    )
+                    line = line.replace(value, reader)
+                    logger.debug(f"{var} is now read from {PARAMETER_FILE}")
+                parameters.pop(var)
+        out.append(line)
+    return out
+
+
+def _replace_values(lines: List[str], parameters: Dict[str, Any]) -> List[str]:
+    out = []
+    for line in lines:
+        if match := PARAMETER_REGEX.match(line):
+            var, value = match.groups()
+            if var in parameters:
+                formatted = f"{parameters[var]}"
+                line = line.replace(value, f"{formatted}")
+                logger.debug(f"Replaced {var} value {value} with {formatted}")
+                parameters.pop(var)
+        out.append(line)
+    return out
+
 
 def apply_parameters(args):
     config = get_moris_config()
@@ -13,32 +169,44 @@ def apply_parameters(args):
     except KeyError:
         logger.error("No parameters found in moris.json")
         raise SystemExit(1)
-    logger.info(f"Applying parameters to {cpp_file}")
+    write_parameters(config, cpp_file, parameters)
 
-    # regular expression that matches a variable assignment in a C++ file
-    parameter_regex = re.compile(r"^\s*(?:[^\/\n]+)\s+(\w+)\s*=\s*([^;]+);")
 
-    out = []
+def write_parameters(config: Dict[str, Any], cpp_file: Path, parameters: Dict[str, Any]):
+    """Apply the values to the .cpp or the parameter file, depending on the parameter mode"""
+    mode = config.get("parameter_mode", "source")
+    if mode not in ("source", "runtime"):
+        logger.error(f"Unknown parameter_mode '{mode}' in moris.json (source or runtime)")
+        raise SystemExit(1)
+
     with cpp_file.open("r") as cpp:
-        for line in cpp.readlines():
-            if match := parameter_regex.match(line):
-                var, value = match.groups()
-                if var in parameters:
-                    formatted = f"{parameters[var]}"
-                    line = line.replace(value, f"{formatted}")
-                    logger.debug(f"Replaced {var} value {value} with {formatted}")
-                    parameters.pop(var)
-            out.append(line)
-    
-    if parameters:
-        not_found = "\n".join("  - " + k + ": " + str(v) for k, v in parameters.items())
+        lines = cpp.readlines()
+    if mode == "runtime":
+        # the values go to the parameter file, the source only changes on the first call
+        parameter_file = cpp_file.with_name(PARAMETER_FILE)
+        logger.info(f"Writing parameters to {parameter_file}")
+        write_parameter_file(parameters, parameter_file)
+        remaining = dict(parameters)
+        out = _insert_reader(_read_at_runtime(lines, remaining))
+    else:
+        logger.info(f"Applying parameters to {cpp_file}")
+        remaining = dict(parameters)
+        out = _replace_values(lines, remaining)
+
+    if remaining:
+        not_found = "\n".join("  - " + k + ": " + str(v) for k, v in remaining.items())
         logger.warning(
             f"Could not find the following parameter in the file {cpp_file}:\n"
             + f"{not_found}"
         )
-    
+
+    if out == lines:
+        # an unchanged source keeps the shared object (and its build cache entry) valid
+        logger.info(f"{cpp_file.name} is unchanged, the shared object can be reused")
+        return
     with cpp_file.open("w") as cpp:
-        logger.info(f"Writing parameters to {cpp_file}")
+        if mode == "runtime":
+            logger.info(f"Reading the parameters at runtime in {cpp_file}")
+        else:
+            logger.info(f"Writing parameters to {cpp_file}")
         cpp.writelines(out)
-
-
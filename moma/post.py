@@ -1,20 +1,38 @@
-from io import StringIO
+import itertools
+import json
 import logging
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Tuple
 import pandas as pd
-import matplotlib.pyplot as plt
-from moma.util import get_log_file, get_moris_config
+from moma import chunked
+from moma.log_index import LogIndex
+from moma.metrics import METRICS_FILE, load_metrics
+from moma.util import (
+    get_log_file,
+    get_moris_config,
+    get_run_directory,
+    select_run_directories,
+)
 import csv
 import numpy as np
 
 logger = logging.getLogger(__name__)
 
+FOLLOW_SAVE_INTERVAL = 30.0  # seconds between saves of the log index while following
+
+
+def plot_residuals(args):
+    import matplotlib.pyplot as plt
 
-def plot_residuals():
     config = get_moris_config()
+    directory = get_run_directory(config, args.run) if args.run else Path(".")
     try:
-        df = pd.read_csv("newton_iterations.csv")
+        df = pd.DataFrame(load_metrics(directory))
     except FileNotFoundError:
-        logger.error("No newton_iterations.csv file found")
+        logger.error(f"No {METRICS_FILE} file found")
         raise SystemExit(1)
 
     fig, ax = plt.subplots()
@@ -31,73 +49,497 @@ def plot_residuals():
     ax.set_ylabel("Norm")
     ax.set_title(f"'{config['project']}' Residuals")
     ax.legend()
-    fig.savefig("residuals.png", dpi=300)
+    fig.savefig(f"residuals_{args.run}.png" if args.run else "residuals.png", dpi=300)
+
+
+def decimate_min_max(
+    x: np.ndarray, y: np.ndarray, max_points: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce a series to at most max_points points by keeping the minimum and the maximum of
+    every bucket, in their original order. Spikes and plateaus stay visible, unlike with
+    plain striding.
+    """
+    if len(y) <= max_points:
+        return x, y
+    buckets = max(max_points // 2, 1)
+    size = -(-len(y) // buckets)  # ceil
+    padded = np.full(buckets * size, np.nan)
+    padded[: len(y)] = y
+    padded = padded.reshape(buckets, size)
+    # buckets that are all nan (not a number in the log) keep their first index
+    valid = ~np.isnan(padded).all(axis=1)
+    filled = np.where(np.isnan(padded), np.inf, padded)
+    lows = np.argmin(filled, axis=1)
+    filled = np.where(np.isnan(padded), -np.inf, padded)
+    highs = np.argmax(filled, axis=1)
+    offsets = np.arange(buckets) * size
+    indices = np.stack([lows, highs], axis=1)
+    indices = np.sort(np.where(valid[:, None], indices, 0), axis=1) + offsets[:, None]
+    indices = np.unique(indices[indices < len(y)])
+    return x[indices], y[indices]
+
+
+def _render_comparison(
+    metric: str,
+    series: List[Tuple[str, np.ndarray, np.ndarray]],
+    title: str,
+    output: Path,
+    dpi: int,
+):
+    # runs in worker processes: the Agg canvas needs neither pyplot nor a display
+    from matplotlib import colormaps
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+    from matplotlib.lines import Line2D
+
+    figure = Figure(figsize=(8, 5))
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    colors = colormaps["viridis"](np.linspace(0, 1, max(len(series), 2)))
+    # a single collection draws hundreds of lines much faster than one artist per run
+    segments = [np.column_stack([x, y]) for _, x, y in series]
+    ax.add_collection(LineCollection(segments, colors=colors, linewidths=1))
+    if metric != "LoadFactor":
+        ax.set_yscale("log")
+    ax.autoscale_view()
+    if len(series) <= 20:
+        ax.legend(
+            [Line2D([], [], color=color) for color in colors],
+            [identifier for identifier, _, _ in series],
+            fontsize="small",
+        )
+    ax.set_xlabel("Iteration")
+    ax.set_ylabel(metric)
+    ax.set_title(title)
+    figure.savefig(output, dpi=dpi)
+    return output
 
 
-def _convert_to_coordinate_column(df, name) -> pd.DataFrame:
+def compare_runs(args):
+    config = get_moris_config()
+    run_dirs = select_run_directories(config, args.runs)
+    metrics = args.metric or ["ResidualNorm"]
+
+    start = time.perf_counter()
+    series: Dict[str, List[Tuple[str, np.ndarray, np.ndarray]]] = {m: [] for m in metrics}
+    for run_dir in run_dirs:
+        try:
+            data = load_metrics(run_dir)
+        except FileNotFoundError:
+            logger.warning(f"Skipping {run_dir.name}: no {METRICS_FILE} file found")
+            continue
+        iterations = data["Iteration"]
+        for metric in metrics:
+            if metric not in data:
+                logger.warning(f"Skipping {run_dir.name}: no {metric} recorded")
+                continue
+            x, y = decimate_min_max(iterations, data[metric], args.max_points)
+            series[metric].append((run_dir.name, x, y))
+
+    output = Path(args.output)
+    jobs = []
+    for metric in metrics:
+        if len(metrics) > 1:
+            path = output.with_name(f"{output.stem}_{metric}{output.suffix}")
+        else:
+            path = output
+        title = f"'{config['project']}' {metric} of {len(series[metric])} runs"
+        jobs.append((metric, series[metric], title, path, args.dpi))
+
+    # every figure is rendered in its own process, matplotlib is single threaded
+    if len(jobs) > 1 and args.workers != 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            outputs = list(pool.map(_render_comparison, *zip(*jobs)))
+    else:
+        outputs = [_render_comparison(*job) for job in jobs]
+    logger.info(
+        f"Compared {len(run_dirs)} runs in {time.perf_counter() - start:.1f}s: "
+        + ", ".join(str(path) for path in outputs)
+    )
+
+
+def _coordinate_columns(df: pd.DataFrame, name: str) -> List[str]:
+    # columns <name>x, <name>y and <name>z in this order, as far as they exist
+    columns = [name + axis for axis in "xyz" if name + axis in df.columns]
+    if not columns:
+        raise KeyError(f"No coordinate columns {name}x, {name}y, ... found")
+    return columns
+
+
+def coordinate_array(df: pd.DataFrame, name: str) -> np.ndarray:
+    """
+    Returns the columns <name>x, <name>y, ... as a contiguous (n, dim) float array.
+    """
+    return np.ascontiguousarray(df[_coordinate_columns(df, name)].to_numpy(dtype=float))
+
+
+def _convert_to_coordinate_column(df: pd.DataFrame, *names: str) -> pd.DataFrame:
     """
     Converts columns <name>x, <name>y, ... into a single column <name>
     with a numpy array of coordinates.
 
     Parameters:
     - df: pandas DataFrame.
-    - name: Base name of the columns to convert (e.g., 'A' for 'Ax', 'Ay').
+    - names: Base names of the columns to convert (e.g., 'A' for 'Ax', 'Ay').
 
     Returns:
-    - Modified DataFrame with a new column <name> containing numpy arrays of coordinates.
+    - Modified DataFrame with a new column <name> for every name. The arrays in a column
+      are row views into a single contiguous (n, dim) array.
     """
-    # Identify columns that start with the name and end with 'x' or 'y'
-    coord_columns = [
-        col for col in df.columns if col.startswith(name) and col[-1] in ["x", "y", "z"]
-    ]
+    for name in names:
+        columns = _coordinate_columns(df, name)
+        coordinates = coordinate_array(df, name)
+        df[name] = list(coordinates)
+        df.drop(columns=columns, inplace=True)
+    return df
 
-    # Sort columns to ensure x, y order
-    coord_columns = sorted(coord_columns)
 
-    # Combine the identified columns into a single column with numpy arrays
-    df[name] = df.apply(
-        lambda row: np.array([row[col] for col in coord_columns]), axis=1
-    )
+def _parse_rows(values: List[str], sep: str) -> List[list]:
+    # unquoted values are numbers, quoted ones strings (like pandas with QUOTE_NONNUMERIC)
+    options = {"delimiter": sep, "skipinitialspace": True, "quotechar": '"'}
+    try:
+        return list(csv.reader(values, quoting=csv.QUOTE_NONNUMERIC, **options))
+    except ValueError:
+        rows = []
+        for value in values:
+            try:
+                rows.extend(csv.reader([value], quoting=csv.QUOTE_NONNUMERIC, **options))
+            except ValueError:
+                rows.extend(csv.reader([value], **options))
+        return rows
 
-    # Optionally, drop the original coordinate columns if you no longer need them
-    df.drop(columns=coord_columns, inplace=True)
-    return df
+
+class MarkerMatcher:
+    """
+    Finds the marker of a line. Longer markers are tried first, so that a marker that is a
+    prefix of another one does not win.
+    """
+
+    def __init__(self, markers: List[str]):
+        self.markers = sorted(markers, key=len, reverse=True)
+        self.prefixes = tuple(self.markers)
+
+    def match(self, line: str) -> Optional[Tuple[str, str]]:
+        """The marker of the line and its value, None for other lines"""
+        line = line.strip()
+        if not line.startswith(self.prefixes):
+            return None
+        for marker in self.markers:
+            if line.startswith(marker):
+                return marker, line[len(marker) :].strip()
+        return None
+
+
+class MarkerExtractor:
+    """
+    Streams the values of all lines starting with one of the markers into one csv file per
+    marker. Rows are parsed and written in batches, so the memory use does not depend on
+    the size of the log.
+    """
+
+    batch_size = 10_000
+
+    def __init__(
+        self,
+        markers: List[str],
+        outputs: List[Path],
+        headers: List[Optional[str]],
+        sep: str,
+    ):
+        self.matcher = MarkerMatcher(markers)
+        self.sep = sep
+        self.outputs = dict(zip(markers, outputs))
+        self.headers = dict(zip(markers, headers))
+        self.pending: Dict[str, List[str]] = {marker: [] for marker in markers}
+        self._open()
+
+    def _open(self):
+        self.rows = {marker: 0 for marker in self.outputs}
+        self.files: Dict[str, IO[str]] = {}
+        self.writers = {}
+        for marker, output in self.outputs.items():
+            self.files[marker] = output.open("w", newline="")
+            self.writers[marker] = csv.writer(self.files[marker])
+            if self.headers[marker]:
+                self.writers[marker].writerow(
+                    column.strip() for column in self.headers[marker].split(self.sep)
+                )
+
+    def feed(self, line: str):
+        match = self.matcher.match(line)
+        if match is None or not match[1]:
+            return
+        marker, value = match
+        pending = self.pending[marker]
+        pending.append(value)
+        if len(pending) >= self.batch_size:
+            self._write(marker)
+
+    def _write(self, marker: str):
+        rows = _parse_rows(self.pending[marker], self.sep)
+        self.writers[marker].writerows(rows)
+        self.rows[marker] += len(rows)
+        self.pending[marker].clear()
+
+    def flush(self):
+        for marker, f in self.files.items():
+            self._write(marker)
+            f.flush()
+
+    def close(self):
+        for marker, f in self.files.items():
+            self._write(marker)
+            f.close()
+
+    def restart(self):
+        """Discard everything extracted so far and start with empty files"""
+        for marker, f in self.files.items():
+            self.pending[marker].clear()
+            f.close()
+        self._open()
+
+
+def _marker_outputs(output: Path, markers: List[str]) -> List[Path]:
+    """One file per marker, named after the marker next to the output"""
+    if len(markers) == 1:
+        return [output]
+    names = [re.sub(r"\W+", "_", marker).strip("_") or "marker" for marker in markers]
+    # different markers can have the same name (e.g. "a-b" and "a b"), number those
+    duplicates = {name for name in names if names.count(name) > 1}
+    taken = set(names) - duplicates
+    outputs = []
+    for name in names:
+        if name in duplicates:
+            number = 1
+            while f"{name}_{number}" in taken:
+                number += 1
+            name = f"{name}_{number}"
+            taken.add(name)
+        outputs.append(output.with_name(f"{output.stem}_{name}{output.suffix}"))
+    return outputs
+
+
+def _follow_log(index: LogIndex, extractor: MarkerExtractor, interval: float):
+    logger.info(f"Following {index.log_file} (press Ctrl+C to stop)")
+    # the whole index is rewritten on every save, not on every poll
+    last_save = time.monotonic()
+    try:
+        while True:
+            time.sleep(interval)
+            try:
+                size = chunked.uncompressed_size(index.log_file)
+            except FileNotFoundError:
+                continue
+            if index.inode is not None and not index.is_valid():
+                logger.info(f"{index.log_file} was replaced, restarting the extraction")
+                index.reset(index.markers)
+                extractor.restart()
+            elif size == index.indexed_bytes:
+                continue
+
+            with chunked.open_binary(index.log_file) as f:
+                index.update(f, extractor.feed, follow=True)
+            extractor.flush()
+            if time.monotonic() - last_save >= FOLLOW_SAVE_INTERVAL:
+                index.save()
+                last_save = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        index.save()
+
+
+def _collect_marker_values(markers: List[str]):
+    # values of the lines of every marker, matched like in MarkerExtractor
+    matcher = MarkerMatcher(markers)
+    values: Dict[str, List[str]] = {marker: [] for marker in markers}
+
+    def feed(line: str):
+        match = matcher.match(line)
+        if match is not None and match[1]:
+            values[match[0]].append(match[1])
+
+    return values, feed
+
+
+def _extract_run(log_file: Path, markers: List[str], sep: str) -> Dict[str, List[list]]:
+    """Rows of the markers in one log, runs in a worker process of the batch extraction"""
+    values, feed = _collect_marker_values(markers)
+    index = LogIndex.load(log_file)
+    index.track(markers)
+    with chunked.open_binary(log_file) as f:
+        for line in index.marker_lines(f, markers):
+            feed(line)
+        index.update(f, feed)
+    try:
+        index.save()
+    except OSError:
+        pass  # the next extraction indexes the log again
+    return {marker: _parse_rows(lines, sep) for marker, lines in values.items()}
+
+
+def _cell(value):
+    # lists and tables of parameters do not fit into one column
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return json.dumps(value)
+
+
+def _tag_names(parameter_names: List[str], columns: List[str]) -> Dict[str, str]:
+    # column names of the parameters that do not clash with "run" or the value columns
+    taken = {"run", *columns}
+    names = {}
+    for name in parameter_names:
+        column = name
+        while column in taken:
+            column = f"parameter_{column}"
+        taken.add(column)
+        names[name] = column
+    return names
+
+
+def _extract_batch(args, config, markers: List[str], headers: List[Optional[str]]):
+    """Extract the markers from the logs of many stored runs into one file per marker"""
+    output = Path(args.output)
+    parquet = output.suffix == ".parquet"
+    if parquet:
+        try:
+            pd.io.parquet.get_engine("auto")
+        except ImportError:
+            logger.error("Writing parquet files requires pyarrow or fastparquet")
+            raise SystemExit(1)
+
+    log_name = get_log_file(config).name
+    runs = []
+    for run_dir in select_run_directories(config, args.runs):
+        if not chunked.exists(run_dir / log_name):
+            logger.warning(f"Skipping {run_dir.name}: no {log_name} found")
+            continue
+        try:
+            config_file = json.loads((run_dir / "moris.json").read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            config_file = {}
+        parameters = config_file.get("parameters", {})
+        runs.append((run_dir.name, parameters, run_dir / log_name))
+    parameter_names = list(dict.fromkeys(name for _, p, _ in runs for name in p))
+    outputs = dict(zip(markers, _marker_outputs(output, markers)))
+    columns = {
+        m: [c.strip() for c in h.split(args.sep)] if h else None
+        for m, h in zip(markers, headers)
+    }
+
+    start = time.perf_counter()
+    rows = {marker: 0 for marker in markers}
+    frames: Dict[str, List[pd.DataFrame]] = {marker: [] for marker in markers}
+    # the logs are read and parsed in parallel, the results are written in the run order
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = pool.map(
+            _extract_run,
+            [log_file for _, _, log_file in runs],
+            itertools.repeat(markers),
+            itertools.repeat(args.sep),
+        )
+        for (identifier, parameters, _), run_rows in zip(runs, results):
+            for marker in markers:
+                if not run_rows[marker]:
+                    continue
+                df = pd.DataFrame(run_rows[marker])
+                # the columns are fixed by the header or else by the first run, all runs
+                # of one file must have the same columns
+                if columns[marker] is None:
+                    columns[marker] = [f"value_{i + 1}" for i in range(len(df.columns))]
+                names = columns[marker]
+                if len(df.columns) != len(names):
+                    logger.warning(
+                        f"{identifier}: {len(df.columns)} values for '{marker}' instead of "
+                        + f"{len(names)}, the rows are padded or truncated"
+                    )
+                df = df.reindex(columns=range(len(names)))
+                df.columns = names
+                tag_names = _tag_names(parameter_names, names)
+                tags = {"run": identifier}
+                tags.update((tag_names[n], _cell(parameters.get(n))) for n in parameter_names)
+                for position, (name, value) in enumerate(tags.items()):
+                    df.insert(position, name, value)
+                if parquet:
+                    frames[marker].append(df)
+                else:
+                    df.to_csv(
+                        outputs[marker],
+                        mode="a" if rows[marker] else "w",
+                        header=not rows[marker],
+                        index=False,
+                    )
+                rows[marker] += len(df)
+
+    for marker in markers:
+        if rows[marker] == 0:
+            logger.warning(f"No lines found for marker '{marker}' in {len(runs)} runs")
+            continue
+        if parquet:
+            pd.concat(frames[marker], ignore_index=True).to_parquet(outputs[marker])
+        logger.info(
+            f"Saved {rows[marker]} rows for '{marker}' from {len(runs)} runs to "
+            + f"{outputs[marker]} in {time.perf_counter() - start:.1f}s"
+        )
 
 
 def extract_csv_from_log(args):
-    if args.marker is None:
+    if not args.marker:
         logger.error("No marker for extraction provided!")
         raise SystemExit(1)
-    marker = args.marker
-    sep = args.sep
-
-    data = args.header + "\n" if args.header else ""
+    markers = args.marker
+    headers = args.header or [None] * len(markers)
+    if len(headers) != len(markers):
+        logger.error(
+            f"Got {len(headers)} headers for {len(markers)} markers. Provide one header per marker."
+        )
+        raise SystemExit(1)
+    # a marker given twice is extracted once, with its first header
+    unique: Dict[str, Optional[str]] = {}
+    for marker, header in zip(markers, headers):
+        unique.setdefault(marker, header)
+    if len(unique) < len(markers):
+        logger.warning("Markers given more than once are extracted once")
+    markers, headers = list(unique), list(unique.values())
 
     config = get_moris_config()
-    log_file = get_log_file(config)
+    if args.runs:
+        if args.run or args.follow:
+            logger.error("--runs cannot be combined with --run or --follow")
+            raise SystemExit(1)
+        _extract_batch(args, config, markers, headers)
+        return
 
-    try:
-        with log_file.open("r") as f:
-            lines = f.readlines()
-    except FileNotFoundError:
+    log_file = get_log_file(config)
+    if args.run:
+        log_file = get_run_directory(config, args.run) / log_file.name
+    if not chunked.exists(log_file):
         logger.error(f"Cannot extract from log file: {log_file} not found")
         raise SystemExit(1)
 
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if line.startswith(marker):
-            data += line.lstrip(marker).strip() + "\n"
-
-    df = pd.read_csv(
-        StringIO(data),
-        sep=sep,
-        skipinitialspace=True,
-        skip_blank_lines=True,
-        quoting=csv.QUOTE_NONNUMERIC,
-        quotechar='"',
-        index_col=False,
-        header=0 if args.header else None,
-    )
-    logger.info(f"Extracted data from log file:\n{df}")
-    logger.info(f"Saving to {args.output}")
-    df.to_csv(args.output, index=False, header=True if args.header else False)
+    # lines that were indexed before are read directly, the rest of the log is indexed
+    index = LogIndex.load(log_file)
+    index.track(markers)
+    outputs = _marker_outputs(Path(args.output), markers)
+    extractor = MarkerExtractor(markers, outputs, headers, args.sep)
+    try:
+        with chunked.open_binary(log_file) as f:
+            for line in index.marker_lines(f, markers):
+                extractor.feed(line)
+            index.update(f, extractor.feed, follow=args.follow)
+        index.save()
+        if args.follow:
+            _follow_log(index, extractor, args.interval)
+    finally:
+        extractor.close()
+
+    for marker, output in extractor.outputs.items():
+        if extractor.rows[marker] == 0:
+            logger.warning(f"No lines found for marker '{marker}'")
+        else:
+            logger.info(
+                f"Saved {extractor.rows[marker]} rows for '{marker}' to {output}"
+            )
@@ -1,11 +1,21 @@
-from io import BufferedReader
+import json
 import logging
-from typing import IO, Any, Callable
+import os
+import selectors
+import shlex
+from typing import IO, Any, Callable, Dict, List
 from pathlib import Path
-import select
 import threading
+import time
 from subprocess import Popen, PIPE
+from moma import chunked
+from moma.build_cache import BuildCache
+from moma.events import EventStream
+from moma.isolation import DEFAULT_PRIVATE, Scratch, moris_build_lock
 from moma.log_filter import MorisLogFilter
+from moma.log_index import get_index_file
+from moma.parameter import PARAMETER_FILE
+from moma.section_profile import PROFILE_FILE
 from moma.util import (
     get_log_file,
     get_moris_config,
@@ -16,45 +26,174 @@ from moma.util import (
 
 logger = logging.getLogger(__name__)
 
+RECEIPT_FILE = "moma_run.json"
+READ_SIZE = 1 << 16
+FLUSH_INTERVAL = 0.5  # seconds
+FLUSH_SIZE = 1 << 20  # bytes
 
-exit_event = threading.Event()
 
+def _dispatch_lines(data: bytes, logging_func: Callable[[str], None]):
+    # lines are decoded straight from the chunk, without a bytes copy per line. The chunks
+    # themselves are copied when a partial line is joined and when pending writes are joined
+    view = memoryview(data)
+    start = 0
+    end = data.find(b"\n")
+    while end != -1:
+        line = str(view[start:end], "utf8", "replace").strip()
+        if line:
+            logging_func(line)
+        start = end + 1
+        end = data.find(b"\n", start)
 
-def handle_subprocess_stream(
+
+def pump_subprocess_output(
     process: Popen,
-    stream: BufferedReader,
-    log_file: IO[Any],
-    logging_func: Callable[[str], None] | None = None,
+    log_file: IO[bytes],
+    stdout_func: Callable[[str], None] | None = None,
+    stderr_func: Callable[[str], None] | None = None,
+    exit_event: threading.Event | None = None,
 ):
-    while True:
-        # Check if process has ended or exit_event is set
-        if exit_event.is_set() or process.poll() is not None:
+    """
+    Multiplex stdout and stderr of the process in a single loop.
+
+    Output is read in large chunks and only complete lines are written to the log file, so
+    lines of both streams are never interleaved. Writes are batched and flushed when
+    FLUSH_SIZE bytes are pending or FLUSH_INTERVAL seconds have passed. The streams are
+    read until EOF, so everything the process wrote is drained after it exits.
+    """
+    selector = selectors.DefaultSelector()
+    partial: Dict[int, bytes] = {}
+    for stream, func in ((process.stdout, stdout_func), (process.stderr, stderr_func)):
+        if stream is not None:
+            selector.register(stream.fileno(), selectors.EVENT_READ, func)
+            partial[stream.fileno()] = b""
+
+    pending: List[bytes] = []
+    pending_size = 0
+    last_flush = time.monotonic()
+    while selector.get_map():
+        for key, _ in selector.select(timeout=FLUSH_INTERVAL):
+            data = os.read(key.fd, READ_SIZE)
+            if not data:
+                # EOF: the remainder is the last (unterminated) line
+                selector.unregister(key.fd)
+                remainder = partial.pop(key.fd)
+                data = remainder + b"\n" if remainder else b""
+            else:
+                data = partial[key.fd] + data
+                last_newline = data.rfind(b"\n") + 1
+                partial[key.fd] = data[last_newline:]
+                data = data[:last_newline]
+            if not data:
+                continue
+
+            pending.append(data)
+            pending_size += len(data)
+            if key.data is not None:
+                _dispatch_lines(data, key.data)
+
+        now = time.monotonic()
+        if pending_size >= FLUSH_SIZE or now - last_flush >= FLUSH_INTERVAL:
+            log_file.write(b"".join(pending))
+            log_file.flush()
+            pending.clear()
+            pending_size = 0
+            last_flush = now
+
+        if exit_event is not None and exit_event.is_set():
+            process.terminate()
             break
-        # Use select to wait for I/O readiness, with a timeout to periodically check exit conditions
-        ready_to_read, _, _ = select.select([stream], [], [], 0.05)
-        if stream in ready_to_read:
-            line = stream.readline().decode("utf8").strip()
-            log_file.write(line + "\n")
-            log_file.flush()  # Ensure the line is written out immediately
-            if logging_func and line:
-                logging_func(line)
-        else:
-            # No data to read, loop back and check exit conditions again
-            continue
 
+    log_file.write(b"".join(pending))
+    log_file.flush()
+    selector.close()
 
-def check_for_lock_file(line: str):
+
+def check_for_lock_file(
+    line: str, exit_event: threading.Event, events: EventStream | None = None
+):
     if line.startswith("Warning: lock file"):
+        if events is not None:
+            events.emit("lock", line=line)
         logger.error(
             "Lock file detected. Check the log for more information. You can use the clean command with the --remove-lock option to remove the lock file."
         )
         exit_event.set()
 
 
-def create_shared_object(build_type: str, cpp_file: Path, log_file: IO[Any]):
+def create_shared_object(
+    build_type: str,
+    cpp_file: Path,
+    log_file: IO[bytes],
+    cache: BuildCache | None = None,
+    scratch: Scratch | None = None,
+    private: List[str] = DEFAULT_PRIVATE,
+    stderr_func: Callable[[str], None] | None = None,
+    events: EventStream | None = None,
+) -> bool:
+    """
+    Build the shared object of the project. Returns whether it came from the cache.
+
+    Without scratch the build runs in the shared moris tree, one moma build at a time.
+    With scratch it runs in a private overlay of the tree and never touches the shared lock.
+    """
     moris_root = get_moris_root()
     cso_script = moris_root / "share" / "scripts" / "create_shared_object.sh"
     build_dir = get_build_dir_name(build_type)
+
+    def build():
+        if scratch is None:
+            with moris_build_lock(moris_root):
+                _build_shared_object(
+                    cso_script,
+                    build_dir,
+                    cpp_file,
+                    log_file,
+                    stderr_func=stderr_func,
+                    events=events,
+                )
+        else:
+            # the build directory compiles the input file as well, its products stay private
+            build_mains = Path(build_dir) / "projects" / "mains"
+            overlay_private = list(private)
+            if (moris_root / build_mains).is_dir():
+                overlay_private.append(str(build_mains))
+            overlay = scratch.overlay(moris_root, overlay_private)
+            _build_shared_object(
+                overlay / cso_script.relative_to(moris_root),
+                build_dir,
+                cpp_file,
+                log_file,
+                env={**os.environ, "MORISROOT": str(overlay)},
+                stderr_func=stderr_func,
+                events=events,
+            )
+
+    if cache is None:
+        build()
+        return False
+
+    moris_library = moris_root / build_dir / "projects" / "mains" / "moris"
+    key = cache.key(cpp_file, build_type, build_dir, moris_library, cso_script)
+    with cache.lock(key):
+        cpp_file.with_suffix(".o").unlink(missing_ok=True)
+        if cache.restore(key, cpp_file.with_suffix(".so")):
+            logger.info(f"Shared object for {cpp_file.stem} restored from the build cache")
+            return True
+        build()
+        cache.store(key, cpp_file.with_suffix(".so"))
+        return False
+
+
+def _build_shared_object(
+    cso_script: Path,
+    build_dir: str,
+    cpp_file: Path,
+    log_file: IO[bytes],
+    env: Dict[str, str] | None = None,
+    stderr_func: Callable[[str], None] | None = None,
+    events: EventStream | None = None,
+):
     command = [
         str(cso_script),
         ".",
@@ -67,24 +206,21 @@ def create_shared_object(build_type: str, cpp_file: Path, log_file: IO[Any]):
     cpp_file.with_suffix(".o").unlink(missing_ok=True)
 
     logger.debug(f"Running command: {' '.join(command)}")
-    with Popen(command, stdout=PIPE, stderr=PIPE) as proc:
-        stdout_thread = threading.Thread(
-            target=handle_subprocess_stream,
-            args=(proc, proc.stdout, log_file, check_for_lock_file),
+    # per build, a lock in one of several concurrent builds must not stop the others
+    exit_event = threading.Event()
+    # the script builds the project in its working directory (".")
+    with Popen(command, stdout=PIPE, stderr=PIPE, env=env, cwd=cpp_file.parent) as proc:
+        pump_subprocess_output(
+            proc,
+            log_file,
+            lambda line: check_for_lock_file(line, exit_event, events),
+            stderr_func or stderr_logger(events, "build"),
+            exit_event,
         )
-        stderr_thread = threading.Thread(
-            target=handle_subprocess_stream,
-            args=(proc, proc.stderr, log_file, lambda line: logger.error(line)),
-        )
-        stdout_thread.start()
-        stderr_thread.start()
-        # Check if the exit_event is set after threads have completed
         if exit_event.is_set():
             raise SystemExit(1)
-        stdout_thread.join()
-        stderr_thread.join()
 
-        if proc.poll() != 0 or not cpp_file.with_suffix(".so").exists():
+        if proc.wait() != 0 or not cpp_file.with_suffix(".so").exists():
             logger.error(
                 f"Failed to create shared object for {cpp_file.stem}. Check the log at {log_file.name}"
             )
@@ -93,45 +229,82 @@ def create_shared_object(build_type: str, cpp_file: Path, log_file: IO[Any]):
             logger.info(f"Shared object created for {cpp_file.stem}")
 
 
+def get_shared_object(cpp_file: Path, build_type: str) -> Path:
+    # <project>.so holds the last build of any type, only the typed name is certain
+    shared_object = cpp_file.with_suffix(f".{build_type}.so")
+    if shared_object.exists() or os.environ.get("MOMA_MORIS"):
+        # a replacement of moris (e.g. the replay of a benchmark) may need no shared object
+        return shared_object
+    untyped = cpp_file.with_suffix(".so")
+    if untyped.exists():
+        # projects built before the typed names existed
+        logger.warning(
+            f"No {shared_object.name} found, running {untyped.name} whose build type is "
+            + "unknown. Build it again to be sure"
+        )
+        return untyped
+    logger.error(
+        f"No {build_type} shared object {shared_object.name} found. Build it with "
+        + f"'moma run --{build_type}' (without --run-only) or 'moma build --{build_type}'"
+    )
+    raise SystemExit(1)
+
+
+def link_shared_object(cpp_file: Path, build_type: str):
+    """Make the <project>.so just built available as <project>.<build type>.so"""
+    shared_object = cpp_file.with_suffix(f".{build_type}.so")
+    shared_object.unlink(missing_ok=True)
+    os.link(cpp_file.with_suffix(".so"), shared_object)
+
+
 def get_moris_run_command(
     build_type: str,
     processors: int,
     cpp_file: Path,
 ) -> list[str]:
-    moris_root = get_moris_root()
-    build_dir = get_build_dir_name(build_type)
-    moris_command = moris_root / build_dir / "projects" / "mains" / "moris"
-    # make sure that the moris command exists
-    if not moris_command.exists():
-        logger.error(f"moris command not found at {moris_command}")
-        raise SystemExit(1)
-    return [
-        "mpirun",
-        "-np",
-        str(processors),
-        str(moris_command),
-        str(cpp_file.with_suffix(".so")),
-    ]
+    # MOMA_MORIS and MOMA_MPIRUN replace the commands, e.g. with moma.fake_moris for
+    # benchmarks. An empty MOMA_MPIRUN starts moris directly.
+    if moris_override := os.environ.get("MOMA_MORIS"):
+        moris_command = shlex.split(moris_override)
+    else:
+        moris_root = get_moris_root()
+        build_dir = get_build_dir_name(build_type)
+        moris_path = moris_root / build_dir / "projects" / "mains" / "moris"
+        # make sure that the moris command exists
+        if not moris_path.exists():
+            logger.error(f"moris command not found at {moris_path}")
+            raise SystemExit(1)
+        moris_command = [str(moris_path)]
+    mpirun = shlex.split(os.environ.get("MOMA_MPIRUN", "mpirun"))
+    launcher = [*mpirun, "-np", str(processors)] if mpirun else []
+    shared_object = get_shared_object(cpp_file, build_type)
+    return [*launcher, *moris_command, str(shared_object)]
+
 
+def stderr_logger(events: EventStream | None, phase: str) -> Callable[[str], None]:
+    if events is None:
+        return lambda line: logger.error(line)
 
-def run_moris(command: list[str], log_file: IO[Any]):
+    def log(line: str):
+        events.emit("stderr", phase=phase, line=line)
+        logger.error(line)
+
+    return log
+
+
+def run_moris(
+    command: list[str],
+    log_file: IO[bytes],
+    stdout_logger: MorisLogFilter,
+    cwd: Path | None = None,
+):
     logger.debug(f"Running command: {' '.join(command)}")
-    with Popen(command, stdout=PIPE, stderr=PIPE) as proc:
-        # Create threads for handling stdout and stderr
-        stdout_logger = MorisLogFilter()
-        stdout_thread = threading.Thread(
-            target=handle_subprocess_stream,
-            args=(proc, proc.stdout, log_file, stdout_logger.log),
-        )
-        stderr_thread = threading.Thread(
-            target=handle_subprocess_stream,
-            args=(proc, proc.stderr, log_file, lambda line: logger.error(line)),
+    with Popen(command, stdout=PIPE, stderr=PIPE, cwd=cwd) as proc:
+        pump_subprocess_output(
+            proc, log_file, stdout_logger.log, stderr_logger(stdout_logger.events, "run")
         )
-        stdout_thread.start()
-        stderr_thread.start()
-        stdout_thread.join()
-        stderr_thread.join()
-        if proc.poll() != 0:
+        stdout_logger.close()
+        if proc.wait() != 0:
             # logger.error(f"moris failed. Last {n_last} lines of log:\n{last_lines}")
             logger.error("moris run failed")
             raise SystemExit(1)
@@ -139,6 +312,23 @@ def run_moris(command: list[str], log_file: IO[Any]):
             logger.info("Moris run completed successfully")
 
 
+def open_run_log(log_file: Path, codec: str | bool | None) -> IO[bytes]:
+    """The plain log, or compressed chunks of it written while moris runs"""
+    if not codec:
+        return log_file.open("wb")
+    codec = chunked.DEFAULT_CODEC if codec is True else codec
+    if codec not in chunked.CODECS:
+        logger.error(f"The {codec} codec is not available, install the zstandard package")
+        raise SystemExit(1)
+    return chunked.ChunkedWriter(log_file, codec)  # type: ignore[return-value]
+
+
+def write_run_receipt(receipt: Dict[str, Any]):
+    # machine readable summary of the run, stored and catalogued with the results
+    with open(RECEIPT_FILE, "w") as f:
+        json.dump(receipt, f, indent=4)
+
+
 def get_build_type(args):
     if args.dbg:
         return "dbg"
@@ -149,6 +339,11 @@ def get_build_type(args):
         return "dbg"
 
 
+def get_processors(args, config: Dict[str, Any]) -> int:
+    # the default can be recorded in the moris.json, e.g. by a scaling study
+    return args.processors or config.get("processors", 1)
+
+
 def run(args):
     config = get_moris_config()
     cpp_file = get_cpp_file(config)
@@ -156,17 +351,108 @@ def run(args):
     log_file = get_log_file(config)
     if log_file.exists():
         log_file.unlink()
+    get_index_file(log_file).unlink(missing_ok=True)
+    for codec in chunked.CODECS.values():
+        compressed = log_file.with_name(log_file.name + codec.suffix)
+        compressed.unlink(missing_ok=True)
+        chunked.get_index_file(compressed).unlink(missing_ok=True)
+
+    scratch = None
+    if args.isolate or config.get("isolate", False):
+        scratch_directory = config.get("scratch_directory")
+        base = Path(scratch_directory) if scratch_directory else None
+        scratch = Scratch(Path.cwd(), base)
+    events = EventStream(args.events) if args.events else None
+    try:
+        _run(args, config, cpp_file, build_type, log_file, scratch, events)
+    finally:
+        if scratch is not None:
+            scratch.remove()
+        if events is not None:
+            events.close()
 
-    with log_file.open("w") as log:
+
+def _run(
+    args,
+    config: Dict[str, Any],
+    cpp_file: Path,
+    build_type: str,
+    log_file: Path,
+    scratch: Scratch | None,
+    events: EventStream | None = None,
+):
+    build: Dict[str, Any] = {"build_time": None, "build_cached": None}
+    codec = args.compress_log or config.get("compress_log")
+    with open_run_log(log_file, codec) as log:
         if not args.run_only:
             logger.info(f"Creating shared object for '{cpp_file.stem}'")
-            create_shared_object(build_type, cpp_file, log)
+            cache = None if args.no_cache else BuildCache.from_config(config)
+            if events is not None:
+                events.emit("build_start", project=config["project"], build_type=build_type)
+            start = time.perf_counter()
+            build["build_cached"] = create_shared_object(
+                build_type,
+                cpp_file,
+                log,
+                cache,
+                scratch,
+                config.get("isolation_private", DEFAULT_PRIVATE),
+                events=events,
+            )
+            build["build_time"] = time.perf_counter() - start
+            link_shared_object(cpp_file, build_type)
+            if events is not None:
+                events.emit("build_end", **build)
             if args.shared_object_only:
                 return
 
         logger.info(f"Running moris for '{cpp_file.stem}'")
-        run_command = get_moris_run_command(build_type, args.processors, cpp_file)
-        run_moris(run_command, log)
+        parameter_file = cpp_file.with_name(PARAMETER_FILE)
+        if config.get("parameter_mode") == "runtime" and parameter_file.exists():
+            # the shared object reads the values of the parameters from this file
+            os.environ["MOMA_PARAMETERS"] = str(parameter_file)
+        processors = get_processors(args, config)
+        run_command = get_moris_run_command(build_type, processors, cpp_file)
+        staging = None
+        if scratch is not None:
+            # moris writes its outputs into a private directory, they are moved back after
+            inputs = [parameter_file] if parameter_file.exists() else []
+            for pattern in config.get("inputs", []):
+                inputs.extend(Path.cwd().glob(pattern))
+            staging = scratch.stage(inputs)
+        receipt = {
+            "project": config["project"],
+            "build_type": build_type,
+            "processors": processors,
+            "started": time.time(),
+            "status": "failed",
+            **build,
+        }
+        if events is not None:
+            events.emit(
+                "run_start",
+                project=config["project"],
+                build_type=build_type,
+                processors=processors,
+                command=run_command,
+            )
+        stdout_logger = MorisLogFilter(events)
+        # moris runs in child processes, so the cpu time of this process is the overhead
+        # of reading, writing and filtering the log
+        cpu_start = time.process_time()
+        try:
+            run_moris(run_command, log, stdout_logger, cwd=staging)
+            receipt["status"] = "completed"
+        finally:
+            if staging is not None:
+                scratch.collect(staging)
+            receipt["elapsed"] = time.time() - receipt["started"]
+            receipt["moma_cpu_time"] = time.process_time() - cpu_start
+            receipt.update(stdout_logger.summary())
+            write_run_receipt(receipt)
+            stdout_logger.profile.save(Path(PROFILE_FILE))
+            if events is not None:
+                events.emit("run_end", **receipt)
 
     # command = [MORIS_COMMAND, moris_build, args.processors, cpp_file.stem]
 
@@ -0,0 +1,256 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from moma import chunked
+from moma.metrics import load_metrics
+from moma.parameter import write_parameters
+from moma.run import RECEIPT_FILE, run
+from moma.util import atomic_write, format_cell, get_cpp_file, get_log_file, get_moris_config
+
+logger = logging.getLogger(__name__)
+
+SCALING_DIRECTORY = "scaling_study"
+SUMMARY_COLUMNS = [
+    "processors",
+    "status",
+    "walltime",
+    "iteration_time",
+    "speedup",
+    "efficiency",
+    "karp_flatt",
+    "iteration_speedup",
+]
+
+
+def parse_processor_counts(spec: str) -> List[int]:
+    try:
+        counts = sorted({int(value) for value in spec.split(",") if value.strip()})
+    except ValueError:
+        counts = []
+    if not counts or counts[0] < 1:
+        logger.error(f"Invalid processor counts '{spec}', use e.g. 1,2,4,8")
+        raise SystemExit(1)
+    return counts
+
+
+def _weak_values(config: Dict[str, Any], parameter: str, counts: List[int]) -> List[Any]:
+    # the problem size grows with the processors, relative to the smallest count
+    try:
+        base = config["parameters"][parameter]
+    except KeyError:
+        logger.error(f"Parameter '{parameter}' for the weak scaling not found in moris.json")
+        raise SystemExit(1)
+    if isinstance(base, bool) or not isinstance(base, (int, float)):
+        logger.error(f"Parameter '{parameter}' must be a number to scale it, not {base!r}")
+        raise SystemExit(1)
+    values = [base * count / counts[0] for count in counts]
+    return [round(value) if isinstance(base, int) else value for value in values]
+
+
+def _measure(args, processors: int, build: bool, directory: Path) -> Dict[str, Any]:
+    """Run the case on the processors (best of args.repeat) and keep its log and receipt"""
+    import numpy as np
+
+    config = get_moris_config()
+    log_file = get_log_file(config)
+    if build and not args.run_only:
+        # without the shared object every following run would fail or use a stale one
+        build_args = argparse.Namespace(**vars(args))
+        build_args.processors = processors
+        build_args.shared_object_only = True
+        try:
+            run(build_args)
+        except SystemExit:
+            logger.error("Building the shared object failed, the scaling study is aborted")
+            raise
+
+    best: Dict[str, Any] = {"processors": processors, "status": "failed"}
+    for repeat in range(args.repeat):
+        case_args = argparse.Namespace(**vars(args))
+        case_args.processors = processors
+        case_args.run_only = True
+        case_args.shared_object_only = False
+        logger.info(f"Scaling study: {processors} processors (run {repeat + 1}/{args.repeat})")
+        try:
+            run(case_args)
+        except SystemExit:
+            logger.warning(f"The run on {processors} processors failed")
+            continue
+
+        receipt = json.loads(Path(RECEIPT_FILE).read_text())
+        walltime = receipt.get("walltime") or receipt["elapsed"]
+        if best["status"] == "completed" and walltime >= best["walltime"]:
+            continue
+        try:
+            times = load_metrics()["Time"]
+            times = times[~np.isnan(times)]  # incomplete iterations have no time
+            iteration_time = float(times.mean()) if len(times) else None
+        except (FileNotFoundError, KeyError):
+            iteration_time = None
+        best = {
+            "processors": processors,
+            "status": "completed",
+            "walltime": walltime,
+            "iteration_time": iteration_time,
+        }
+        # the log of the fastest run is kept, a compressed one with its chunk index
+        log = chunked.resolve(log_file)
+        kept = directory / f"np{processors}{log.name[len(log_file.stem):]}"
+        os.replace(log, kept)
+        if log != log_file:
+            os.replace(chunked.get_index_file(log), chunked.get_index_file(kept))
+        (directory / f"np{processors}.json").write_text(json.dumps(receipt, indent=4))
+    return best
+
+
+def _ratio(numerator: Optional[float], denominator: Optional[float]) -> Optional[float]:
+    if numerator is None or not denominator:
+        return None
+    return numerator / denominator
+
+
+def analyze(results: List[Dict[str, Any]], weak: bool) -> List[Dict[str, Any]]:
+    """
+    Speedup and parallel efficiency relative to the smallest successful count, which is
+    assumed to be perfectly efficient. For strong scaling the Karp-Flatt metric is the
+    experimentally determined serial fraction e = (1/S - 1/p) / (1 - 1/p); if it grows
+    with p, the parallel overhead grows, not the serial part of the code.
+    """
+    completed = [r for r in results if r["status"] == "completed"]
+    if not completed:
+        return results
+    base = completed[0]
+    p0 = base["processors"]
+    for result in completed:
+        p = result["processors"]
+        if weak:
+            # the work grows with p: the ideal time stays constant
+            efficiency = _ratio(base["walltime"], result["walltime"])
+            result["efficiency"] = efficiency
+            result["speedup"] = None if efficiency is None else efficiency * p / p0
+            iteration = _ratio(base["iteration_time"], result["iteration_time"])
+            result["iteration_speedup"] = None if iteration is None else iteration * p / p0
+        else:
+            walltime = base["walltime"]
+            speedup = _ratio(walltime * p0 if walltime else None, result["walltime"])
+            result["speedup"] = speedup
+            result["efficiency"] = None if speedup is None else speedup / p
+            iteration = _ratio(base["iteration_time"], result["iteration_time"])
+            result["iteration_speedup"] = None if iteration is None else iteration * p0
+            if p > p0 and result["speedup"]:
+                result["karp_flatt"] = (1 / result["speedup"] - 1 / p) / (1 - 1 / p)
+    return results
+
+
+def recommend(results: List[Dict[str, Any]], min_efficiency: float) -> Optional[int]:
+    """The largest processor count that still runs with the minimal efficiency"""
+    candidates = [
+        r["processors"]
+        for r in results
+        if r["status"] == "completed" and (r.get("efficiency") or 0) >= min_efficiency
+    ]
+    return max(candidates) if candidates else None
+
+
+def _record_processors(processors: int):
+    moris_config = Path("moris.json")
+    config = json.loads(moris_config.read_text())
+    config["processors"] = processors
+    with atomic_write(moris_config) as tmp_file:
+        tmp_file.write_text(json.dumps(config, indent=4) + "\n")
+    logger.info(f"Recorded 'processors': {processors} in {moris_config}")
+
+
+def write_summary(results: List[Dict[str, Any]], directory: Path, title: str):
+    from rich.console import Console
+    from rich.table import Table
+
+    table = Table(title=title)
+    for column in SUMMARY_COLUMNS:
+        table.add_column(column, justify="left" if column == "status" else "right")
+    with (directory / "summary.csv").open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(SUMMARY_COLUMNS)
+        for result in results:
+            values = [result.get(column) for column in SUMMARY_COLUMNS]
+            writer.writerow(["" if value is None else value for value in values])
+            table.add_row(*(format_cell(value, ".4g") for value in values))
+    Console().print(table)
+
+
+def scaling_study(args):
+    config = get_moris_config()
+    counts = parse_processor_counts(args.scaling_study)
+    cores = os.cpu_count() or 1
+    if counts[-1] > cores:
+        logger.warning(
+            f"{counts[-1]} processors oversubscribe the {cores} cores of this machine, "
+            + "the timings of those runs are not meaningful"
+        )
+    # logs and receipts of an earlier study must not mix with the new ones
+    directory = Path(SCALING_DIRECTORY)
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir()
+
+    weak_values = _weak_values(config, args.weak, counts) if args.weak else None
+    cpp_file = get_cpp_file(config)
+    results = []
+    try:
+        for i, processors in enumerate(counts):
+            if weak_values is not None:
+                logger.info(f"Weak scaling: {args.weak} = {weak_values[i]}")
+                parameters = {**config["parameters"], args.weak: weak_values[i]}
+                write_parameters(config, cpp_file, parameters)
+            # strong scaling runs the same shared object, weak scaling changes the case
+            build = i == 0 or weak_values is not None
+            result = _measure(args, processors, build, directory)
+            if weak_values is not None:
+                result[args.weak] = weak_values[i]
+            results.append(result)
+    finally:
+        if weak_values is not None:
+            write_parameters(config, cpp_file, config["parameters"])
+
+    results = analyze(results, weak=weak_values is not None)
+    kind = "Weak" if weak_values is not None else "Strong"
+    write_summary(results, directory, f"{kind} scaling of '{config['project']}'")
+
+    karp_flatt = [r["karp_flatt"] for r in results if r.get("karp_flatt") is not None]
+    if len(karp_flatt) > 1 and all(b > a for a, b in zip(karp_flatt, karp_flatt[1:])):
+        logger.info(
+            "The Karp-Flatt metric grows with the processors: "
+            + "the parallel overhead limits the scaling"
+        )
+    elif karp_flatt:
+        logger.info(
+            f"The Karp-Flatt metric is about {sum(karp_flatt) / len(karp_flatt):.3f}: "
+            + "the serial fraction limits the scaling"
+        )
+
+    recommended = recommend(results, args.min_efficiency)
+    (directory / "summary.json").write_text(
+        json.dumps(
+            {
+                "kind": kind.lower(),
+                "min_efficiency": args.min_efficiency,
+                "recommended": recommended,
+                "results": results,
+            },
+            indent=4,
+        )
+    )
+    if recommended is None:
+        logger.error("No run of the scaling study completed, no processor count to recommend")
+        raise SystemExit(1)
+    logger.info(
+        f"Recommended: {recommended} processors (largest count with a parallel efficiency "
+        + f"of at least {args.min_efficiency:.0%}), results in {directory}"
+    )
+    if args.record:
+        _record_processors(recommended)
@@ -0,0 +1,186 @@
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from moma.util import atomic_write, get_moris_config, get_run_directory
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILE = "moma_profile.json"
+PROFILE_VERSION = 1
+ROOT = "moris"
+MAX_NODES = 10_000
+OTHER = "(other sections)"
+
+SectionPath = Tuple[str, ...]
+
+
+class SectionProfile:
+    """
+    Timing tree of the `|__ name - type - info` sections of a moris run.
+
+    moris only prints when a section starts, so a section ends when the next section on
+    the same or a higher level starts (or the run ends). Repeated sections with the same
+    path are aggregated into one node with a count and the total time, which bounds the
+    memory by the number of distinct paths (at most MAX_NODES, the rest is "other").
+    The times are taken when the lines arrive, so they are as accurate as moris flushes
+    its output.
+    """
+
+    def __init__(self, start: Optional[float] = None):
+        self.start = time.monotonic() if start is None else start
+        # path -> [count, total seconds]
+        self.nodes: Dict[SectionPath, List[float]] = {(ROOT,): [1, 0.0]}
+        # open sections: level, path, start
+        self.stack: List[Tuple[int, SectionPath, float]] = []
+
+    def enter(
+        self, level: int, label: str, now: Optional[float] = None
+    ) -> List[Tuple[int, SectionPath, float]]:
+        """Open a section, returns the sections it closed (level, path, seconds)"""
+        now = time.monotonic() if now is None else now
+        closed = self._close(level, now)
+        parent = self.stack[-1][1] if self.stack else (ROOT,)
+        path = parent + (label,)
+        if path not in self.nodes and len(self.nodes) >= MAX_NODES:
+            path = parent + (OTHER,)
+        self.stack.append((level, path, now))
+        return closed
+
+    def _close(self, level: int, now: float) -> List[Tuple[int, SectionPath, float]]:
+        closed = []
+        while self.stack and self.stack[-1][0] >= level:
+            section_level, path, start = self.stack.pop()
+            node = self.nodes.setdefault(path, [0, 0.0])
+            node[0] += 1
+            node[1] += now - start
+            closed.append((section_level, path, now - start))
+        return closed
+
+    def finish(self, now: Optional[float] = None) -> List[Tuple[int, SectionPath, float]]:
+        now = time.monotonic() if now is None else now
+        closed = self._close(-1, now)
+        self.nodes[(ROOT,)][1] = now - self.start
+        return closed
+
+    def save(self, path: Path = Path(PROFILE_FILE)):
+        data = {
+            "version": PROFILE_VERSION,
+            "nodes": [
+                {"path": list(node_path), "count": count, "total": total}
+                for node_path, (count, total) in sorted(self.nodes.items())
+            ],
+        }
+        with atomic_write(path) as tmp_file:
+            tmp_file.write_text(json.dumps(data))
+
+    @classmethod
+    def load(cls, path: Path) -> "SectionProfile":
+        data = json.loads(path.read_text())
+        if data.get("version") != PROFILE_VERSION:
+            raise ValueError(f"Unsupported profile version in {path}")
+        profile = cls(start=0.0)
+        profile.nodes = {
+            tuple(node["path"]): [node["count"], node["total"]] for node in data["nodes"]
+        }
+        return profile
+
+    def self_times(self) -> Dict[SectionPath, float]:
+        """Time of every node that is not spent in one of its children"""
+        times = {path: total for path, (_, total) in self.nodes.items()}
+        for path, (_, total) in self.nodes.items():
+            if len(path) > 1 and path[:-1] in times:
+                times[path[:-1]] -= total
+        # clock jitter between the lines must not produce negative times
+        return {path: max(value, 0.0) for path, value in times.items()}
+
+    def collapsed(self) -> List[str]:
+        """Collapsed stacks (`a;b;c <microseconds>`) as read by flamegraph.pl and inferno"""
+        return [
+            ";".join(frame.replace(";", ",") for frame in path) + f" {round(value * 1e6)}"
+            for path, value in sorted(self.self_times().items())
+            if round(value * 1e6) > 0
+        ]
+
+    def speedscope(self, name: str) -> Dict[str, Any]:
+        """Profile in the speedscope file format, one weighted sample per node"""
+        frames: Dict[str, int] = {}
+        samples = []
+        weights = []
+        for path, value in sorted(self.self_times().items()):
+            samples.append([frames.setdefault(frame, len(frames)) for frame in path])
+            weights.append(value)
+        total = self.nodes[(ROOT,)][1]
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": [{"name": frame} for frame in frames]},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": total,
+                    "samples": samples,
+                    "weights": weights,
+                }
+            ],
+            "name": name,
+            "exporter": "moma",
+        }
+
+    def stages(self) -> List[Tuple[str, int, float, float]]:
+        """Stage label, count, total and self time, aggregated over all paths"""
+        self_times = self.self_times()
+        stages: Dict[str, List[float]] = {}
+        for path, (count, total) in self.nodes.items():
+            stage = stages.setdefault(path[-1], [0, 0.0, 0.0])
+            stage[0] += count
+            # recursive sections would be counted twice in the total
+            if path[-1] not in path[:-1]:
+                stage[1] += total
+            stage[2] += self_times[path]
+        rows = [(label, int(c), total, own) for label, (c, total, own) in stages.items()]
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+
+def export_profile(args):
+    config = get_moris_config()
+    directory = get_run_directory(config, args.run) if args.run else Path(".")
+    try:
+        profile = SectionProfile.load(directory / PROFILE_FILE)
+    except FileNotFoundError:
+        logger.error(
+            f"No {PROFILE_FILE} found in {directory}. It is written by 'moma run', "
+            + "runs of older versions have no section timings."
+        )
+        raise SystemExit(1)
+
+    name = f"{config['project']} {args.run or ''}".strip()
+    if args.format == "collapsed":
+        output = Path(args.output or "profile.folded")
+        output.write_text("\n".join(profile.collapsed()) + "\n")
+    elif args.format == "speedscope":
+        output = Path(args.output or "profile.speedscope.json")
+        output.write_text(json.dumps(profile.speedscope(name)))
+    else:
+        from rich.console import Console
+        from rich.table import Table
+
+        total = profile.nodes[(ROOT,)][1] or 1.0
+        table = Table(title=f"Section timings of '{name}'")
+        for column in ("Stage", "Count", "Total [s]", "Self [s]", "Self [%]"):
+            table.add_column(column, justify="left" if column == "Stage" else "right")
+        for label, count, stage_total, own in profile.stages()[: args.limit]:
+            table.add_row(
+                label,
+                str(count),
+                f"{stage_total:.3f}",
+                f"{own:.3f}",
+                f"{100 * own / total:.1f}",
+            )
+        Console().print(table)
+        return
+    logger.info(f"Saved the {args.format} profile to {output}")
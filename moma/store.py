@@ -1,37 +1,67 @@
-import glob
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from shutil import copy
-import argparse
-import json
 import logging
+import os
 from typing import Generator, List, Union
-from moma.util import get_moris_config, get_cpp_file
+from moma import chunked
+from moma.blob_store import BlobStore, hash_file
+from moma.catalog import catalog_run
+from moma.parameter import PARAMETER_FILE
+from moma.util import (
+    get_moris_config,
+    get_cpp_file,
+    get_result_directory,
+    get_run_directory,
+)
 
 
 logger = logging.getLogger(__name__)
 
+BLOB_DIRECTORY = ".blobs"
+COMPRESS_SUFFIXES = (".exo", ".log")
 
-def transfer_files(file_patterns: list, destination: Path):
+
+def transfer_files(file_patterns: list, destination: Path, blobs: BlobStore):
+    files: List[Path] = []
     for file_pattern in file_patterns:
-        files: Union[Generator[Path, None, None], List[Path]] = []
+        matches: Union[Generator[Path, None, None], List[Path]] = []
         if isinstance(file_pattern, str):
-            files = Path.cwd().glob(str(file_pattern))
+            matches = Path.cwd().glob(str(file_pattern))
         else:
-            files = [file_pattern]
-        for file_name in files:
-            try:
-                # move the file to the results directory
-                dest = destination / file_name.name
-                copy(file_name, dest)
-            except FileNotFoundError:
+            matches = [file_pattern]
+        for file_name in matches:
+            if file_name.exists():
+                files.append(file_name)
+            else:
                 logger.info(f"'{file_name}' is not available and will not be stored")
 
+    # hashing reads every file completely, hashlib releases the GIL so threads run in parallel
+    with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1) or 1) as pool:
+        digests = list(pool.map(hash_file, files))
+
+    new_bytes = 0
+    linked_bytes = 0
+    for file_name, digest in zip(files, digests):
+        size = file_name.stat().st_size
+        if blobs.add(file_name, digest):
+            new_bytes += size
+        else:
+            linked_bytes += size
+        blobs.link(digest, destination / file_name.name)
+        logger.debug(f"Stored {file_name.name} as {digest}")
+
+    logger.info(
+        f"Stored {len(files)} files: {new_bytes / 1024**2:.1f} MiB new, "
+        + f"{linked_bytes / 1024**2:.1f} MiB deduplicated"
+    )
+
 
 def store_results(args):
     config = get_moris_config()
 
-    result_directory = Path(config.get("result_directory", "results"))
+    result_directory = get_result_directory(config)
     result_directory.mkdir(exist_ok=True)
+    blobs = BlobStore(result_directory / BLOB_DIRECTORY)
 
     identifier = args.identifier
     try:
@@ -58,5 +88,58 @@ def store_results(args):
         "moris.json",
         "xtk_temp.exo",
         "Parameter_Receipt.xml",
+        "newton_iterations.npz",
+        "moma_run.json",
+        "moma_profile.json",
+        PARAMETER_FILE,
     ]
-    transfer_files(files, problem_dir)
+    # the log of 'moma run --compress-log' is stored as it is, with its chunk index
+    log_file = problem_file.with_suffix(".log")
+    if not log_file.exists() and (compressed := chunked.find_compressed(log_file)):
+        files[2] = compressed
+        files.append(chunked.get_index_file(compressed))
+    transfer_files(files, problem_dir, blobs)
+    if args.compress:
+        compress_run(problem_dir, blobs, args.codec, args.workers)
+    # the blobs of files that were replaced or overwritten are not linked anymore
+    if args.compress or args.force:
+        removed = blobs.prune()
+        if removed:
+            logger.info(f"Removed {removed} blobs that are not used by any run anymore")
+    catalog_run(config, problem_dir)
+
+
+def compress_run(
+    problem_dir: Path,
+    blobs: BlobStore,
+    codec: Union[str, None] = None,
+    workers: Union[int, None] = None,
+):
+    """Replace the large files of a stored run with seekable compressed chunks"""
+    codec = codec or chunked.DEFAULT_CODEC
+    if codec not in chunked.CODECS:
+        logger.error(f"The {codec} codec is not available, install the zstandard package")
+        raise SystemExit(1)
+    for file_name in sorted(problem_dir.iterdir()):
+        if file_name.suffix not in COMPRESS_SUFFIXES:
+            continue
+        size = file_name.stat().st_size
+        compressed = chunked.compress_file(file_name, codec, workers)
+        # the compressed file and its chunk index are deduplicated like everything else
+        for new_file in (compressed, chunked.get_index_file(compressed)):
+            digest = hash_file(new_file)
+            blobs.add(new_file, digest)
+            blobs.link(digest, new_file)
+        file_name.unlink()
+        ratio = size / max(compressed.stat().st_size, 1)
+        logger.info(f"Compressed {file_name.name} to {compressed.name} ({ratio:.1f}x)")
+
+
+def archive_results(args):
+    config = get_moris_config()
+    problem_dir = get_run_directory(config, args.identifier)
+    blobs = BlobStore(get_result_directory(config) / BLOB_DIRECTORY)
+    compress_run(problem_dir, blobs, args.codec, args.workers)
+    removed = blobs.prune()
+    if removed:
+        logger.info(f"Removed {removed} blobs that are not used by any run anymore")
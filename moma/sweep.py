@@ -0,0 +1,296 @@
+import csv
+import itertools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, ContextManager, Dict, List, Optional
+
+from moma.log_filter import read_walltime
+from moma.metrics import load_metrics
+from moma.run import get_build_type, get_processors
+from moma.util import format_cell, get_cpp_file, get_moris_config
+
+logger = logging.getLogger(__name__)
+
+
+SUMMARY_COLUMNS = [
+    "case",
+    "status",
+    "walltime",
+    "iterations",
+    "final_residual",
+    "mean_iteration_time",
+    "elapsed",
+]
+
+
+@dataclass
+class SweepCase:
+    name: str
+    directory: Path
+    parameters: Dict[str, Any]
+    status: str = "pending"
+    elapsed: Optional[float] = None
+    stats: Dict[str, Any] = field(default_factory=dict)
+
+
+class CoreBudget:
+    """Hands out cores to jobs such that the sum of all `-np` never exceeds the budget"""
+
+    def __init__(self, cores: int):
+        self.cores = cores
+        self.available = cores
+        self._condition = threading.Condition()
+
+    def acquire(self, cores: int):
+        with self._condition:
+            while self.available < cores:
+                self._condition.wait()
+            self.available -= cores
+
+    def release(self, cores: int):
+        with self._condition:
+            self.available += cores
+            self._condition.notify_all()
+
+
+def expand_parameters(
+    parameters: Dict[str, Any], sweep_config: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """
+    Expand the parameters of the moris.json into the list of cases of a sweep.
+
+    Every parameter with a list value is a sweep axis. By default, the cases are the
+    cartesian product of all axes ("mode": "grid"). With "mode": "zip", the lists are
+    paired element-wise. Explicit cases can be added with "cases", a list of parameter
+    dictionaries that are applied on top of the fixed parameters. An explicit case must
+    give a value for every swept parameter, the list has no single value to fall back to.
+    """
+    fixed = {k: v for k, v in parameters.items() if not isinstance(v, list)}
+    axes = {k: v for k, v in parameters.items() if isinstance(v, list)}
+
+    cases = []
+    if axes:
+        mode = sweep_config.get("mode", "grid")
+        if mode == "grid":
+            combinations = itertools.product(*axes.values())
+        elif mode == "zip":
+            lengths = {len(values) for values in axes.values()}
+            if len(lengths) != 1:
+                logger.error("All swept parameters need the same length in zip mode")
+                raise SystemExit(1)
+            combinations = zip(*axes.values())
+        else:
+            logger.error(f"Unknown sweep mode '{mode}'. Use 'grid' or 'zip'")
+            raise SystemExit(1)
+        for combination in combinations:
+            cases.append({**fixed, **dict(zip(axes.keys(), combination))})
+
+    for i, case in enumerate(sweep_config.get("cases", [])):
+        missing = [name for name in axes if name not in case]
+        if missing:
+            logger.error(
+                f"Explicit case {i} of the sweep has no value for the swept parameters "
+                + ", ".join(missing)
+            )
+            raise SystemExit(1)
+        cases.append({**fixed, **case})
+
+    if not cases:
+        cases.append(fixed)
+    return cases
+
+
+def prepare_cases(
+    config: Dict[str, Any], sweep_dir: Path, force: bool
+) -> List[SweepCase]:
+    sweep_config = config.get("sweep", {})
+    parameters = expand_parameters(config.get("parameters", {}), sweep_config)
+    cpp_file = get_cpp_file(config)
+    width = max(3, len(str(len(parameters) - 1)))
+
+    cases = []
+    for i, case_parameters in enumerate(parameters):
+        name = f"case_{i:0{width}d}"
+        cases.append(SweepCase(name, sweep_dir / name, case_parameters))
+
+    existing = [case.directory for case in cases if case.directory.exists()]
+    if existing and not force:
+        logger.error(
+            f"The directory {existing[0]} already exists. Use the --force option to overwrite existing cases."
+        )
+        raise SystemExit(1)
+
+    case_config = {k: v for k, v in config.items() if k != "sweep"}
+    for case in cases:
+        if case.directory.exists():
+            shutil.rmtree(case.directory)
+        case.directory.mkdir(parents=True)
+        shutil.copy(cpp_file, case.directory / cpp_file.name)
+        with (case.directory / "moris.json").open("w") as f:
+            json.dump({**case_config, "parameters": case.parameters}, f, indent=4)
+    return cases
+
+
+def read_case_statistics(case: SweepCase, project: str) -> Dict[str, Any]:
+    stats: Dict[str, Any] = {
+        "walltime": read_walltime(case.directory / f"{project}.log"),
+        "iterations": 0,
+        "final_residual": None,
+        "mean_iteration_time": None,
+    }
+    try:
+        metrics = load_metrics(case.directory)
+    except FileNotFoundError:
+        return stats
+
+    stats["iterations"] = len(metrics["Iteration"])
+    if stats["iterations"]:
+        stats["final_residual"] = float(metrics["ResidualNorm"][-1])
+        stats["mean_iteration_time"] = float(metrics["Time"].mean())
+    return stats
+
+
+def run_case(
+    case: SweepCase,
+    command: List[str],
+    processors: int,
+    budget: CoreBudget,
+    build_lock: ContextManager,
+):
+    start = time.monotonic()
+    with (case.directory / "moma.out").open("w") as out:
+        # builds contend for the moris input file lock, so only one case builds at a time
+        case.status = "building"
+        with build_lock:
+            returncode = subprocess.call(
+                command + ["--apply-parameters", "--shared-object-only"],
+                cwd=case.directory,
+                stdout=out,
+                stderr=subprocess.STDOUT,
+            )
+        if returncode != 0:
+            case.status = "build failed"
+            case.elapsed = time.monotonic() - start
+            return
+
+        case.status = "waiting"
+        budget.acquire(processors)
+        try:
+            case.status = "running"
+            logger.info(f"Running {case.name} on {processors} processors")
+            returncode = subprocess.call(
+                command + ["--run-only"],
+                cwd=case.directory,
+                stdout=out,
+                stderr=subprocess.STDOUT,
+            )
+        finally:
+            budget.release(processors)
+
+    case.elapsed = time.monotonic() - start
+    case.status = "done" if returncode == 0 else "failed"
+    logger.info(f"Finished {case.name} ({case.status}) after {case.elapsed:.1f}s")
+
+
+def write_summary(cases: List[SweepCase], sweep_dir: Path):
+    from rich.console import Console
+    from rich.table import Table
+
+    parameter_names: List[str] = []
+    for case in cases:
+        for name in case.parameters:
+            if name not in parameter_names:
+                parameter_names.append(name)
+
+    table = Table(title="Sweep summary")
+    for column in SUMMARY_COLUMNS[:1] + parameter_names + SUMMARY_COLUMNS[1:]:
+        table.add_column(column)
+
+    summary_file = sweep_dir / "summary.csv"
+    with summary_file.open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(SUMMARY_COLUMNS[:1] + parameter_names + SUMMARY_COLUMNS[1:])
+        for case in cases:
+            values = [
+                case.name,
+                *(case.parameters.get(name) for name in parameter_names),
+                case.status,
+                case.stats.get("walltime"),
+                case.stats.get("iterations"),
+                case.stats.get("final_residual"),
+                case.stats.get("mean_iteration_time"),
+                case.elapsed,
+            ]
+            writer.writerow(["" if value is None else value for value in values])
+            table.add_row(*(format_cell(value) for value in values))
+
+    Console().print(table)
+    logger.info(f"Sweep summary written to {summary_file}")
+
+
+def run_sweep(args):
+    config = get_moris_config()
+    sweep_config = config.get("sweep", {})
+    sweep_dir = Path(sweep_config.get("directory", "sweep"))
+    cores = args.cores or sweep_config.get("cores") or os.cpu_count() or 1
+    processors = get_processors(args, config)
+
+    if processors > cores:
+        logger.error(
+            f"A single case needs {processors} processors but the core budget is {cores}"
+        )
+        raise SystemExit(1)
+
+    if args.dry_run:
+        for i, parameters in enumerate(
+            expand_parameters(config.get("parameters", {}), sweep_config)
+        ):
+            logger.info(f"case {i}: {parameters}")
+        return
+
+    cases = prepare_cases(config, sweep_dir, args.force)
+    logger.info(
+        f"Running {len(cases)} cases in '{sweep_dir}' with {processors} processors each and a budget of {cores} cores"
+    )
+
+    build_type = get_build_type(args)
+    command = [
+        sys.executable,
+        "-m",
+        "moma",
+        "run",
+        "-np",
+        str(processors),
+        f"--{build_type}",
+    ]
+    budget = CoreBudget(cores)
+    # isolated cases build in private overlays of the moris tree, but the build tree may keep
+    # more per-input state than the overlay makes private: one case builds at a time
+    build_lock = threading.Lock()
+    # one extra worker so the next case can build while all cores are busy
+    workers = min(len(cases), cores // processors + 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(run_case, case, command, processors, budget, build_lock)
+            for case in cases
+        ]
+        for future in futures:
+            future.result()
+
+    for case in cases:
+        case.stats = read_case_statistics(case, config["project"])
+    write_summary(cases, sweep_dir)
+
+    failed = [case.name for case in cases if case.status != "done"]
+    if failed:
+        logger.error(f"{len(failed)} of {len(cases)} cases failed: {', '.join(failed)}")
+        raise SystemExit(1)
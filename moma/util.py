@@ -1,15 +1,18 @@
+from contextlib import contextmanager
 from pathlib import Path
 import logging
 import json
-from typing import Any, Dict
+from typing import Any, Dict, Iterator, List
+import fnmatch
 import os
+import threading
 
 logger = logging.getLogger(__name__)
 
 
-def get_moris_config():
+def get_moris_config(directory: Path = Path(".")):
     # read the moris.json file and return the dictionary
-    moris_config = Path("moris.json")
+    moris_config = directory / "moris.json"
     try:
         with moris_config.open("r") as f:
             config = json.load(f)
@@ -17,10 +20,10 @@ def get_moris_config():
         # make sure that the config file contains a project name
         config["project"]
     except KeyError:
-        logger.error("No project name found in moris.json")
+        logger.error(f"No project name found in {moris_config}")
         raise SystemExit(1)
     except FileNotFoundError:
-        logger.error("No moris.json file found")
+        logger.error(f"No {moris_config} file found")
         raise SystemExit(1)
 
     return config
@@ -44,6 +47,64 @@ def get_log_file(config: Dict[str, Any]) -> Path:
         raise SystemExit(1)
 
 
+@contextmanager
+def atomic_write(path: Path) -> Iterator[Path]:
+    """
+    Yields a temporary file next to the path that replaces the path when the block ends.
+    Readers never see a partially written file, on an error the temporary file is removed.
+    """
+    tmp_file = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        yield tmp_file
+        os.replace(tmp_file, path)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def format_cell(value: Any, float_format: str = ".4e") -> str:
+    """Formats a value for a cell of a summary table, missing values are shown as -"""
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return format(value, float_format)
+    return str(value)
+
+
+def get_result_directory(config: Dict[str, Any]) -> Path:
+    return Path(config.get("result_directory", "results"))
+
+
+def get_run_directory(config: Dict[str, Any], identifier: str) -> Path:
+    # directory of a stored run
+    run_directory = get_result_directory(config) / identifier
+    if not run_directory.is_dir():
+        logger.error(f"No stored run '{identifier}' found in {run_directory.parent}")
+        raise SystemExit(1)
+    return run_directory
+
+
+def select_run_directories(config: Dict[str, Any], patterns: List[str]) -> List[Path]:
+    # stored runs matching identifiers or glob patterns, in the order of the patterns
+    result_directory = get_result_directory(config)
+    if not result_directory.is_dir():
+        logger.error(f"Result directory {result_directory} not found")
+        raise SystemExit(1)
+    # hidden directories hold moma internals like the blob store
+    identifiers = sorted(
+        path.name
+        for path in result_directory.iterdir()
+        if path.is_dir() and not path.name.startswith(".")
+    )
+    selected: Dict[str, None] = {}
+    for pattern in patterns:
+        matches = fnmatch.filter(identifiers, pattern)
+        if not matches:
+            logger.error(f"No stored run matches '{pattern}' in {result_directory}")
+            raise SystemExit(1)
+        selected.update(dict.fromkeys(matches))
+    return [result_directory / identifier for identifier in selected]
+
+
 def get_env(env: str) -> str:
     var = os.environ.get(env)
     if var is None:
@@ -0,0 +1,223 @@
+import logging
+import os
+import time
+from array import array
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, Optional, Tuple
+
+from moma import chunked
+from moma.log_filter import WALLTIME_PREFIX, NewtonIteration
+from moma.util import atomic_write, get_log_file, get_moris_config, get_run_directory
+
+logger = logging.getLogger(__name__)
+
+PLOTTED = ("ResidualNorm", "SolutionNorm", "RelResidualDrop", "LoadFactor")
+RATE_WINDOW = 20  # iterations
+
+
+class LogFollower:
+    """
+    Reads the complete lines appended to a growing log since the last poll and collects
+    the finished Newton iterations in typed arrays.
+    """
+
+    def __init__(self, log_file: Path):
+        self.log_file = log_file
+        self.reset()
+
+    def reset(self):
+        self.inode: Optional[int] = None
+        self.offset = 0
+        self.newton_iteration = NewtonIteration(record=False)
+        self.columns: Dict[str, array] = {name: array("d") for name in PLOTTED}
+        self.iterations = array("q")
+        # wall clock times at which the last iterations were seen, for the rate
+        self.seen: Deque[Tuple[float, float]] = deque(maxlen=RATE_WINDOW)
+        self.walltime: Optional[float] = None
+
+    def poll(self) -> int:
+        """Read the new lines of the log and return the number of new iterations"""
+        try:
+            inode = chunked.resolve(self.log_file).stat().st_ino
+            size = chunked.uncompressed_size(self.log_file)
+        except FileNotFoundError:
+            return 0
+        if self.inode is not None and (inode != self.inode or size < self.offset):
+            logger.debug(f"{self.log_file} was replaced, starting over")
+            self.reset()
+        self.inode = inode
+        if size == self.offset:
+            return 0
+
+        new = 0
+        now = time.monotonic()
+        with chunked.open_binary(self.log_file) as f:
+            f.seek(self.offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    # the last line is still being written
+                    break
+                self.offset += len(raw)
+                line = raw.decode("utf8", errors="replace").strip()
+                if self.newton_iteration.parse_line(line):
+                    if self.newton_iteration.is_complete():
+                        self._append(self.newton_iteration.take(), now)
+                        new += 1
+                elif line.startswith(WALLTIME_PREFIX):
+                    try:
+                        self.walltime = float(line[len(WALLTIME_PREFIX) :].split()[0])
+                    except (ValueError, IndexError):
+                        self.walltime = float("nan")
+        return new
+
+    def _append(self, properties: Dict, now: float):
+        self.iterations.append(len(self.iterations) + 1)
+        for name, values in self.columns.items():
+            value = properties[name]
+            values.append(float("nan") if value is None else value)
+        self.seen.append((now, properties["LoadFactor"] or 0.0))
+
+    @property
+    def finished(self) -> bool:
+        return self.walltime is not None
+
+    def rate(self) -> Optional[float]:
+        """Newton iterations per minute over the last RATE_WINDOW iterations"""
+        if len(self.seen) < 2 or self.seen[-1][0] == self.seen[0][0]:
+            return None
+        return 60 * (len(self.seen) - 1) / (self.seen[-1][0] - self.seen[0][0])
+
+    def eta(self) -> Optional[float]:
+        """Seconds until the load factor reaches 1, extrapolated from its recent progress"""
+        if len(self.seen) < 2:
+            return None
+        (start, first), (end, last) = self.seen[0], self.seen[-1]
+        if last >= 1.0 or last <= first or end == start:
+            return None
+        return (1.0 - last) * (end - start) / (last - first)
+
+
+class ResidualPlot:
+    """
+    Residual plot that is updated in place: the lines keep their artists and only get new
+    data, and the figure is rendered with the Agg backend without pyplot or a GUI.
+    """
+
+    def __init__(self, title: str, output: Path, dpi: int):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.output = output
+        self.dpi = dpi
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.lines = {
+            "ResidualNorm": self.ax.plot([], [], label="Residual Norm")[0],
+            "SolutionNorm": self.ax.plot([], [], label="Solution Norm")[0],
+            "RelResidualDrop": self.ax.plot([], [], label="Relative Residual Drop")[0],
+        }
+        self.load_factor = None
+        self.ax.set_yscale("log")
+        self.ax.set_xlabel("Iteration")
+        self.ax.set_ylabel("Norm")
+        self.ax.set_title(title)
+        self.ax.legend()
+
+    def update(self, follower: LogFollower):
+        iterations = follower.iterations
+        for name, line in self.lines.items():
+            line.set_data(iterations, follower.columns[name])
+        load_factor = follower.columns["LoadFactor"]
+        # like plot_residuals, the load factor is only shown when load stepping is used
+        if self.load_factor is None and min(load_factor) != max(load_factor):
+            self.load_factor = self.ax.plot([], [], label="Load Factor")[0]
+            self.ax.legend()
+        if self.load_factor is not None:
+            self.load_factor.set_data(iterations, load_factor)
+        self.ax.relim()
+        self.ax.autoscale_view()
+
+        # replace the image atomically, so viewers never load a half written file
+        with atomic_write(self.output) as tmp_file:
+            self.figure.savefig(
+                tmp_file, dpi=self.dpi, format=self.output.suffix[1:] or "png"
+            )
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def _status_table(follower: LogFollower, started: float, plotted: Optional[float]):
+    from rich.table import Table
+
+    table = Table.grid(padding=(0, 2))
+    table.add_column(style="bold")
+    table.add_column()
+    count = len(follower.iterations)
+    table.add_row("Log", str(follower.log_file))
+    table.add_row("Iterations", str(count))
+    if count:
+        for name in PLOTTED:
+            table.add_row(name, f"{follower.columns[name][-1]:.4e}")
+    rate = follower.rate()
+    table.add_row("Rate", f"{rate:.1f} iterations/min" if rate else "-")
+    table.add_row("ETA", _format_duration(follower.eta()))
+    table.add_row("Watching", _format_duration(time.monotonic() - started))
+    if plotted is not None:
+        table.add_row("Plotted", time.strftime("%X", time.localtime(plotted)))
+    if follower.finished:
+        table.add_row("Walltime", f"{follower.walltime} s (finished)")
+    return table
+
+
+def watch_run(args):
+    from rich.live import Live
+
+    config = get_moris_config()
+    log_file = get_log_file(config)
+    if args.run:
+        log_file = get_run_directory(config, args.run) / log_file.name
+    if args.nice:
+        # the ranks of the watched run should not share their cores with the watcher
+        os.nice(args.nice)
+
+    follower = LogFollower(log_file)
+    plot = None
+    if not args.no_plot:
+        output = args.output or (
+            f"residuals_{args.run}.png" if args.run else "residuals.png"
+        )
+        plot = ResidualPlot(f"'{config['project']}' Residuals", Path(output), args.dpi)
+
+    started = time.monotonic()
+    last_plot = -float("inf")
+    plotted: Optional[float] = None
+    pending = False
+    with Live(auto_refresh=False, transient=False) as live:
+        try:
+            while True:
+                pending |= follower.poll() > 0
+                done = follower.finished or args.run is not None
+                # rendering the figure is the expensive part, so it is throttled
+                if plot and pending and len(follower.iterations) and (
+                    done or time.monotonic() - last_plot >= args.plot_interval
+                ):
+                    plot.update(follower)
+                    last_plot = time.monotonic()
+                    plotted = time.time()
+                    pending = False
+                live.update(_status_table(follower, started, plotted), refresh=True)
+                if done:
+                    break
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            if plot and pending and len(follower.iterations):
+                plot.update(follower)
+    if plot and len(follower.iterations):
+        logger.info(f"Saved the residual plot to {plot.output}")
@@ -0,0 +1,47 @@
+import math
+
+import pytest
+
+from moma.bench import _betainc, welch_t_test
+
+
+@pytest.mark.parametrize(
+    "a, b, x, expected",
+    [
+        # reference values of scipy.special.betainc
+        (2.0, 3.0, 0.4, 0.5248),
+        (0.5, 0.5, 0.1, 0.20483276469913345),
+        (10.0, 0.5, 0.9, 0.15164090963470994),
+    ],
+)
+def test_betainc_matches_scipy(a, b, x, expected):
+    assert _betainc(a, b, x) == pytest.approx(expected, rel=1e-9)
+
+
+def test_betainc_bounds():
+    assert _betainc(2.0, 3.0, 0.0) == 0.0
+    assert _betainc(2.0, 3.0, 1.0) == 1.0
+
+
+@pytest.mark.parametrize(
+    "a, b, expected",
+    [
+        # reference values of scipy.stats.ttest_ind(a, b, equal_var=False)
+        ([1.0, 1.1, 0.9, 1.05, 0.95], [1.2, 1.3, 1.25, 1.15, 1.35], 0.0010528257933665429),
+        ([10.0, 10.5, 9.8], [10.1, 10.4, 9.9, 10.2], 0.8436717205313334),
+    ],
+)
+def test_welch_t_test_matches_scipy(a, b, expected):
+    assert welch_t_test(a, b) == pytest.approx(expected, rel=1e-9)
+
+
+def test_welch_t_test_is_symmetric():
+    a = [1.0, 1.1, 0.9, 1.05]
+    b = [1.2, 1.3, 1.25]
+    assert welch_t_test(a, b) == pytest.approx(welch_t_test(b, a))
+
+
+def test_welch_t_test_degenerate_samples():
+    assert math.isnan(welch_t_test([1.0], [1.0, 2.0]))
+    assert welch_t_test([1.0, 1.0], [1.0, 1.0]) == 1.0
+    assert welch_t_test([1.0, 1.0], [2.0, 2.0]) == 0.0
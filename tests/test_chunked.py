@@ -0,0 +1,103 @@
+import io
+import json
+import os
+
+import pytest
+
+from moma import chunked
+from moma.chunked import ChunkedReader, ChunkedWriter, compress_file, get_index_file
+
+CODECS = sorted(chunked.CODECS)
+
+
+def _data(size: int) -> bytes:
+    # compressible, but not trivially
+    lines = (f"line {i} residual {i * 0.37 % 1:.6e}\n" for i in range(size))
+    return "".join(lines).encode()
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("workers", [1, 3])
+def test_compress_file_round_trip(tmp_path, codec, workers):
+    data = _data(5000)
+    source = tmp_path / "run.log"
+    source.write_bytes(data)
+
+    compressed = compress_file(source, codec, workers, chunk_size=4096)
+    assert compressed.name == "run.log" + chunked.CODECS[codec].suffix
+    index = json.loads(get_index_file(compressed).read_text())
+    assert index["size"] == len(data)
+    assert len(index["chunks"]) == -(-len(data) // 4096)
+
+    with ChunkedReader(compressed) as reader:
+        assert reader.read() == data
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_reader_seeks_into_any_chunk(tmp_path, codec):
+    data = _data(3000)
+    source = tmp_path / "run.log"
+    source.write_bytes(data)
+    compressed = compress_file(source, codec, chunk_size=1000)
+
+    # a raw reader may return less than asked for at the end of a chunk
+    with io.BufferedReader(ChunkedReader(compressed), buffer_size=64) as reader:
+        for offset in (0, 999, 1000, 1001, 25_000, len(data) - 1):
+            reader.seek(offset)
+            assert reader.read(50) == data[offset : offset + 50]
+        assert reader.seek(-10, io.SEEK_END) == len(data) - 10
+        assert reader.read() == data[-10:]
+        assert reader.read() == b""
+
+
+def test_open_binary_reads_the_compressed_variant(tmp_path):
+    data = _data(2000)
+    source = tmp_path / "run.log"
+    source.write_bytes(data)
+    compress_file(source, "gzip", chunk_size=1000)
+    os.unlink(source)
+
+    assert chunked.exists(source)
+    assert chunked.uncompressed_size(source) == len(data)
+    with chunked.open_binary(source) as f:
+        assert f.readlines() == data.splitlines(True)
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_writer_round_trip(tmp_path, codec):
+    data = _data(5000)
+    with ChunkedWriter(tmp_path / "run.log", codec, workers=2, chunk_size=4096) as writer:
+        for start in range(0, len(data), 777):
+            writer.write(data[start : start + 777])
+            writer.flush()
+
+    with ChunkedReader(writer.path) as reader:
+        assert reader.read() == data
+
+
+def test_writer_index_covers_the_appended_chunks_only(tmp_path):
+    writer = ChunkedWriter(tmp_path / "run.log", "gzip", chunk_size=100, max_delay=3600)
+    writer.write(b"x" * 200)
+    writer.write(b"x" * 50)
+    while writer.in_flight:
+        writer._collect(block=True)
+    writer._write_index()
+
+    # the last 50 bytes are still buffered and not readable yet
+    with ChunkedReader(writer.path) as reader:
+        assert reader.read() == b"x" * 200
+    writer.close()
+    with ChunkedReader(writer.path) as reader:
+        assert reader.read() == b"x" * 250
+
+
+def test_writer_indexes_on_a_quiet_flush(tmp_path):
+    writer = ChunkedWriter(tmp_path / "run.log", "gzip", chunk_size=10, max_delay=0)
+    writer.write(b"0123456789abc\n")
+    while writer.in_flight:
+        writer._collect(block=True)
+    # no new output, but the interval has passed since the last index
+    writer.last_index -= ChunkedWriter.INDEX_INTERVAL
+    writer.flush()
+    assert json.loads(get_index_file(writer.path).read_text())["size"] == 14
+    writer.close()
@@ -0,0 +1,63 @@
+import pytest
+
+from moma.parameter import _read_at_runtime, _replace_values
+
+
+def _rewrite(source: str, parameters):
+    remaining = dict(parameters)
+    lines = _read_at_runtime(source.splitlines(True), remaining)
+    return "".join(lines), remaining
+
+
+def test_variables_are_read_at_runtime():
+    source, remaining = _rewrite("double tH = 0.5;\nint tN = 4;\n", {"tH": 0.25})
+    assert source == (
+        'double tH = moma::parameter< std::decay_t< decltype( tH ) > >( "tH", 0.5 );\n'
+        + "int tN = 4;\n"
+    )
+    assert remaining == {}
+
+
+def test_unknown_parameters_remain():
+    _, remaining = _rewrite("int tN = 4;\n", {"tMissing": 1})
+    assert remaining == {"tMissing": 1}
+
+
+def test_rewrite_is_idempotent():
+    source, _ = _rewrite("double tH = 0.5;\n", {"tH": 0.25})
+    again, _ = _rewrite(source, {"tH": 0.75})
+    assert again == source
+
+
+def test_auto_uses_the_type_of_the_initializer():
+    source, _ = _rewrite("auto tN = 4;\n", {"tN": 5})
+    assert source == 'auto tN = moma::parameter< std::decay_t< decltype( 4 ) > >( "tN", 4 );\n'
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "constexpr int tN = 4;\n",
+        "const int tN = 4;\ndouble tA[ tN ];\n",
+        "const int tN = 4;\ndouble tA[tN * 2];\n",
+        "const int tN = 4;\nstd::array< double, tN > tA;\n",
+        "const int tN = 4;\nstatic_assert( tN > 0 );\n",
+    ],
+)
+def test_compile_time_constants_stay_in_the_source(source):
+    rewritten, remaining = _rewrite(source, {"tN": 5})
+    assert rewritten == source.replace("= 4", "= 5")
+    assert "moma::parameter" not in rewritten
+    assert remaining == {}
+
+
+def test_runtime_use_in_a_loop_is_not_a_constant():
+    source, _ = _rewrite("int tN = 4;\nfor ( int i = 0; i < tN; ++i ) {}\n", {"tN": 5})
+    assert "moma::parameter" in source
+
+
+def test_replace_values():
+    remaining = {"tN": 8, "tX": 1}
+    lines = _replace_values(["int tN = 4;\n", "double tH = 0.5;\n"], remaining)
+    assert lines == ["int tN = 8;\n", "double tH = 0.5;\n"]
+    assert remaining == {"tX": 1}
@@ -0,0 +1,37 @@
+from pathlib import Path
+
+from moma.post import MarkerMatcher, _collect_marker_values, _marker_outputs
+
+
+def test_matcher_returns_the_marker_and_the_value():
+    matcher = MarkerMatcher(["Residual:", "Time:"])
+    assert matcher.match("  Residual: 1.0, 2.0  ") == ("Residual:", "1.0, 2.0")
+    assert matcher.match("Time:") == ("Time:", "")
+    assert matcher.match("other line") is None
+    assert matcher.match("") is None
+
+
+def test_matcher_prefers_the_longest_marker():
+    # the order of the markers does not matter
+    for markers in (["R", "Res"], ["Res", "R"]):
+        matcher = MarkerMatcher(markers)
+        assert matcher.match("Res: 1") == ("Res", ": 1")
+        assert matcher.match("Rate: 2") == ("R", "ate: 2")
+
+
+def test_collect_marker_values_matches_like_the_extractor():
+    values, feed = _collect_marker_values(["R", "Res"])
+    for line in ("Res 1", "R 2", "Res", "x R 3"):
+        feed(line)
+    # lines without a value are skipped
+    assert values == {"R": ["2"], "Res": ["1"]}
+
+
+def test_marker_outputs():
+    assert _marker_outputs(Path("out.csv"), ["a"]) == [Path("out.csv")]
+    assert _marker_outputs(Path("out.csv"), ["a b", "a-b", "a_b_1", "c:"]) == [
+        Path("out_a_b_2.csv"),
+        Path("out_a_b_3.csv"),
+        Path("out_a_b_1.csv"),
+        Path("out_c.csv"),
+    ]
@@ -0,0 +1,77 @@
+import pytest
+
+from moma.scaling import _weak_values, analyze, parse_processor_counts, recommend
+
+
+def _result(processors, walltime, iteration_time=None, status="completed"):
+    return {
+        "processors": processors,
+        "status": status,
+        "walltime": walltime,
+        "iteration_time": iteration_time,
+    }
+
+
+def test_parse_processor_counts():
+    assert parse_processor_counts("4,1, 2,2") == [1, 2, 4]
+    with pytest.raises(SystemExit):
+        parse_processor_counts("0,2")
+    with pytest.raises(SystemExit):
+        parse_processor_counts("one,two")
+
+
+def test_weak_values_scale_with_the_processors():
+    config = {"parameters": {"tN": 10, "tH": 0.5}}
+    assert _weak_values(config, "tN", [2, 4, 6]) == [10, 20, 30]
+    assert _weak_values(config, "tH", [1, 3]) == [0.5, 1.5]
+    with pytest.raises(SystemExit):
+        _weak_values(config, "tMissing", [1, 2])
+
+
+def test_strong_scaling():
+    results = analyze(
+        [_result(1, 100.0, 1.0), _result(2, 60.0, 0.5), _result(4, 40.0)], weak=False
+    )
+    assert [r["speedup"] for r in results] == pytest.approx([1.0, 100 / 60, 2.5])
+    assert [r["efficiency"] for r in results] == pytest.approx([1.0, 100 / 120, 0.625])
+    assert results[1]["iteration_speedup"] == pytest.approx(2.0)
+    assert results[2]["iteration_speedup"] is None
+    # Karp-Flatt: (1/S - 1/p) / (1 - 1/p), not defined for the base count
+    assert "karp_flatt" not in results[0]
+    assert results[1]["karp_flatt"] == pytest.approx((0.6 - 0.5) / 0.5)
+    assert results[2]["karp_flatt"] == pytest.approx((0.4 - 0.25) / 0.75)
+
+
+def test_strong_scaling_relative_to_the_smallest_completed_count():
+    results = analyze(
+        [_result(1, None, status="failed"), _result(2, 50.0), _result(4, 25.0)], weak=False
+    )
+    assert results[1]["speedup"] == pytest.approx(2.0)
+    assert results[2]["speedup"] == pytest.approx(4.0)
+    assert results[2]["efficiency"] == pytest.approx(1.0)
+    assert results[2]["karp_flatt"] == pytest.approx(0.0)
+
+
+def test_weak_scaling():
+    results = analyze([_result(1, 10.0, 1.0), _result(4, 12.5, 1.25)], weak=True)
+    assert results[1]["efficiency"] == pytest.approx(0.8)
+    assert results[1]["speedup"] == pytest.approx(3.2)
+    assert results[1]["iteration_speedup"] == pytest.approx(3.2)
+    assert "karp_flatt" not in results[1]
+
+
+def test_zero_walltime_leaves_the_metrics_empty():
+    for weak in (False, True):
+        results = analyze([_result(1, 0.0), _result(2, 0.0)], weak=weak)
+        assert results[1]["speedup"] is None
+        assert results[1]["efficiency"] is None
+
+
+def test_recommend_the_largest_efficient_count():
+    results = analyze(
+        [_result(1, 100.0), _result(2, 55.0), _result(4, 40.0), _result(8, 35.0)],
+        weak=False,
+    )
+    assert recommend(results, 0.7) == 2
+    assert recommend(results, 0.6) == 4
+    assert recommend([_result(1, None, status="failed")], 0.7) is None
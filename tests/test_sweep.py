@@ -0,0 +1,45 @@
+import pytest
+
+from moma.sweep import expand_parameters
+
+
+def test_grid_is_the_cartesian_product_of_the_axes():
+    cases = expand_parameters({"tOrder": 1, "tX": [10, 20], "tY": ["a", "b"]}, {})
+    assert cases == [
+        {"tOrder": 1, "tX": 10, "tY": "a"},
+        {"tOrder": 1, "tX": 10, "tY": "b"},
+        {"tOrder": 1, "tX": 20, "tY": "a"},
+        {"tOrder": 1, "tX": 20, "tY": "b"},
+    ]
+
+
+def test_zip_pairs_the_axes():
+    cases = expand_parameters({"tX": [10, 20], "tY": [1, 2]}, {"mode": "zip"})
+    assert cases == [{"tX": 10, "tY": 1}, {"tX": 20, "tY": 2}]
+
+
+def test_zip_needs_axes_of_the_same_length():
+    with pytest.raises(SystemExit):
+        expand_parameters({"tX": [10, 20], "tY": [1]}, {"mode": "zip"})
+
+
+def test_unknown_mode():
+    with pytest.raises(SystemExit):
+        expand_parameters({"tX": [10, 20]}, {"mode": "random"})
+
+
+def test_explicit_cases_are_applied_on_top_of_the_fixed_parameters():
+    cases = expand_parameters(
+        {"tOrder": 1, "tX": [10]}, {"cases": [{"tX": 30, "tOrder": 2}]}
+    )
+    assert cases == [{"tOrder": 1, "tX": 10}, {"tOrder": 2, "tX": 30}]
+
+
+def test_explicit_case_without_a_swept_parameter_is_rejected():
+    with pytest.raises(SystemExit):
+        expand_parameters({"tX": [10, 20], "tY": 1}, {"cases": [{"tY": 2}]})
+
+
+def test_without_axes_there_is_one_case():
+    assert expand_parameters({"tX": 1}, {}) == [{"tX": 1}]
+    assert expand_parameters({}, {}) == [{}]